@@ -8,26 +8,43 @@ from transformers import AutoTokenizer, AutoModelForCausalLM
 from model.model import MiniMindLM
 from model.LMConfig import LMConfig
 from model.model_lora import *
+from model.model_quant import load_quantized
+from model.kv_cache import SinkKVCache
 
 warnings.filterwarnings('ignore')
 
 
+def rope_scaling(args):
+    """命令行参数对应的RoPE长度外推配置"""
+    if args.rope_scaling == 'none':
+        return None
+    return {'type': args.rope_scaling, 'factor': args.rope_factor,
+            'original_max_position_embeddings': args.rope_original_max_len}
+
+
 def init_model(args):
     tokenizer = AutoTokenizer.from_pretrained('./model/minimind_tokenizer')
     if args.load == 0:
         moe_path = '_moe' if args.use_moe else ''
         modes = {0: 'pretrain', 1: 'full_sft', 2: 'rlhf', 3: 'reason', 4: 'grpo'}
-        ckp = f'./{args.out_dir}/{modes[args.model_mode]}_{args.dim}{moe_path}.pth'
+        quant_path = f'_{args.quant}' if args.quant != 'none' else ''
+        ckp = f'./{args.out_dir}/{modes[args.model_mode]}_{args.dim}{moe_path}{quant_path}.pth'
         print(f"加载权重{ckp}")
         model = MiniMindLM(LMConfig(
             dim=args.dim,
             n_layers=args.n_layers,
             max_seq_len=args.max_seq_len,
-            use_moe=args.use_moe
+            use_moe=args.use_moe,
+            rope_scaling=rope_scaling(args),
+            fused_proj=args.fused_proj
         ))
 
-        state_dict = torch.load(ckp, map_location=args.device)
-        model.load_state_dict({k: v for k, v in state_dict.items() if 'mask' not in k}, strict=True)
+        if args.quant != 'none':
+            # 由scripts/quantize_model.py生成的量化权重
+            load_quantized(model, ckp, map_location=args.device)
+        else:
+            state_dict = torch.load(ckp, map_location=args.device)
+            model.load_state_dict({k: v for k, v in state_dict.items() if 'mask' not in k}, strict=True)
 
         if args.lora_name != 'None':
             apply_lora(model)
@@ -40,6 +57,23 @@ def init_model(args):
     return model.eval().to(args.device), tokenizer
 
 
+def init_draft_model(args):
+    # 投机解码的草稿模型：与主模型同一训练阶段、共享分词器的小模型，例如以MiniMind2-Small为MiniMind2起草
+    modes = {0: 'pretrain', 1: 'full_sft', 2: 'rlhf', 3: 'reason', 4: 'grpo'}
+    ckp = f'./{args.out_dir}/{modes[args.model_mode]}_{args.draft_dim}.pth'
+    print(f"加载草稿模型权重{ckp}")
+    draft_model = MiniMindLM(LMConfig(
+        dim=args.draft_dim,
+        n_layers=args.draft_n_layers,
+        max_seq_len=args.max_seq_len,
+        rope_scaling=rope_scaling(args),
+        fused_proj=args.fused_proj
+    ))
+    state_dict = torch.load(ckp, map_location=args.device)
+    draft_model.load_state_dict({k: v for k, v in state_dict.items() if 'mask' not in k}, strict=True)
+    return draft_model.eval().to(args.device)
+
+
 def get_prompt_datas(args):
     if args.model_mode == 0:
         # pretrain模型的接龙能力（无法对话）
@@ -116,6 +150,18 @@ def main():
     parser.add_argument('--n_layers', default=8, type=int)
     parser.add_argument('--max_seq_len', default=8192, type=int)
     parser.add_argument('--use_moe', default=False, type=bool)
+    # RoPE长度外推（dynamic: 动态NTK，yarn: YaRN），让按rope_original_max_len训练的权重支持更长的上下文
+    parser.add_argument('--rope_scaling', default='none', type=str, choices=['none', 'dynamic', 'yarn'])
+    parser.add_argument('--rope_factor', default=4.0, type=float)
+    parser.add_argument('--rope_original_max_len', default=512, type=int)
+    # 合并投影层（wqkv/w13），按原布局保存的权重加载时自动合并
+    parser.add_argument('--fused_proj', action='store_true')
+    # 加载量化权重（先用scripts/quantize_model.py转换），int8适合在CPU上推理，int4内存占用最小
+    parser.add_argument('--quant', default='none', type=str, choices=['none', 'int8', 'int4'])
+    # KV缓存的存储格式，长上下文时int8/fp8可以把缓存占用降到fp32的约1/4
+    parser.add_argument('--kv_cache_dtype', default=None, type=str, choices=['int8', 'fp8'])
+    # 分块预填充的块长度（0为一次预填充），长提示词时限制预填充的峰值激活内存
+    parser.add_argument('--prefill_chunk_size', default=0, type=int)
     # 携带历史对话上下文条数
     # history_cnt需要设为偶数，即【用户问题, 模型回答】为1组；设置为0时，即当前query不携带历史上文
     # 模型未经过外推微调时，在更长的上下文的chat_template时难免出现性能的明显退化，因此需要注意此处设置
@@ -124,9 +170,27 @@ def main():
     parser.add_argument('--load', default=0, type=int, help="0: 原生torch权重，1: transformers加载")
     parser.add_argument('--model_mode', default=1, type=int,
                         help="0: 预训练模型，1: SFT-Chat模型，2: RLHF-Chat模型，3: Reason模型，4: RLAIF-Chat模型")
+    # 投机解码：draft_dim为0时不使用；例如为MiniMind2(dim=768, n_layers=16)配置 --draft_dim 512 --draft_n_layers 8
+    parser.add_argument('--draft_dim', default=0, type=int)
+    parser.add_argument('--draft_n_layers', default=8, type=int)
+    parser.add_argument('--num_speculative_tokens', default=4, type=int)
+    # 注意力汇聚+滑动窗口（需流式输出）：window_size>0时整段对话共用一个固定大小的KV缓存，
+    # 每轮只预填充新增的内容，超出窗口的历史被遗忘，对话可以无限进行，此时不再按history_cnt截断历史
+    parser.add_argument('--window_size', default=0, type=int)
+    parser.add_argument('--num_sink_tokens', default=4, type=int)
     args = parser.parse_args()
+    if args.window_size and args.draft_dim:
+        # 投机解码不使用会话缓存，每轮只送入新增内容时模型会看不到之前的对话
+        parser.error('--window_size cannot be combined with --draft_dim')
 
     model, tokenizer = init_model(args)
+    model.params.kv_cache_dtype = args.kv_cache_dtype
+    draft_model = init_draft_model(args) if args.draft_dim else None
+
+    session_cache = SinkKVCache(model.params, 1, args.window_size, args.num_sink_tokens, device=args.device,
+                                dtype=model.output.weight.dtype) if args.window_size and args.stream else None
+    # 已经送入会话缓存的文本
+    cached_text = ''
 
     prompts = get_prompt_datas(args)
     test_mode = int(input('[0] 自动测试\n[1] 手动输入\n'))
@@ -136,18 +200,29 @@ def main():
         # setup_seed(2025)  # 如需固定每次输出则换成【固定】的随机种子
         if test_mode == 0: print(f'👶: {prompt}')
 
-        messages = messages[-args.history_cnt:] if args.history_cnt else []
+        if session_cache is None:
+            messages = messages[-args.history_cnt:] if args.history_cnt else []
         messages.append({"role": "user", "content": prompt})
 
         new_prompt = tokenizer.apply_chat_template(
             messages,
             tokenize=False,
             add_generation_prompt=True
-        )[-args.max_seq_len - 1:] if args.model_mode != 0 else (tokenizer.bos_token + prompt)
+        ) if args.model_mode != 0 else (tokenizer.bos_token + prompt)
+        input_text = new_prompt
+        if session_cache is not None:
+            # 会话缓存中已有之前的对话，只送入新增的部分；对不上时（如预训练模式）从头开始
+            if cached_text and new_prompt.startswith(cached_text):
+                input_text = new_prompt[len(cached_text):]
+            else:
+                session_cache.reset()
+        else:
+            input_text = new_prompt[-args.max_seq_len - 1:]
 
         answer = new_prompt
         with torch.no_grad():
-            x = torch.tensor(tokenizer(new_prompt)['input_ids'], device=args.device).unsqueeze(0)
+            x = torch.tensor(tokenizer(input_text)['input_ids'], device=args.device).unsqueeze(0)
+            session_args = {'past_key_values': session_cache} if session_cache is not None else {}
             outputs = model.generate(
                 x,
                 eos_token_id=tokenizer.eos_token_id,
@@ -155,7 +230,11 @@ def main():
                 temperature=args.temperature,
                 top_p=args.top_p,
                 stream=args.stream,
-                pad_token_id=tokenizer.pad_token_id
+                pad_token_id=tokenizer.pad_token_id,
+                draft_model=draft_model,
+                num_speculative_tokens=args.num_speculative_tokens,
+                prefill_chunk_size=args.prefill_chunk_size or None,
+                **session_args
             )
 
             print('🤖️: ', end='')
@@ -172,9 +251,13 @@ def main():
                         history_idx = len(answer)
             except StopIteration:
                 print("No answer")
+            if draft_model is not None and model.speculative_stats:
+                stats = model.speculative_stats
+                print(f"\n[投机解码] 接受率: {stats['acceptance_rate']:.2%}, 速度: {stats['tokens_per_second']:.1f} tokens/s", end='')
             print('\n')
 
         messages.append({"role": "assistant", "content": answer})
+        cached_text = new_prompt + answer
 
 
 if __name__ == "__main__":
@@ -17,8 +17,13 @@ class LMConfig(PretrainedConfig):
             norm_eps: float = 1e-5,
             max_seq_len: int = 8192,
             rope_theta: int = 1e6,
+            rope_scaling: dict = None,
             dropout: float = 0.0,
             flash_attn: bool = True,
+            kv_cache_dtype: str = None,
+            fused_proj: bool = False,
+            activation_checkpoint: str = 'none',
+            activation_checkpoint_n: int = 2,
             ####################################################
             # Here are the specific configurations of MOE
             # When use_moe is false, the following is invalid
@@ -32,6 +37,8 @@ class LMConfig(PretrainedConfig):
             aux_loss_alpha: float = 0.1,
             seq_aux: bool = True,
             norm_topk_prob: bool = True,
+            moe_capacity_factor: float = None,
+            expert_parallel: bool = False,
             **kwargs,
     ):
         self.dim = dim
@@ -44,8 +51,21 @@ class LMConfig(PretrainedConfig):
         self.norm_eps = norm_eps
         self.max_seq_len = max_seq_len
         self.rope_theta = rope_theta
+        # RoPE长度外推，让按较短长度训练的权重在更长的上下文中推理，例如：
+        # {'type': 'dynamic', 'factor': 4.0, 'original_max_position_embeddings': 512}：动态NTK，超出原始长度后按实际长度增大基数
+        # {'type': 'yarn', 'factor': 4.0, 'original_max_position_embeddings': 512}：YaRN，可选beta_fast/beta_slow/attention_factor
+        self.rope_scaling = rope_scaling
         self.dropout = dropout
         self.flash_attn = flash_attn
+        # 推理时KV缓存的存储格式：None与模型权重相同；'int8'/'fp8'按(token, head)量化存储
+        self.kv_cache_dtype = kv_cache_dtype
+        # 合并投影层：Attention的wq/wk/wv合并为wqkv，FeedForward的w1/w3合并为w13，每层少发起几次矩阵乘；
+        # 两种布局的权重可以互相加载（加载时自动合并/拆分）
+        self.fused_proj = fused_proj
+        # 训练时的激活检查点（前向不保存块内激活，反向时重新计算，以时间换显存）：
+        # 'none'不使用；'every'每个MiniMindBlock；'every_n'每activation_checkpoint_n层一个块；'attention'只有注意力子层
+        self.activation_checkpoint = activation_checkpoint
+        self.activation_checkpoint_n = activation_checkpoint_n
         ####################################################
         # Here are the specific configurations of MOE
         # When use_moe is false, the following is invalid
@@ -58,4 +78,6 @@ class LMConfig(PretrainedConfig):
         self.aux_loss_alpha = aux_loss_alpha  # 辅助损失的alpha参数
         self.seq_aux = seq_aux  # 是否在序列级别上计算辅助损失
         self.norm_topk_prob = norm_topk_prob  # 是否标准化top-k概率
+        self.moe_capacity_factor = moe_capacity_factor  # 训练时每个专家的容量系数，超出容量的token被丢弃；None表示不限制
+        self.expert_parallel = expert_parallel  # 专家并行：路由专家分片到torch.distributed的各个rank上，token用all-to-all交换
         super().__init__(**kwargs)
@@ -52,6 +52,94 @@ class PretrainDataset(Dataset):
         return X, Y, loss_mask
 
 
+def load_token_shards(data_path):
+    """
+    找到scripts/pretokenize_data.py生成的token分片，返回[(bin路径, idx路径)]
+
+    data_path可以是分片所在的目录（按文件名顺序取其中所有.bin），也可以是单个.bin文件
+    """
+    if os.path.isdir(data_path):
+        bins = sorted(os.path.join(data_path, f) for f in os.listdir(data_path) if f.endswith('.bin'))
+    else:
+        bins = [data_path]
+    if not bins:
+        raise FileNotFoundError(f"no .bin token shards found in {data_path}")
+    return [(path, path[:-len('.bin')] + '.idx') for path in bins]
+
+
+class PretrainMemmapDataset(Dataset):
+    """
+    读取预先分词的token分片的预训练数据集，pack=False时与PretrainDataset给出相同的样本
+
+    每个分片是一个.bin文件（所有文档的token依次拼接，uint16）和一个.idx文件（int64，第i篇文档的起止位置为idx[i]、idx[i+1]）。
+    .bin用np.memmap打开，样本直接从映射的文件中切出，不在内存中保存文本或token列表，也不再每轮重复分词；
+    同一台机器上的各个DDP rank和DataLoader worker共享操作系统的页缓存。
+
+    pack=True时把文档首尾相接，按max_length切成没有填充的样本（相邻样本重叠一个token，每个token恰好作为一次目标），
+    短文档不再浪费大部分计算；此时另外返回每个位置在所属文档中的位置position_ids（在文档开头和样本开头为0），
+    配合MiniMindLM的position_ids/document_ids参数可以让每篇文档从位置0开始，并且注意力不跨文档。
+    """
+
+    def __init__(self, data_path, max_length=512, pad_token_id=0, pack=False):
+        super().__init__()
+        self.max_length = max_length
+        self.pad_token_id = pad_token_id
+        self.pack = pack
+        self.shards = load_token_shards(data_path)
+        # 各分片的文档起止位置（每篇文档8字节）；token本身在第一次取样本时才映射，避免随Dataset复制到子进程
+        self.offsets = [np.fromfile(idx, dtype=np.int64) for _, idx in self.shards]
+        # 各分片的样本数：pack时按max_length切分，分片末尾不足一个样本的token丢弃；否则每篇文档一个样本
+        if pack:
+            self.sample_starts = np.cumsum([0] + [max(int(o[-1]) - 1, 0) // (max_length - 1) for o in self.offsets])
+        else:
+            self.sample_starts = np.cumsum([0] + [len(o) - 1 for o in self.offsets])
+        self.tokens = None
+
+    def __len__(self):
+        return int(self.sample_starts[-1])
+
+    def __getstate__(self):
+        # 多进程DataLoader以spawn方式启动worker时不复制已映射的token
+        return {**self.__dict__, 'tokens': None}
+
+    def _locate(self, index):
+        """返回第index个文档（pack=True时为样本）所在的分片与分片内的编号"""
+        if self.tokens is None:
+            self.tokens = [np.memmap(path, dtype=np.uint16, mode='r') for path, _ in self.shards]
+        shard = int(np.searchsorted(self.sample_starts, index, side='right')) - 1
+        return shard, index - self.sample_starts[shard]
+
+    def _document(self, index):
+        """返回第index篇文档的token（memmap视图，不复制）"""
+        shard, i = self._locate(index)
+        offsets = self.offsets[shard]
+        return self.tokens[shard][offsets[i]:offsets[i + 1]]
+
+    def _packed(self, index):
+        """返回第index个打包样本：max_length个连续token及输入部分各位置在所属文档中的位置"""
+        shard, i = self._locate(index)
+        start = i * (self.max_length - 1)
+        input_ids = torch.from_numpy(self.tokens[shard][start:start + self.max_length].astype(np.int64))
+        # 每个输入位置所属文档的起点；样本中途开始的文档从样本开头算起
+        pos = np.arange(start, start + self.max_length - 1)
+        doc_start = self.offsets[shard][np.searchsorted(self.offsets[shard], pos, side='right') - 1]
+        position_ids = torch.from_numpy(pos - np.maximum(doc_start, start))
+        return input_ids[:-1], input_ids[1:], torch.ones(self.max_length - 1, dtype=torch.long), position_ids
+
+    def __getitem__(self, index):
+        if self.pack:
+            return self._packed(index)
+        # 与PretrainDataset相同：文档截断到max_length，不足的部分用pad_token_id填充并从损失中去掉
+        tokens = self._document(index)[:self.max_length]
+        input_ids = torch.full((self.max_length,), self.pad_token_id, dtype=torch.long)
+        input_ids[:len(tokens)] = torch.from_numpy(tokens.astype(np.int64))
+        loss_mask = torch.arange(1, self.max_length) < len(tokens)
+
+        X = input_ids[:-1]
+        Y = input_ids[1:]
+        return X, Y, loss_mask.long()
+
+
 class SFTDataset(Dataset):
     def __init__(self, jsonl_path, tokenizer, max_length=1024):
         super().__init__()
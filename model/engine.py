@@ -0,0 +1,313 @@
+import queue
+import threading
+from collections import deque
+
+import torch
+
+from .kv_cache import PagedKVCache, RadixCache
+from .logits_process import LogitsProcessor
+
+
+class GenerationRequest:
+    """
+    一次生成请求：由服务端线程提交，推理引擎线程逐token写回结果
+
+    请求对象本身是线程安全的：引擎线程把新token放入内部队列，
+    服务端可以在任意线程中迭代请求对象（流式输出），或调用result()等待全部结果。
+    """
+    def __init__(self, input_ids, max_new_tokens=512, temperature=0.7, top_p=0.92, eos_token_id=2,
+                 top_k=0, min_p=0., repetition_penalty=1., presence_penalty=0., frequency_penalty=0.):
+        """
+        参数:
+            input_ids: 提示词的token ID列表
+            max_new_tokens: 最多生成的token数量
+            temperature: 温度参数
+            top_p: 核采样参数
+            eos_token_id: 结束符token的ID
+            top_k: 只在概率最高的top_k个token中采样，0表示不限制
+            min_p: 过滤概率低于 min_p * 最大概率 的token
+            repetition_penalty: 重复惩罚因子
+            presence_penalty: 存在惩罚
+            frequency_penalty: 频率惩罚
+        """
+        self.input_ids = list(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.eos_token_id = eos_token_id
+        self.top_k = top_k
+        self.min_p = min_p
+        self.repetition_penalty = repetition_penalty
+        self.presence_penalty = presence_penalty
+        self.frequency_penalty = frequency_penalty
+        # 已生成的token ID
+        self.output_ids = []
+        # 结束原因：'stop'（生成了结束符）或'length'（达到长度上限）
+        self.finish_reason = None
+        # 命中前缀缓存、跳过预填充的token数
+        self.num_cached_tokens = 0
+        self._queue = queue.Queue()
+
+    @property
+    def sampling_params(self):
+        """传给LogitsProcessor的采样参数"""
+        return {name: getattr(self, name) for name in LogitsProcessor.DEFAULTS}
+
+    def __iter__(self):
+        """逐个产出新生成的token ID，直到请求结束"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def result(self):
+        """阻塞直到生成结束，返回全部生成的token ID"""
+        for _ in self:
+            pass
+        return self.output_ids
+
+
+class InferenceEngine:
+    """
+    连续批处理（Continuous Batching）推理引擎
+
+    引擎在后台线程中运行一个循环：每一步先在token边界处接纳等待中的新请求（单独预填充后加入批次），
+    然后对批次中所有请求做一次前向计算，各生成一个token；生成结束的请求立即退出批次并归还缓存块。
+    这样并发请求共享同一个解码批次，吞吐量随批次大小增长，长请求也不会阻塞其它请求。
+
+    KV缓存采用分页管理（PagedKVCache），调度以空闲块数为预算：
+    - 只有空闲块足够容纳提示词时才接纳新请求；
+    - 解码中空闲块耗尽时，抢占最后接纳的请求（归还其全部块），它之后会带着已生成的内容重新预填充并继续生成。
+
+    开启前缀缓存（RadixCache）时，预填充完成和请求结束后都会把完整的块登记到前缀树中，
+    新请求只需预填充最长已缓存前缀之后的部分；空闲块不足时先按LRU淘汰前缀缓存。
+
+    设置prefill_chunk_size时启用分块预填充：每一步最多预填充prefill_chunk_size个提示词token，
+    然后批次中的其它请求照常解码一步。长提示词分多步写入缓存，既限制了预填充的峰值激活内存，
+    也不会让正在解码的请求等待整个长提示词预填充完，token间延迟有上界。
+    正在预填充的请求（最多一个）占用缓存的最后一行，预填充完成后才加入解码批次。
+    """
+    def __init__(self, model, max_batch_size: int = 8, max_seq_len: int = None,
+                 num_blocks: int = 1024, block_size: int = 16, enable_prefix_cache: bool = True,
+                 prefill_chunk_size: int = None):
+        """
+        参数:
+            model: 已加载权重的MiniMindLM模型
+            max_batch_size: 最多同时解码的请求数
+            max_seq_len: 每个请求（提示词+生成内容）的最大长度，默认取模型配置中的max_seq_len
+            num_blocks: KV缓存池中块的总数，所有请求共享
+            block_size: 每个块容纳的token数
+            enable_prefix_cache: 是否启用基于前缀树的前缀缓存
+            prefill_chunk_size: 每一步最多预填充的token数，None表示接纳时一次预填充整个提示词
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        weight = model.output.weight
+        self.device = weight.device
+        self.cache = PagedKVCache(model.params, num_blocks, block_size, device=weight.device, dtype=weight.dtype)
+        # 单个请求不能超过整个缓存池的容量，否则即使独占缓存也无法继续生成
+        self.max_seq_len = min(max_seq_len or model.params.max_seq_len, self.cache.max_seq_len)
+        self.prefix_cache = RadixCache(self.cache) if enable_prefix_cache else None
+        # 各行的采样参数与token计数，行号与running、缓存的行号一致
+        self.processor = LogitsProcessor(model.vocab_size, device=weight.device)
+        # 外部提交的请求（线程安全）
+        self.waiting = queue.Queue()
+        # 引擎线程内待接纳的请求，被抢占的请求放在队首优先重新接纳
+        self.pending = deque()
+        # 正在解码的请求，running[i]对应缓存的第i行
+        self.running = []
+        # 正在分块预填充的请求，对应缓存的第len(running)行（最后一行）
+        self.prefilling = None
+        self.prefill_chunk_size = prefill_chunk_size
+        self._thread = None
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        """提交一个请求（线程安全），返回请求对象本身"""
+        self.waiting.put(request)
+        return request
+
+    def start(self):
+        """启动后台推理线程"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+        return self
+
+    def _loop(self):
+        with torch.inference_mode():
+            while True:
+                # 没有任何工作时，阻塞等待新请求
+                if not self.running and not self.pending and self.prefilling is None:
+                    self.pending.append(self.waiting.get())
+                while not self.waiting.empty():
+                    self.pending.append(self.waiting.get_nowait())
+                # 在token边界接纳新请求，并推进至多prefill_chunk_size个token的预填充
+                self.schedule()
+                if self.running:
+                    try:
+                        self.step()
+                    except Exception as e:
+                        for i in reversed(range(len(self.running))):
+                            self._retire(i, e)
+
+    def schedule(self):
+        """
+        按先来先服务接纳待处理的请求并预填充，直到批次满、缓存块不足，
+        或者（分块预填充时）本步已预填充了prefill_chunk_size个token
+        """
+        budget = self.prefill_chunk_size or float('inf')
+        while budget > 0:
+            if self.prefilling is None and not self._admit_next():
+                break
+            budget -= self._prefill(budget)
+
+    def _admit_next(self) -> bool:
+        """接纳下一个待处理的请求开始预填充，没有可接纳的请求时返回False"""
+        while self.pending and len(self.running) < self.max_batch_size:
+            request = self.pending[0]
+            if not request.output_ids:
+                # 截断过长的提示词，至少为生成留出一个位置
+                request.input_ids = request.input_ids[-(self.max_seq_len - 1):]
+            # 预填充提示词以及被抢占前已生成的内容，并为下一个token预留位置
+            blocks = self.cache.blocks_needed(len(request.input_ids) + len(request.output_ids) + 1)
+            if blocks > self.cache.num_blocks:
+                self.pending.popleft()
+                request._queue.put(RuntimeError(f"请求过长，超出KV缓存容量: {blocks} > {self.cache.num_blocks} 块"))
+                continue
+            if not self._admit(request):
+                return False
+            self.pending.popleft()
+            return True
+        return False
+
+    def _reserve(self, row: int, num_tokens: int) -> bool:
+        """为row行预留num_tokens个token的空间，空闲块不足时先淘汰前缀缓存"""
+        shortage = self.cache.blocks_to_reserve(row, num_tokens) - self.cache.num_free_blocks
+        if shortage > 0 and self.prefix_cache is not None:
+            self.prefix_cache.evict(shortage)
+        return self.cache.reserve(row, num_tokens)
+
+    def _admit(self, request: GenerationRequest) -> bool:
+        """
+        为请求分配缓存块（包括整个提示词和下一个token），使它成为正在预填充的请求
+
+        返回:
+            缓存块不足、无法接纳时返回False（请求保持待处理状态）
+        """
+        input_ids = request.input_ids + request.output_ids
+        # 复用最长的已缓存前缀，至少留下最后一个token做预填充以得到它的logits
+        prefix_blocks = self.prefix_cache.match_prefix(input_ids[:-1]) if self.prefix_cache is not None else []
+        prefix_len = len(prefix_blocks) * self.cache.block_size
+        row = self.cache.add_sequence(prefix_blocks, prefix_len)
+        if not self._reserve(row, len(input_ids) - prefix_len + 1):
+            self.cache.remove_sequence(row)
+            return False
+        request.num_cached_tokens = prefix_len
+        self.prefilling = request
+        return True
+
+    def _prefill(self, budget) -> int:
+        """
+        预填充正在预填充的请求的下一块（至多budget个token），返回预填充的token数
+
+        最后一块预填充完成后采样出下一个token，请求加入解码批次
+        """
+        request, row = self.prefilling, len(self.running)
+        input_ids = request.input_ids + request.output_ids
+        start_pos = self.cache.lengths[row]
+        end_pos = int(min(len(input_ids), start_pos + budget))
+        try:
+            self.cache.prepare_prefill(row)
+            x = torch.tensor([input_ids[start_pos:end_pos]], dtype=torch.long, device=self.device)
+            # 各块依次接在已缓存的内容之后，start_pos处的偏移因果掩码保证跨块的注意力正确
+            out = self.model(x, past_key_values=self.cache, use_cache=True, start_pos=start_pos, logits_to_keep=1)
+            self.cache.lengths[row] = end_pos
+        except Exception as e:
+            self.prefilling = None
+            self.cache.remove_sequence(row)
+            request._queue.put(e)
+            return end_pos - start_pos
+        if end_pos < len(input_ids):
+            return end_pos - start_pos
+
+        self.prefilling = None
+        self.running.append(request)
+        self.processor.add_rows(1, [input_ids], **request.sampling_params)
+        try:
+            token = self.processor.sample(out.logits[:, -1, :], row=row)
+            self.processor.update(token, row=row)
+            token = token.item()
+        except Exception as e:
+            self._retire(row, e)
+            return end_pos - start_pos
+        self._cache_prefix(row)
+        if self._append(row, token):
+            self._retire(row)
+        return end_pos - start_pos
+
+    def _cache_prefix(self, row: int):
+        """把row行已写满的块登记到前缀缓存"""
+        if self.prefix_cache is not None:
+            request = self.running[row]
+            token_ids = (request.input_ids + request.output_ids)[:self.cache.lengths[row]]
+            self.prefix_cache.insert(token_ids, self.cache.block_tables[row])
+
+    def step(self):
+        """对所有正在解码的请求做一次前向计算，每个请求生成一个token"""
+        # 为每行的新token预留空间；空闲块不足时从最后接纳的请求开始抢占
+        row = 0
+        while row < len(self.running):
+            if self._reserve(row, 1):
+                row += 1
+            else:
+                self._preempt(len(self.running) - 1)
+        if not self.running:
+            return
+
+        tokens = torch.tensor([[r.output_ids[-1]] for r in self.running], dtype=torch.long, device=self.device)
+        # 正在预填充的请求位于缓存的最后一行，不参与解码
+        write_pos = self.cache.prepare_decode(len(self.running))
+        # 每行只能看到自己已缓存的token和当前token
+        attention_mask = torch.arange(self.cache._read_len, device=self.device)[None, :] <= write_pos[:, None]
+        out = self.model(tokens, past_key_values=self.cache, use_cache=True,
+                         attention_mask=attention_mask, position_ids=write_pos[:, None])
+        # 各行的采样参数与token计数都已在设备上，整个批次每步只在取出新token时同步一次主机
+        next_tokens = self.processor.sample(out.logits[:, -1, :])
+        self.processor.update(next_tokens)
+        next_tokens = next_tokens.tolist()
+        finished = []
+        for i, token in enumerate(next_tokens):
+            self.cache.lengths[i] += 1
+            if self._append(i, token):
+                finished.append(i)
+        for i in reversed(finished):
+            self._retire(i)
+
+    def _append(self, row: int, token: int) -> bool:
+        """记录row行新生成的token并推送给请求方，返回该请求是否已结束"""
+        request = self.running[row]
+        request.output_ids.append(token)
+        request._queue.put(token)
+        if token == request.eos_token_id:
+            request.finish_reason = 'stop'
+        elif len(request.output_ids) >= request.max_new_tokens or self.cache.lengths[row] >= self.max_seq_len:
+            request.finish_reason = 'length'
+        return request.finish_reason is not None
+
+    def _preempt(self, row: int):
+        """抢占row行的请求：归还它的缓存块，放回待处理队列的队首"""
+        self._cache_prefix(row)
+        self.pending.appendleft(self.running.pop(row))
+        self.processor.remove_row(row)
+        self.cache.remove_sequence(row)
+
+    def _retire(self, row: int, error: Exception = None):
+        """结束row行的请求并归还缓存块"""
+        if error is None:
+            self._cache_prefix(row)
+        self.running.pop(row)._queue.put(error)
+        self.processor.remove_row(row)
+        self.cache.remove_sequence(row)
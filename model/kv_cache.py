@@ -0,0 +1,450 @@
+import heapq
+
+import torch
+
+from .LMConfig import LMConfig
+
+# 量化KV缓存的存储格式：(存储用的dtype, 量化后的数值dtype, 最大可表示的值)
+# fp8(e4m3)在CPU上不支持index_put，按位存成uint8，读取时再view回fp8
+KV_CACHE_FORMATS = {
+    'int8': (torch.int8, torch.int8, 127.),
+    'fp8': (torch.uint8, torch.float8_e4m3fn, 448.),
+}
+
+
+class KVCache:
+    """
+    预分配的静态KV缓存（Static KV Cache）
+
+    原先的实现中，每生成一个token，每一层都要通过 torch.cat 把历史K/V与新K/V拼接，
+    相当于每步都重新分配并复制全部历史，总的显存流量是 O(n²)，还会让显存分配器碎片化。
+    本实现在生成开始时一次性按最大长度分配好缓存，之后只在 start_pos 处原地写入。
+
+    缓存采用 head-major 布局：[n_layers, batch_size, n_kv_heads, max_seq_len, head_dim]，
+    读取时返回的 [batch_size, n_kv_heads, kv_len, head_dim] 视图可以直接参与注意力计算，无需转置复制。
+
+    config.kv_cache_dtype为'int8'或'fp8'时，K/V按(token, head)量化后存储：每个token的每个头
+    各有一个scale（max|x| / 最大可表示值），与数据一起按[..., 1]的形状保存。
+    读取时反量化回计算精度再交给注意力，缓存占用约为fp32的1/4、fp16/bf16的1/2。
+    """
+    def __init__(self, config: LMConfig, batch_size: int, max_seq_len: int, device=None, dtype=None):
+        """
+        初始化并预分配KV缓存
+
+        参数:
+            config: 模型配置参数
+            batch_size: 批次大小
+            max_seq_len: 缓存可容纳的最大序列长度（提示词 + 生成的token）
+            device: 缓存所在设备
+            dtype: 缓存的数据类型，一般与模型权重一致
+        """
+        shape = (config.n_layers, batch_size, self._n_kv_heads(config), max_seq_len, config.dim // config.n_heads)
+        self._allocate(config, shape, device, dtype)
+        self.max_seq_len = max_seq_len
+        # 当前已写入缓存的序列长度，即下一次写入的起始位置(start_pos)
+        self.seq_len = 0
+
+    def update(self, layer_id: int, xk: torch.Tensor, xv: torch.Tensor):
+        """
+        将当前步的K/V原地写入缓存，并返回该层截至当前位置的全部K/V
+
+        参数:
+            layer_id: 层索引
+            xk: 当前步的键张量，形状为 [batch_size, seq_len, n_kv_heads, head_dim]
+            xv: 当前步的值张量，形状为 [batch_size, seq_len, n_kv_heads, head_dim]
+
+        返回:
+            keys, values: 形状为 [batch_size, n_kv_heads, start_pos + seq_len, head_dim] 的缓存视图
+        """
+        start_pos = self.seq_len
+        end_pos = start_pos + xk.shape[1]
+        assert end_pos <= self.max_seq_len, f"KV缓存已满: {end_pos} > {self.max_seq_len}"
+        index = (layer_id, slice(None), slice(None), slice(start_pos, end_pos))
+        self._write(index, xk.transpose(1, 2), xv.transpose(1, 2))
+        return self._read((layer_id, slice(None), slice(None), slice(None, end_pos)))
+
+    def make_room(self, num_tokens: int, pos_cis: torch.Tensor = None) -> int:
+        """
+        在前向计算写入num_tokens个token之前调用，返回这些token的起始位置
+
+        静态缓存直接从当前长度处写入；滑动窗口缓存（SinkKVCache）会先淘汰窗口外的token
+        """
+        return self.seq_len
+
+    @staticmethod
+    def _n_kv_heads(config: LMConfig):
+        return config.n_heads if config.n_kv_heads is None else config.n_kv_heads
+
+    @classmethod
+    def bytes_per_token(cls, config: LMConfig, dtype=torch.float32) -> int:
+        """缓存一个token（所有层的K和V）占用的字节数"""
+        n = config.n_layers * cls._n_kv_heads(config) * 2
+        quant = getattr(config, 'kv_cache_dtype', None)
+        if quant is None:
+            return n * (config.dim // config.n_heads) * torch.empty((), dtype=dtype).element_size()
+        return n * (config.dim // config.n_heads + torch.empty((), dtype=dtype).element_size())
+
+    def _allocate(self, config: LMConfig, shape, device, dtype):
+        """按shape分配K/V缓存；量化时另分配每个(token, head)的scale，形状为shape[:-1] + (1,)"""
+        self.dtype = dtype or torch.get_default_dtype()
+        self.quant_format = getattr(config, 'kv_cache_dtype', None)
+        if self.quant_format is None:
+            self.k_cache = torch.zeros(shape, device=device, dtype=dtype)
+            self.v_cache = torch.zeros(shape, device=device, dtype=dtype)
+            return
+        assert self.quant_format in KV_CACHE_FORMATS, f"不支持的kv_cache_dtype: {self.quant_format}"
+        storage_dtype = KV_CACHE_FORMATS[self.quant_format][0]
+        self.k_cache = torch.zeros(shape, device=device, dtype=storage_dtype)
+        self.v_cache = torch.zeros(shape, device=device, dtype=storage_dtype)
+        self.k_scale = torch.zeros(shape[:-1] + (1,), device=device, dtype=self.dtype)
+        self.v_scale = torch.zeros(shape[:-1] + (1,), device=device, dtype=self.dtype)
+
+    def _quantize(self, x: torch.Tensor):
+        """按最后一维（head_dim）对称量化，返回(存储格式的数据, scale)"""
+        storage_dtype, value_dtype, max_value = KV_CACHE_FORMATS[self.quant_format]
+        scale = x.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-8) / max_value
+        x = x.float() / scale
+        if value_dtype == torch.int8:
+            x = x.round().clamp(-max_value, max_value).to(torch.int8)
+        else:
+            x = x.to(value_dtype).view(storage_dtype)
+        return x, scale.to(self.dtype)
+
+    def _dequantize(self, x: torch.Tensor, scale: torch.Tensor):
+        value_dtype = KV_CACHE_FORMATS[self.quant_format][1]
+        if x.dtype != value_dtype:
+            x = x.view(value_dtype)
+        return x.to(self.dtype) * scale
+
+    def _read(self, index):
+        """读取缓存的index位置，返回计算精度的(K, V)"""
+        if self.quant_format is None:
+            return self.k_cache[index], self.v_cache[index]
+        return (self._dequantize(self.k_cache[index], self.k_scale[index]),
+                self._dequantize(self.v_cache[index], self.v_scale[index]))
+
+    def _write(self, index, xk: torch.Tensor, xv: torch.Tensor):
+        """把K/V写入缓存的index位置（需要时先量化）"""
+        if self.quant_format is None:
+            self.k_cache[index] = xk
+            self.v_cache[index] = xv
+            return
+        self.k_cache[index], self.k_scale[index] = self._quantize(xk)
+        self.v_cache[index], self.v_scale[index] = self._quantize(xv)
+
+    def reset(self):
+        """清空缓存（只重置长度，不释放已分配的显存，便于复用）"""
+        self.seq_len = 0
+
+
+class SinkKVCache(KVCache):
+    """
+    注意力汇聚（Attention Sink）+ 滑动窗口的KV缓存（StreamingLLM）
+
+    只保留序列最开头的num_sink_tokens个token（注意力汇聚点，去掉它们会让注意力分布崩溃）
+    和最近的window_size个token，更早的token被淘汰。缓存占用与每个token的计算量都不随对话长度增长，
+    一个会话可以无限地持续下去（超出窗口的内容会被遗忘）。
+
+    位置按token在缓存中的下标分配，而不是在整段对话中的绝对位置，因此永远不会超出RoPE预计算的范围：
+    窗口滑动时，剩下的token整体前移，K按前移的距离反向旋转（RoPE的旋转可以叠加），V原样搬移。
+    """
+    def __init__(self, config: LMConfig, batch_size: int = 1, window_size: int = 1024, num_sink_tokens: int = 4,
+                 device=None, dtype=None):
+        """
+        参数:
+            config: 模型配置参数
+            batch_size: 批次大小
+            window_size: 滑动窗口保留的最近token数，也是每次前向最多能写入的token数
+            num_sink_tokens: 始终保留的开头token数
+            device: 缓存所在设备
+            dtype: 缓存的数据类型
+        """
+        super().__init__(config, batch_size, num_sink_tokens + window_size, device=device, dtype=dtype)
+        self.window_size = window_size
+        self.num_sink_tokens = num_sink_tokens
+
+    def make_room(self, num_tokens: int, pos_cis: torch.Tensor = None) -> int:
+        """
+        淘汰最早的非汇聚token，使缓存能再容纳num_tokens个token，返回新token的起始位置
+
+        参数:
+            num_tokens: 即将写入的token数，不能超过window_size（更长的输入需要分块送入）
+            pos_cis: 模型的RoPE表（见precompute_pos_cis），形状为[max_pos, 2*head_dim]，用于把前移的K反向旋转
+        """
+        assert num_tokens <= self.window_size, f"一次最多写入{self.window_size}个token: {num_tokens}"
+        shift = self.seq_len + num_tokens - self.max_seq_len
+        if shift > 0:
+            begin, end = self.num_sink_tokens, self.seq_len
+            if begin + shift < end:
+                # 所有层一起前移：[n_layers, batch_size, n_kv_heads, 保留的token, head_dim]
+                keys, values = self._read((slice(None), slice(None), slice(None), slice(begin + shift, end)))
+                # 位置减小shift：每组(x1, x2)反向旋转shift*θ，即 x * (cos, cos) - (x2, x1) * (-sin, sin)；
+                # 表中可能乘了YaRN的缩放系数，除去它的模长
+                cos, sin = pos_cis[shift].float().chunk(2, dim=-1)
+                norm = (cos * cos + sin * sin).sqrt()
+                pairs = keys.float().unflatten(-1, (-1, 2))
+                swapped = torch.cat((pairs[..., 1:], pairs[..., :1]), dim=-1).flatten(-2)
+                keys = ((pairs.flatten(-2) * cos - swapped * sin) / norm).to(values.dtype)
+                self._write((slice(None), slice(None), slice(None), slice(begin, end - shift)), keys, values.clone())
+            self.seq_len -= shift
+        return self.seq_len
+
+
+class PagedKVCache(KVCache):
+    """
+    分页KV缓存（Paged KV Cache）
+
+    连续批处理服务中请求长度差异很大（服务端默认max_tokens为8192），若按最大长度为每个请求预留连续缓存，
+    绝大部分预留空间都被浪费。这里把缓存切成固定大小的块(block)组成的池子：
+    - 空闲块用free list管理；
+    - 每个序列维护一张块表(block table)，记录它的第i个块在池中的编号；
+    - 序列增长时按需从free list取块，结束时归还。
+    这样显存占用只与实际缓存的token数成正比，调度器可以根据空闲块数决定接纳或抢占请求。
+
+    池的布局为 [n_layers, num_blocks, n_kv_heads, block_size, head_dim]，
+    注意力计算前按块表把各序列的块gather成 [batch_size, n_kv_heads, kv_len, head_dim]。
+    """
+    def __init__(self, config: LMConfig, num_blocks: int, block_size: int = 16, device=None, dtype=None):
+        """
+        参数:
+            config: 模型配置参数
+            num_blocks: 池中块的总数，决定了缓存的显存预算（可容纳num_blocks*block_size个token）
+            block_size: 每个块容纳的token数
+            device: 缓存所在设备
+            dtype: 缓存的数据类型
+        """
+        shape = (config.n_layers, num_blocks, self._n_kv_heads(config), block_size, config.dim // config.n_heads)
+        self._allocate(config, shape, device, dtype)
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.max_seq_len = num_blocks * block_size
+        self.seq_len = 0
+        # 空闲块编号，以及每个块的引用计数（块可以被多个序列和前缀缓存共享）
+        self.free_blocks = list(range(num_blocks))
+        self.ref_counts = [0] * num_blocks
+        # 每个序列的块表和已缓存长度，下标即该序列在批次中的行号
+        self.block_tables = []
+        self.lengths = []
+        # 下一次update的写入方式，由prepare_prefill/prepare_decode设置
+        self._prefill_row = None
+        self._write_pos = None
+        self._tables = None
+        self._read_len = 0
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self.free_blocks)
+
+    def blocks_needed(self, num_tokens: int) -> int:
+        """容纳num_tokens个token所需的块数"""
+        return (num_tokens + self.block_size - 1) // self.block_size
+
+    def incref(self, block: int):
+        self.ref_counts[block] += 1
+
+    def decref(self, block: int):
+        """减少块的引用计数，没有任何引用时归还到free list"""
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self.free_blocks.append(block)
+
+    def add_sequence(self, prefix_blocks=(), prefix_len: int = 0) -> int:
+        """
+        新增一个序列，返回它的行号
+
+        参数:
+            prefix_blocks: 可直接复用的已缓存前缀块（来自前缀缓存，均为写满的块）
+            prefix_len: 前缀块中已缓存的token数
+        """
+        for block in prefix_blocks:
+            self.incref(block)
+        self.block_tables.append(list(prefix_blocks))
+        self.lengths.append(prefix_len)
+        return len(self.lengths) - 1
+
+    def remove_sequence(self, row: int):
+        """移除一个序列并释放它对各块的引用，后面的行号依次前移"""
+        for block in self.block_tables.pop(row):
+            self.decref(block)
+        self.lengths.pop(row)
+
+    def blocks_to_reserve(self, row: int, num_tokens: int) -> int:
+        """row行再写入num_tokens个token还需要新分配的块数"""
+        return max(self.blocks_needed(self.lengths[row] + num_tokens) - len(self.block_tables[row]), 0)
+
+    def reserve(self, row: int, num_tokens: int) -> bool:
+        """
+        确保row行还能再写入num_tokens个token，不够时从free list分配新块
+
+        返回:
+            是否分配成功；空闲块不足时不分配任何块并返回False
+        """
+        extra = self.blocks_to_reserve(row, num_tokens)
+        if extra > len(self.free_blocks):
+            return False
+        for _ in range(extra):
+            block = self.free_blocks.pop()
+            self.incref(block)
+            self.block_tables[row].append(block)
+        return True
+
+    def prepare_prefill(self, row: int):
+        """下一次前向计算只针对row这一行，从它当前的长度处连续写入（需先reserve）"""
+        self._prefill_row = row
+        start_pos = self.lengths[row]
+        table = self.block_tables[row]
+        device = self.k_cache.device
+        self._tables = torch.tensor([table], dtype=torch.long, device=device)
+        # 从当前长度到已分配容量的所有位置，update时取前seq_len个
+        self._write_pos = torch.arange(start_pos, len(table) * self.block_size, device=device)
+
+    def prepare_decode(self, num_rows: int = None) -> torch.Tensor:
+        """
+        下一次前向计算针对前num_rows行（默认所有行），每行在各自的长度处写入一个token（需先reserve）
+
+        参数:
+            num_rows: 参与解码的行数；之后的行（如尚未分块预填充完的序列）不参与
+
+        返回:
+            形状为[num_rows]的张量，每行的写入位置（即该行当前长度）
+        """
+        self._prefill_row = None
+        device = self.k_cache.device
+        lengths, tables = self.lengths[:num_rows], self.block_tables[:num_rows]
+        self._read_len = max(lengths) + 1
+        n_blocks = self.blocks_needed(self._read_len)
+        # 块表补齐到相同长度，补齐部分指向任意块即可，读取时会被注意力掩码屏蔽
+        self._tables = torch.tensor([t[:n_blocks] + [0] * (n_blocks - len(t[:n_blocks])) for t in tables],
+                                    dtype=torch.long, device=device)
+        self._write_pos = torch.tensor(lengths, dtype=torch.long, device=device)
+        return self._write_pos
+
+    def _gather(self, pool: torch.Tensor, tables: torch.Tensor, kv_len: int):
+        """按块表把各行的块拼成 [batch_size, n_kv_heads, kv_len, head_dim]"""
+        bsz, n_blocks = tables.shape
+        x = pool[tables]  # [batch_size, n_blocks, n_kv_heads, block_size, head_dim]
+        x = x.permute(0, 2, 1, 3, 4).reshape(bsz, x.shape[2], n_blocks * self.block_size, x.shape[-1])
+        return x[:, :, :kv_len]
+
+    def update(self, layer_id: int, xk: torch.Tensor, xv: torch.Tensor):
+        if self._prefill_row is not None:
+            seq_len = xk.shape[1]
+            pos = self._write_pos[:seq_len]
+            blocks = self._tables[0, pos // self.block_size]
+            # 高级索引：逐token写入各自所在块的对应偏移，[seq_len, n_kv_heads, head_dim]
+            self._write((layer_id, blocks, slice(None), pos % self.block_size), xk[0], xv[0])
+            kv_len = self.lengths[self._prefill_row] + seq_len
+        else:
+            rows = torch.arange(xk.shape[0], device=xk.device)
+            blocks = self._tables[rows, self._write_pos // self.block_size]
+            self._write((layer_id, blocks, slice(None), self._write_pos % self.block_size), xk[:, 0], xv[:, 0])
+            kv_len = self._read_len
+        keys = self._gather(self.k_cache[layer_id], self._tables, kv_len)
+        values = self._gather(self.v_cache[layer_id], self._tables, kv_len)
+        if self.quant_format is None:
+            return keys, values
+        return (self._dequantize(keys, self._gather(self.k_scale[layer_id], self._tables, kv_len)),
+                self._dequantize(values, self._gather(self.v_scale[layer_id], self._tables, kv_len)))
+
+
+class _RadixNode:
+    """前缀树的节点：对应一个写满的缓存块，key为该块中的block_size个token"""
+    __slots__ = ('key', 'block', 'parent', 'children', 'last_access')
+
+    def __init__(self, key=(), block=-1, parent=None):
+        self.key = key
+        self.block = block
+        self.parent = parent
+        self.children = {}
+        self.last_access = 0
+
+
+class RadixCache:
+    """
+    基于token ID前缀树（Radix Tree）的前缀缓存
+
+    通过聊天模板进入服务的请求都以相同的system提示词开头，多轮对话客户端每轮还会重发整段历史，
+    如果每次都重新预填充，首token延迟会随历史长度增长。这里把已计算过的KV块按token前缀组织成一棵树：
+    - 以块为粒度，每条边对应一个写满的块（block_size个token），相同前缀的请求共享同一串块；
+    - 新请求先匹配最长的已缓存前缀，直接复用这些块，只需预填充剩余部分；
+    - 树对每个块持有一个引用，空闲块不足时按LRU从叶子开始淘汰只被树引用的块。
+    """
+    def __init__(self, cache: PagedKVCache):
+        """
+        参数:
+            cache: 与之配合的分页KV缓存，块的分配与引用计数都由它管理
+        """
+        self.cache = cache
+        self.block_size = cache.block_size
+        self.root = _RadixNode()
+        self._clock = 0
+
+    def _keys(self, token_ids):
+        """把token序列切成完整的块，返回每块的key"""
+        n = len(token_ids) // self.block_size
+        return [tuple(token_ids[i * self.block_size:(i + 1) * self.block_size]) for i in range(n)]
+
+    def match_prefix(self, token_ids):
+        """
+        查找token_ids的最长已缓存前缀
+
+        返回:
+            前缀对应的块编号列表，缓存的token数为 len(blocks) * block_size
+        """
+        self._clock += 1
+        node, blocks = self.root, []
+        for key in self._keys(token_ids):
+            node = node.children.get(key)
+            if node is None:
+                break
+            node.last_access = self._clock
+            blocks.append(node.block)
+        return blocks
+
+    def insert(self, token_ids, blocks):
+        """
+        把一个序列已缓存的完整块加入前缀树
+
+        参数:
+            token_ids: 序列中已写入KV缓存的token
+            blocks: 该序列的块表
+        """
+        self._clock += 1
+        node = self.root
+        for key, block in zip(self._keys(token_ids), blocks):
+            child = node.children.get(key)
+            if child is None:
+                child = _RadixNode(key, block, node)
+                node.children[key] = child
+                self.cache.incref(block)
+            child.last_access = self._clock
+            node = child
+
+    def evict(self, num_blocks: int) -> int:
+        """
+        按LRU淘汰只被前缀树引用的块，直到释放num_blocks个块或无块可淘汰
+
+        返回:
+            实际释放的块数
+        """
+        leaves = [(n.last_access, id(n), n) for n in self._nodes()
+                  if not n.children and self.cache.ref_counts[n.block] == 1]
+        heapq.heapify(leaves)
+        freed = 0
+        while leaves and freed < num_blocks:
+            _, _, node = heapq.heappop(leaves)
+            parent = node.parent
+            del parent.children[node.key]
+            self.cache.decref(node.block)
+            freed += 1
+            # 父节点成为叶子且同样只被树引用时，也加入候选
+            if parent is not self.root and not parent.children and self.cache.ref_counts[parent.block] == 1:
+                heapq.heappush(leaves, (parent.last_access, id(parent), parent))
+        return freed
+
+    def _nodes(self):
+        stack = list(self.root.children.values())
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            yield node
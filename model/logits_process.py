@@ -0,0 +1,163 @@
+import torch
+import torch.nn.functional as F
+
+
+class LogitsProcessor:
+    """
+    向量化、按行参数化的logits处理流水线
+
+    处理顺序：重复惩罚 -> 存在/频率惩罚 -> 温度缩放 -> top-k -> top-p -> min-p。
+    每个参数都以形状为[batch_size, 1]的张量保存在设备上，批次中的每一行可以使用不同的采样设置；
+    各行出现过的token用[batch_size, vocab_size]的计数张量在设备上维护，
+    因此解码的每一步都不需要把序列复制回主机。
+
+    某个阶段只有在至少一行使用了非默认值时才会执行（在添加行时由Python值判断，不需要同步设备）。
+    top-k与top-p共用一次torch.topk：只在所有行都设置了top_k时只取前max(top_k)个候选，
+    否则退化为对整个词表排序。
+    """
+    # 各参数的默认值（即不起作用的取值）
+    DEFAULTS = {
+        'repetition_penalty': 1.0,
+        'presence_penalty': 0.0,
+        'frequency_penalty': 0.0,
+        'temperature': 1.0,
+        'top_k': 0,
+        'top_p': 1.0,
+        'min_p': 0.0,
+    }
+
+    def __init__(self, vocab_size: int, batch_size: int = 0, device=None, token_ids=None, mask=None, **params):
+        """
+        参数:
+            vocab_size: 词表大小
+            batch_size: 初始的行数，可以为0，之后用add_rows逐个添加
+            device: 参数与计数张量所在的设备
+            token_ids: 可选，形状为[batch_size, seq_len]的已有token（如提示词），计入各行的token计数
+            mask: 可选，与token_ids形状相同，为0的位置（如填充）不计数
+            **params: DEFAULTS中的采样参数，取值可以是标量（所有行相同）或长度为batch_size的序列（逐行设置）
+        """
+        self.vocab_size = vocab_size
+        self.device = device
+        # 各参数每一行的Python值，用于判断哪些阶段需要执行
+        self.values = {name: [] for name in self.DEFAULTS}
+        self.params = {name: torch.empty((0, 1), device=device) for name in self.DEFAULTS}
+        self.token_counts = torch.zeros((0, vocab_size), dtype=torch.int32, device=device)
+        if batch_size:
+            self.add_rows(batch_size, token_ids, mask, **params)
+
+    def __len__(self):
+        return self.token_counts.size(0)
+
+    def add_rows(self, num_rows: int, token_ids=None, mask=None, **params):
+        """在批次末尾添加num_rows行，参数与__init__相同"""
+        unknown = set(params) - set(self.DEFAULTS)
+        assert not unknown, f"未知的采样参数: {unknown}"
+        for name, default in self.DEFAULTS.items():
+            value = params.get(name)
+            value = default if value is None else value
+            rows = list(value) if isinstance(value, (list, tuple)) else [value] * num_rows
+            assert len(rows) == num_rows, f"{name}的长度应为{num_rows}"
+            self.values[name] += rows
+            # top_k为0表示不限制，等价于保留整个词表
+            if name == 'top_k':
+                rows = [k if k > 0 else self.vocab_size for k in rows]
+            new = torch.tensor(rows, dtype=self.params[name].dtype, device=self.device).unsqueeze(-1)
+            self.params[name] = torch.cat([self.params[name], new])
+        counts = torch.zeros((num_rows, self.vocab_size), dtype=torch.int32, device=self.device)
+        if token_ids is not None:
+            token_ids = torch.as_tensor(token_ids, dtype=torch.long, device=self.device).reshape(num_rows, -1)
+            src = torch.ones_like(token_ids, dtype=torch.int32) if mask is None else mask.to(torch.int32)
+            counts.scatter_add_(1, token_ids, src)
+        self.token_counts = torch.cat([self.token_counts, counts])
+
+    def remove_row(self, row: int):
+        """移除第row行，后面的行号依次前移"""
+        keep = [i for i in range(len(self)) if i != row]
+        for name in self.DEFAULTS:
+            self.values[name].pop(row)
+            self.params[name] = self.params[name][keep]
+        self.token_counts = self.token_counts[keep]
+
+    def update(self, tokens, mask=None, row: int = None):
+        """
+        把各行新生成的token计入计数
+
+        参数:
+            tokens: 形状为[batch_size]或[batch_size, n]的token
+            mask: 可选，与tokens形状相同，为False的位置（如已结束的行）不计数
+            row: 可选，只更新第row行（此时tokens只包含这一行的token）
+        """
+        counts = self.token_counts if row is None else self.token_counts[row:row + 1]
+        tokens = torch.as_tensor(tokens, dtype=torch.long, device=counts.device).view(counts.size(0), -1)
+        src = torch.ones_like(tokens, dtype=torch.int32) if mask is None else mask.view_as(tokens).to(torch.int32)
+        counts.scatter_add_(1, tokens, src)
+
+    def _active(self, name):
+        return any(v != self.DEFAULTS[name] for v in self.values[name])
+
+    def __call__(self, logits, token_counts=None, row: int = None):
+        """
+        对logits依次应用各处理阶段
+
+        参数:
+            logits: 形状为[batch_size, vocab_size]的logits
+            token_counts: 可选，代替内部计数使用的token计数（如投机解码验证时各位置包含不同的草稿前缀）
+            row: 可选，只处理第row行（此时logits的形状为[n, vocab_size]，n行共用该行的参数）
+
+        返回:
+            处理后的float32 logits，被过滤的token为负无穷
+        """
+        rows = slice(None) if row is None else slice(row, row + 1)
+        p = {name: value[rows] for name, value in self.params.items()}
+        counts = self.token_counts[rows] if token_counts is None else token_counts
+        active = {name for name in self.DEFAULTS if self._active(name)} if row is None else \
+            {name for name, default in self.DEFAULTS.items() if self.values[name][row] != default}
+        logits = logits.float()
+
+        # 1. 重复惩罚（CTRL）：出现过的token，正logit除以惩罚因子，负logit乘以惩罚因子
+        if 'repetition_penalty' in active:
+            rp = p['repetition_penalty']
+            penalized = torch.where(logits > 0, logits / rp, logits * rp)
+            logits = torch.where(counts > 0, penalized, logits)
+        # 2. 存在惩罚与频率惩罚（OpenAI）：按是否出现过、出现了几次线性地降低logit
+        if 'presence_penalty' in active or 'frequency_penalty' in active:
+            logits = logits - p['presence_penalty'] * (counts > 0) - p['frequency_penalty'] * counts
+        # 3. 温度缩放
+        if 'temperature' in active:
+            logits = logits / (p['temperature'] + 1e-9)
+        # 4. top-k与top-p：在按logit降序排列的候选上计算，再映射回原始顺序
+        if 'top_k' in active or 'top_p' in active:
+            top_k = self.values['top_k'] if row is None else self.values['top_k'][row:row + 1]
+            num_candidates = self.vocab_size if min(top_k) <= 0 else min(max(top_k), self.vocab_size)
+            values, indices = logits.topk(num_candidates, dim=-1)
+            remove = torch.arange(num_candidates, device=logits.device) >= p['top_k']
+            if 'top_p' in active:
+                probs = F.softmax(values.masked_fill(remove, float('-inf')), dim=-1)
+                # 保留累积概率刚好达到top_p的那个token：移除排在它之前的累积概率已超过top_p的token
+                remove = remove | (probs.cumsum(dim=-1) - probs > p['top_p'])
+            # 至少保留概率最高的token
+            remove[:, 0] = False
+            values = values.masked_fill(remove, float('-inf'))
+            logits = torch.full_like(logits, float('-inf')).scatter(1, indices, values)
+        # 5. min-p：过滤概率低于 min_p * 最大概率 的token
+        if 'min_p' in active:
+            probs = F.softmax(logits, dim=-1)
+            logits = logits.masked_fill(probs < p['min_p'] * probs.amax(dim=-1, keepdim=True), float('-inf'))
+        return logits
+
+    def probs(self, logits, token_counts=None, row: int = None):
+        """返回实际用于采样的概率分布，参数与__call__相同"""
+        return F.softmax(self(logits, token_counts, row), dim=-1)
+
+    def sample(self, logits, row: int = None):
+        """
+        按处理后的分布为每行采样一个token
+
+        用指数分布做竞争采样：argmax(p / E)（E ~ Exp(1)）与按p做多项式采样同分布，
+        且全部在设备上完成，不会像torch.multinomial那样可能引入主机同步。
+
+        返回:
+            采样得到的token，形状为[batch_size]
+        """
+        probs = self.probs(logits, row=row)
+        return (probs / torch.empty_like(probs).exponential_(1)).argmax(dim=-1)
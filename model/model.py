@@ -4,11 +4,15 @@ import inspect
 import time
 
 from .LMConfig import LMConfig
+from .kv_cache import KVCache, SinkKVCache
+from .logits_process import LogitsProcessor
 from typing import Any, Optional, Tuple, List, Union
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 from transformers import PreTrainedModel
 from transformers.modeling_outputs import CausalLMOutputWithPast
 
@@ -50,67 +54,107 @@ class RMSNorm(torch.nn.Module):
         return self.weight * self._norm(x.float()).type_as(x)
 
 
-def precompute_pos_cis(dim: int, end: int = int(32 * 1024), theta: float = 1e6):
+def rope_inv_freq(dim: int, theta: float = 1e6, rope_scaling: dict = None, seq_len: int = None):
     """
-    预计算旋转位置编码（Rotary Position Embeddings, RoPE）所需的复数值
+    计算RoPE各频率分量的逆频率，以及按长度外推方法需要的注意力缩放系数
 
     参数:
-        dim: 隐藏维度大小
-        end: 最大序列长度，默认为32K
+        dim: 每个注意力头的维度
+        theta: RoPE的基数
+        rope_scaling: 长度外推配置（见LMConfig.rope_scaling），None表示不缩放
+        seq_len: 当前需要覆盖的序列长度，只有动态NTK使用
+
+    返回:
+        inv_freq: 形状为[dim//2]的逆频率
+        mscale: cos/sin表需要乘上的系数（YaRN的注意力温度，其它情况为1）
+    """
+    exponent = torch.arange(0, dim, 2)[: (dim // 2)].float() / dim
+    scaling = rope_scaling or {}
+    rope_type = scaling.get('type')
+    factor = scaling.get('factor', 1.0)
+    original_len = scaling.get('original_max_position_embeddings', 2048)
+    if rope_type is None:
+        return 1.0 / (theta ** exponent), 1.0
+    if rope_type == 'dynamic':
+        # 动态NTK：序列超出原始训练长度后按实际长度增大基数，低频分量被插值、高频分量基本不变
+        if seq_len is not None and seq_len > original_len:
+            theta = theta * ((factor * seq_len / original_len) - (factor - 1)) ** (dim / (dim - 2))
+        return 1.0 / (theta ** exponent), 1.0
+    if rope_type == 'yarn':
+        # YaRN：波长远小于原始长度的高频分量保持外推，波长超过原始长度的低频分量按factor插值，中间线性过渡
+        beta_fast, beta_slow = scaling.get('beta_fast', 32), scaling.get('beta_slow', 1)
+        inv_freq_extrapolation = 1.0 / (theta ** exponent)
+        inv_freq_interpolation = inv_freq_extrapolation / factor
+
+        def correction_dim(num_rotations):
+            # 在原始长度内恰好旋转num_rotations圈的频率分量下标
+            return dim * math.log(original_len / (num_rotations * 2 * math.pi)) / (2 * math.log(theta))
+
+        low = max(math.floor(correction_dim(beta_fast)), 0)
+        high = min(math.ceil(correction_dim(beta_slow)), dim // 2 - 1)
+        ramp = ((torch.arange(dim // 2).float() - low) / max(high - low, 1e-3)).clamp(0, 1)
+        inv_freq = inv_freq_interpolation * ramp + inv_freq_extrapolation * (1 - ramp)
+        mscale = scaling.get('attention_factor', 0.1 * math.log(factor) + 1.0 if factor > 1 else 1.0)
+        return inv_freq, mscale
+    raise ValueError(f'不支持的RoPE缩放类型: {rope_type}')
+
+
+def precompute_pos_cis(dim: int, end: int = 8192, theta: float = 1e6, rope_scaling: dict = None,
+                       seq_len: int = None):
+    """
+    预计算旋转位置编码（Rotary Position Embeddings, RoPE）所需的cos/sin表
+
+    位置p、第i个频率分量的旋转角为 p * inv_freq[i]，等价于乘以复数 cos + i*sin（cis）。
+    这里直接保存实数形式的cos和sin，前向时不需要把Q/K转换为复数，表也会随模型一起转换为模型的数据类型。
+    为了让apply_rotary_emb只做逐元素运算，表已按Q/K最后一维中(x1, x2)交错的布局展开：
+    cos部分为(cos, cos)，sin部分带符号为(-sin, sin)。
+
+    参数:
+        dim: 每个注意力头的维度
+        end: 表覆盖的位置数
         theta: RoPE中的缩放因子，影响位置编码的频率
+        rope_scaling: 长度外推配置（见LMConfig.rope_scaling）
+        seq_len: 动态NTK按此长度计算基数，默认为end
 
     返回:
-        pos_cis: 预计算好的复数形式的位置编码，形状为[end, dim//2]
+        pos_cis: 形状为[end, 2*dim]的表，前dim列为cos、后dim列为带符号的sin
     """
-    # 计算不同频率的逆频率项
-    freqs = 1.0 / (theta ** (torch.arange(0, dim, 2)[: (dim // 2)].float() / dim))
-    # 生成位置索引
-    t = torch.arange(end, device=freqs.device)  # type: ignore
-    # 计算外积得到每个位置对应的每个频率
-    freqs = torch.outer(t, freqs).float()  # type: ignore
-    # 使用欧拉公式 e^(i*θ) = cos(θ) + i*sin(θ) 生成复数
-    # 幅值为1，相位为freqs的复数值
-    pos_cis = torch.polar(torch.ones_like(freqs), freqs)  # complex64
-    return pos_cis
+    inv_freq, mscale = rope_inv_freq(dim, theta, rope_scaling, seq_len or end)
+    # 计算外积得到每个位置对应的每个频率的旋转角
+    freqs = torch.outer(torch.arange(end).float(), inv_freq)
+    cos = freqs.cos().repeat_interleave(2, dim=-1)
+    sin = torch.stack([-freqs.sin(), freqs.sin()], dim=-1).flatten(-2)
+    return torch.cat([cos, sin], dim=-1) * mscale
 
 
 def apply_rotary_emb(xq, xk, pos_cis):
     """
     将旋转位置编码应用到查询(Q)和键(K)张量上
 
+    最后一维中相邻的两个元素(x1, x2)为一组，按该组的角度旋转：
+    (x1*cos - x2*sin, x1*sin + x2*cos)，与复数乘法 (x1 + i*x2) * cis 的结果相同。
+    借助展开后的表写成 x * (cos, cos) + (x2, x1) * (-sin, sin)，全部在Q/K的数据类型下完成。
+
     参数:
         xq: 查询张量, 形状为[batch_size, seq_len, n_heads, head_dim]
         xk: 键张量, 形状为[batch_size, seq_len, n_kv_heads, head_dim]
-        pos_cis: 预计算的位置编码复数
+        pos_cis: 预计算的cos/sin表，形状为[seq_len, 2*head_dim]；
+                 批内各行位置不同时（如左填充的批量生成）形状为[batch_size, seq_len, 2*head_dim]
 
     返回:
         应用位置编码后的查询和键张量
     """
-    def unite_shape(pos_cis, x):
-        """
-        调整pos_cis的形状使其与输入张量x兼容，便于广播计算
-        """
-        ndim = x.ndim
-        assert 0 <= 1 < ndim
-        assert pos_cis.shape == (x.shape[1], x.shape[-1])
-        # 创建一个新形状，只保留序列长度和特征维度，其余维度设为1
-        shape = [d if i == 1 or i == ndim - 1 else 1 for i, d in enumerate(x.shape)]
-        return pos_cis.view(*shape)
-
-    # 将Q和K重塑并转换为复数形式
-    # 将最后一个维度每两个相邻元素视为一个复数的实部和虚部
-    xq_ = torch.view_as_complex(xq.float().reshape(*xq.shape[:-1], -1, 2))
-    xk_ = torch.view_as_complex(xk.float().reshape(*xk.shape[:-1], -1, 2))
+    # 在Q/K的数据类型下计算，[seq_len, head_dim]插入头维度（以及批次维度）以便广播
+    cos, sin = pos_cis.to(xq.dtype).unsqueeze(-2).chunk(2, dim=-1)
+    if pos_cis.ndim == 2:
+        cos, sin = cos.unsqueeze(0), sin.unsqueeze(0)
 
-    # 调整pos_cis的形状以便与输入张量兼容
-    pos_cis = unite_shape(pos_cis, xq_)
+    def rotate(x):
+        pairs = x.unflatten(-1, (-1, 2))
+        swapped = torch.cat((pairs[..., 1:], pairs[..., :1]), dim=-1).flatten(-2)
+        return torch.addcmul(x * cos, swapped, sin)
 
-    # 应用旋转操作：在复数域中，乘以pos_cis等同于旋转
-    xq_out = torch.view_as_real(xq_ * pos_cis).flatten(3)
-    xk_out = torch.view_as_real(xk_ * pos_cis).flatten(3)
-
-    # 转换回输入张量的原始数据类型
-    return xq_out.type_as(xq), xk_out.type_as(xk)
+    return rotate(xq), rotate(xk)
 
 
 def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
@@ -139,13 +183,65 @@ def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
     )
 
 
+def _sdpa_supports_gqa() -> bool:
+    """用一次很小的调用探测scaled_dot_product_attention是否支持enable_gqa（PyTorch>=2.5）"""
+    if not hasattr(F, 'scaled_dot_product_attention'):
+        return False
+    try:
+        F.scaled_dot_product_attention(torch.zeros(1, 2, 1, 8), torch.zeros(1, 1, 1, 8), torch.zeros(1, 1, 1, 8),
+                                       enable_gqa=True)
+    except TypeError:
+        return False
+    return True
+
+
+# 支持enable_gqa时K/V头数少于Q头数也不需要复制
+SDPA_GQA = _sdpa_supports_gqa()
+
+
+def causal_mask(seq_len: int, kv_len: int, device=None, dtype=torch.float32) -> torch.Tensor:
+    """
+    按需构造加性因果掩码，代替按max_seq_len预先分配的[max_seq_len, max_seq_len]掩码
+
+    查询位于整段序列的最后seq_len个位置（即相对键偏移了kv_len - seq_len），
+    第i个查询只能看见位置不超过kv_len - seq_len + i的键，适用于有KV缓存或分块预填充的情况。
+
+    返回:
+        形状为[1, 1, seq_len, kv_len]的掩码，允许的位置为0，屏蔽的位置为-inf
+    """
+    mask = torch.full((seq_len, kv_len), float("-inf"), device=device, dtype=dtype)
+    return mask.triu_(kv_len - seq_len + 1)[None, None]
+
+
+def convert_proj_layout(state_dict, prefix, fused_name, names, sizes, fused):
+    """
+    在合并与分开的投影布局之间转换state_dict中的权重（原地修改），两种布局保存的权重可以互相加载
+
+    参数:
+        state_dict: 待加载的state_dict
+        prefix: 所属模块在state_dict中的前缀
+        fused_name: 合并后的线性层名，如'wqkv'
+        names: 按输出维度拼接顺序排列的分开的线性层名，如('wq', 'wk', 'wv')
+        sizes: 各分开的线性层的输出维度
+        fused: 目标布局是否为合并的投影
+    """
+    parts = [f'{prefix}{name}.weight' for name in names]
+    whole = f'{prefix}{fused_name}.weight'
+    # 只转换浮点权重，量化后的权重需要按模型的布局重新量化
+    if fused and all(p in state_dict and state_dict[p].is_floating_point() for p in parts):
+        state_dict[whole] = torch.cat([state_dict.pop(p) for p in parts])
+    elif not fused and whole in state_dict and state_dict[whole].is_floating_point():
+        for p, weight in zip(parts, state_dict.pop(whole).split(sizes)):
+            state_dict[p] = weight
+
+
 class Attention(nn.Module):
     """
     多头注意力机制（Multi-Head Attention）实现
 
     注意力机制是Transformer架构的核心组件，允许模型关注输入序列中的不同部分。
     本实现支持：
-    1. 分组查询注意力（Grouped-Query Attention, GQA）：允许Q头数量多于KV头数量
+    1. 分组查询注意力（Grouped-Query Attention, GQA）：允许Q头数量多于KV头数量，Q按组重排后直接与KV头计算，不复制KV缓存
     2. 旋转位置编码（Rotary Position Embedding, RoPE）：通过复数旋转编码位置信息
     3. 注意力掩码：确保模型只能看到当前及之前的token（因果关系）
     4. KV缓存：用于加速自回归生成过程
@@ -160,14 +256,16 @@ class Attention(nn.Module):
     6. 将注意力权重与V相乘得到输出
     7. 通过输出投影层转换回原始维度
     """
-    def __init__(self, args: LMConfig):
+    def __init__(self, args: LMConfig, layer_id: int = 0):
         """
         初始化注意力层
 
         参数:
             args: 模型配置参数
+            layer_id: 所在层的索引，用于定位预分配KV缓存中对应的层
         """
         super().__init__()
+        self.layer_id = layer_id
         # 确定KV头的数量，如果未指定则与Q头数量相同
         self.n_kv_heads = args.n_heads if args.n_kv_heads is None else args.n_kv_heads
         # 确保Q头数量是KV头数量的整数倍，这是GQA的要求
@@ -180,10 +278,19 @@ class Attention(nn.Module):
         self.n_rep = self.n_local_heads // self.n_local_kv_heads
         # 每个注意力头的维度
         self.head_dim = args.dim // args.n_heads
-        # Q、K、V的线性投影层
-        self.wq = nn.Linear(args.dim, args.n_heads * self.head_dim, bias=False)
-        self.wk = nn.Linear(args.dim, self.n_kv_heads * self.head_dim, bias=False)
-        self.wv = nn.Linear(args.dim, self.n_kv_heads * self.head_dim, bias=False)
+        # Q、K、V的线性投影层；fused_proj时合并为一个wqkv，一次矩阵乘同时得到Q、K、V
+        self.fused_proj = args.fused_proj
+        self.qkv_sizes = [args.n_heads * self.head_dim] + [self.n_kv_heads * self.head_dim] * 2
+        if self.fused_proj:
+            self.wqkv = nn.Linear(args.dim, sum(self.qkv_sizes), bias=False)
+        else:
+            self.wq = nn.Linear(args.dim, args.n_heads * self.head_dim, bias=False)
+            self.wk = nn.Linear(args.dim, self.n_kv_heads * self.head_dim, bias=False)
+            self.wv = nn.Linear(args.dim, self.n_kv_heads * self.head_dim, bias=False)
+        # 加载另一种布局保存的权重时自动合并/拆分
+        self._register_load_state_dict_pre_hook(
+            lambda state_dict, prefix, *args: convert_proj_layout(
+                state_dict, prefix, 'wqkv', ('wq', 'wk', 'wv'), self.qkv_sizes, self.fused_proj))
         # 输出投影层，将多头注意力的结果映射回模型维度
         self.wo = nn.Linear(args.n_heads * self.head_dim, args.dim, bias=False)
         # 注意力权重的dropout
@@ -194,25 +301,25 @@ class Attention(nn.Module):
         # 检测是否可以使用Flash Attention（需要PyTorch >= 2.0）
         self.flash = hasattr(torch.nn.functional, 'scaled_dot_product_attention') and args.flash_attn
         # print("WARNING: using slow attention. Flash Attention requires PyTorch >= 2.0")
-        # 创建因果掩码（上三角矩阵，对角线以上为-inf）
-        # 这确保了每个位置只能关注自身及之前的位置，实现自回归属性
-        mask = torch.full((1, 1, args.max_seq_len, args.max_seq_len), float("-inf"))
-        mask = torch.triu(mask, diagonal=1)
-        self.register_buffer("mask", mask, persistent=False)
+        # 因果掩码不再按max_seq_len预先分配（8192时每层256MB），而是按当前的查询/键长度用causal_mask按需构造
 
     def forward(self,
                 x: torch.Tensor,
                 pos_cis: torch.Tensor,
-                past_key_value: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
-                use_cache=False):
+                past_key_value: Optional[Union[Tuple[torch.Tensor, torch.Tensor], KVCache]] = None,
+                use_cache=False,
+                attn_mask: Optional[torch.Tensor] = None):
         """
         注意力层的前向传播
 
         参数:
             x: 输入张量，形状为 [batch_size, seq_len, hidden_dim]
             pos_cis: 预计算的旋转位置编码
-            past_key_value: 可选的KV缓存，用于加速自回归生成
+            past_key_value: 可选的KV缓存，用于加速自回归生成；
+                            可以是(历史K, 历史V)元组（兼容旧接口），也可以是预分配的KVCache
             use_cache: 是否使用并返回KV缓存
+            attn_mask: 可选的加性注意力掩码，形状为 [batch_size 或 1, 1, seq_len, kv_len]，
+                       已合并因果掩码（及填充掩码）；为None时按需构造因果掩码
 
         返回:
             output: 注意力层的输出，形状为 [batch_size, seq_len, hidden_dim]
@@ -222,7 +329,10 @@ class Attention(nn.Module):
         bsz, seq_len, _ = x.shape
 
         # 1. 线性投影：将输入投影到查询(Q)、键(K)和值(V)空间
-        xq, xk, xv = self.wq(x), self.wk(x), self.wv(x)
+        if self.fused_proj:
+            xq, xk, xv = self.wqkv(x).split(self.qkv_sizes, dim=-1)
+        else:
+            xq, xk, xv = self.wq(x), self.wk(x), self.wv(x)
 
         # 2. 重塑张量以便多头处理
         # 从 [batch_size, seq_len, heads*head_dim] 变为 [batch_size, seq_len, heads, head_dim]
@@ -233,43 +343,52 @@ class Attention(nn.Module):
         # 3. 应用旋转位置编码(RoPE)到查询和键
         xq, xk = apply_rotary_emb(xq, xk, pos_cis)
 
-        # 4. KV缓存处理：如果有历史KV，则与当前KV拼接
-        # 这在生成时很有用，避免重复计算已处理token的KV值
-        if past_key_value is not None:
-            xk = torch.cat([past_key_value[0], xk], dim=1)  # 拼接历史K和当前K
-            xv = torch.cat([past_key_value[1], xv], dim=1)  # 拼接历史V和当前V
-        # 如果需要缓存，则保存当前KV用于下一步
-        past_kv = (xk, xv) if use_cache else None
-
-        # 5. 张量变换准备计算注意力
-        # - 转置维度，使头维度在前，便于批量计算
-        # - 对KV进行重复，实现分组查询注意力(GQA)
-        xq, xk, xv = (
-            xq.transpose(1, 2),  # [batch_size, n_heads, seq_len, head_dim]
-            repeat_kv(xk, self.n_rep).transpose(1, 2),  # 重复KV头以匹配Q头数量
-            repeat_kv(xv, self.n_rep).transpose(1, 2)
-        )
+        # 4. KV缓存处理
+        if isinstance(past_key_value, KVCache):
+            # 预分配的静态缓存：在start_pos处原地写入，避免每步拼接复制整段历史
+            # 返回的是head-major布局 [batch_size, n_kv_heads, kv_len, head_dim]
+            xk, xv = past_key_value.update(self.layer_id, xk, xv)
+            past_kv = past_key_value
+            xk, xv = xk.transpose(1, 2), xv.transpose(1, 2)
+        else:
+            # 兼容旧接口：如果有历史KV，则与当前KV拼接
+            if past_key_value is not None:
+                xk = torch.cat([past_key_value[0], xk], dim=1)  # 拼接历史K和当前K
+                xv = torch.cat([past_key_value[1], xv], dim=1)  # 拼接历史V和当前V
+            # 如果需要缓存，则保存当前KV用于下一步
+            past_kv = (xk, xv) if use_cache else None
+        # 当前查询在整段序列中的起始位置（有缓存时大于0）
+        kv_len = xk.shape[1]
+        offset = kv_len - seq_len
+
+        # 5. 张量变换准备计算注意力：头维度在前，K/V保持n_kv_heads个头（KVCache返回的本就是head-major布局，不复制）
+        xq, xk, xv = xq.transpose(1, 2), xk.transpose(1, 2), xv.transpose(1, 2)
 
         # 6. 注意力计算
-        if self.flash and seq_len != 1:  # 使用Flash Attention（如果可用且序列长度>1）
-            dropout_p = self.dropout if self.training else 0.0
-            output = F.scaled_dot_product_attention(
-                xq, xk, xv,
-                attn_mask=None,  # Flash Attention内部处理因果掩码
-                dropout_p=dropout_p,
-                is_causal=True  # 指示使用因果掩码
-            )
-        else:  # 使用传统注意力计算
-            # 计算注意力分数：Q和K的矩阵乘法，然后除以缩放因子
-            scores = (xq @ xk.transpose(-2, -1)) / math.sqrt(self.head_dim)
-            # 应用因果掩码，确保只关注当前及之前的token
-            scores += self.mask[:, :, :seq_len, :seq_len]
-            # 对分数进行softmax归一化，得到注意力权重
-            scores = F.softmax(scores.float(), dim=-1).type_as(xq)
-            # 应用dropout
-            scores = self.attn_dropout(scores)
-            # 将注意力权重与V相乘得到加权值
-            output = scores @ xv
+        if attn_mask is None and seq_len != 1 and (offset != 0 or not self.flash):
+            # 有缓存时查询相对键偏移了offset，需要使用对应偏移的因果掩码；
+            # 单个查询位于序列末尾，可以看见所有键，不需要掩码
+            attn_mask = causal_mask(seq_len, kv_len, xq.device, xq.dtype)
+        dropout_p = self.dropout if self.training else 0.0
+        if self.n_rep > 1 and self.flash and SDPA_GQA:
+            # PyTorch>=2.5的SDPA直接支持分组查询注意力
+            output = F.scaled_dot_product_attention(xq, xk, xv, attn_mask=attn_mask, dropout_p=dropout_p,
+                                                    is_causal=attn_mask is None and seq_len != 1, enable_gqa=True)
+        elif self.n_rep == 1 or (attn_mask is None and seq_len != 1):
+            # 无缓存的因果预填充/训练（Flash Attention内部处理因果掩码）：分组后因果关系不再是对角线，
+            # 这里仍复制K/V头，复制量只与本次输入的长度有关，不涉及缓存的历史
+            if self.n_rep > 1:
+                xk = repeat_kv(xk.transpose(1, 2), self.n_rep).transpose(1, 2)
+                xv = repeat_kv(xv.transpose(1, 2), self.n_rep).transpose(1, 2)
+            output = self._attention(xq, xk, xv, attn_mask, dropout_p, is_causal=attn_mask is None and seq_len != 1)
+        else:
+            # 分组查询：共享同一KV头的n_rep个Q头排成该头的n_rep * seq_len个查询，直接与n_kv_heads个头的K/V计算，
+            # 解码时不再把整段KV缓存复制n_rep份；掩码沿查询维度重复n_rep次
+            xq = xq.reshape(bsz, self.n_local_kv_heads, self.n_rep * seq_len, self.head_dim)
+            if attn_mask is not None and self.n_rep > 1:
+                attn_mask = attn_mask.repeat(1, 1, self.n_rep, 1)
+            output = self._attention(xq, xk, xv, attn_mask, dropout_p)
+            output = output.reshape(bsz, self.n_local_heads, seq_len, self.head_dim)
 
         # 7. 重塑输出并通过输出投影层
         # 转置回原始维度顺序并合并多头结果
@@ -279,6 +398,27 @@ class Attention(nn.Module):
 
         return output, past_kv
 
+    def _attention(self, xq, xk, xv, attn_mask, dropout_p, is_causal=False):
+        """
+        缩放点积注意力，xq为[batch, heads, q_len, head_dim]，xk/xv为[batch, heads, kv_len, head_dim]
+
+        可用时使用融合的SDPA（包括单token解码：查询在最后，不需要因果掩码），否则逐步计算softmax(QKᵀ/√d)V；
+        is_causal只在使用SDPA时由其内部处理，其余情况由调用者构造attn_mask
+        """
+        if self.flash:
+            return F.scaled_dot_product_attention(xq, xk, xv, attn_mask=attn_mask, dropout_p=dropout_p,
+                                                  is_causal=is_causal)
+        # 计算注意力分数：Q和K的矩阵乘法，然后除以缩放因子
+        scores = (xq @ xk.transpose(-2, -1)) / math.sqrt(self.head_dim)
+        # 应用因果掩码，确保只关注当前及之前的token
+        if attn_mask is not None:
+            scores += attn_mask
+        # 对分数进行softmax归一化，得到注意力权重
+        scores = F.softmax(scores.float(), dim=-1).type_as(xq)
+        # 应用dropout
+        scores = self.attn_dropout(scores)
+        # 将注意力权重与V相乘得到加权值
+        return scores @ xv
 
 class FeedForward(nn.Module):
     """
@@ -314,12 +454,22 @@ class FeedForward(nn.Module):
             # 将隐藏维度调整为multiple_of的倍数，有助于硬件加速
             config.hidden_dim = config.multiple_of * ((hidden_dim + config.multiple_of - 1) // config.multiple_of)
 
-        # 第一个投影层：将输入从模型维度映射到隐藏维度
-        self.w1 = nn.Linear(config.dim, config.hidden_dim, bias=False)
+        self.fused_proj = config.fused_proj
+        if self.fused_proj:
+            # 合并的第一、第三个投影层：输出的前一半为W₁·x，后一半为W₃·x
+            self.w13 = nn.Linear(config.dim, 2 * config.hidden_dim, bias=False)
+        else:
+            # 第一个投影层：将输入从模型维度映射到隐藏维度
+            self.w1 = nn.Linear(config.dim, config.hidden_dim, bias=False)
         # 第二个投影层：将激活后的结果映射回模型维度
         self.w2 = nn.Linear(config.hidden_dim, config.dim, bias=False)
-        # 第三个投影层：用于门控机制，与w1共同作用
-        self.w3 = nn.Linear(config.dim, config.hidden_dim, bias=False)
+        if not self.fused_proj:
+            # 第三个投影层：用于门控机制，与w1共同作用
+            self.w3 = nn.Linear(config.dim, config.hidden_dim, bias=False)
+        # 加载另一种布局保存的权重时自动合并/拆分
+        self._register_load_state_dict_pre_hook(
+            lambda state_dict, prefix, *args: convert_proj_layout(
+                state_dict, prefix, 'w13', ('w1', 'w3'), [config.hidden_dim] * 2, self.fused_proj))
         # dropout层，用于正则化
         self.dropout = nn.Dropout(config.dropout)
 
@@ -341,6 +491,9 @@ class FeedForward(nn.Module):
         # 3. 将两者相乘
         # 4. 通过W₂投影回原始维度
         # 5. 应用dropout
+        if self.fused_proj:
+            h1, h3 = self.w13(x).chunk(2, dim=-1)
+            return self.dropout(self.w2(F.silu(h1) * h3))
         return self.dropout(self.w2(F.silu(self.w1(x)) * self.w3(x)))
 
 
@@ -359,6 +512,8 @@ class MoEGate(nn.Module):
         self.gating_dim = config.dim
         self.weight = nn.Parameter(torch.empty((self.n_routed_experts, self.gating_dim)))
         self.reset_parameters()
+        # 可选的路由统计（model.moe_stats.MoELayerStats），由MoERoutingStats挂上
+        self.stats = None
 
     def reset_parameters(self) -> None:
         import torch.nn.init as init
@@ -374,6 +529,8 @@ class MoEGate(nn.Module):
             raise NotImplementedError(f'insupportable scoring function for MoE gating: {self.scoring_func}')
 
         topk_weight, topk_idx = torch.topk(scores, k=self.top_k, dim=-1, sorted=False)
+        if self.stats is not None and not _RECOMPUTING:
+            self.stats.update(scores, topk_idx)
 
         if self.top_k > 1 and self.norm_topk_prob:
             denominator = topk_weight.sum(dim=-1, keepdim=True) + 1e-20
@@ -401,17 +558,82 @@ class MoEGate(nn.Module):
         return topk_idx, topk_weight, aux_loss
 
 
+_EXPERT_PARALLEL_GROUP = None
+
+
+def expert_parallel_group():
+    """
+    专家并行使用的进程组：包含默认进程组中的所有rank，与DDP的梯度同步分开通信
+
+    所有MoE层共享同一个进程组；创建进程组是集合操作，各rank按相同的顺序构建模型即可。
+    """
+    global _EXPERT_PARALLEL_GROUP
+    if _EXPERT_PARALLEL_GROUP is None:
+        _EXPERT_PARALLEL_GROUP = dist.new_group(list(range(dist.get_world_size())))
+    return _EXPERT_PARALLEL_GROUP
+
+
+def clip_grad_norm_(model, max_norm: float):
+    """
+    与torch.nn.utils.clip_grad_norm_相同，但专家并行时按所有rank上的全部参数计算梯度的总范数，
+    各rank的裁剪系数一致，复制的参数不会因为各自的专家梯度不同而在rank之间产生差异
+
+    参数:
+        model: MiniMindLM，或包装它的DistributedDataParallel
+        max_norm: 梯度总范数的上限
+
+    返回:
+        裁剪前的梯度总范数
+    """
+    model = getattr(model, 'module', model)
+    sharded = set(model.expert_parallel_parameters()) if isinstance(model, MiniMindLM) else set()
+    if not sharded:
+        return torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
+    grads = {name: p.grad for name, p in model.named_parameters() if p.grad is not None}
+    norm = lambda names: torch.stack([grads[n].float().norm() ** 2 for n in names]).sum() if names else 0.0
+    sharded_sq = torch.as_tensor(norm([n for n in grads if n in sharded]), device=model.output.weight.device)
+    dist.all_reduce(sharded_sq, group=expert_parallel_group())
+    total_norm = (norm([n for n in grads if n not in sharded]) + sharded_sq).sqrt()
+    clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+    for grad in grads.values():
+        grad.mul_(clip_coef.to(grad.dtype))
+    return total_norm
+
+
 class MOEFeedForward(nn.Module):
+    # 推理时的分发方式：None按输入规模和设备自动选择，也可以固定为'sorted'/'gather'/'grouped'（用于对比测试）
+    INFER_DISPATCH = None
+    # 不超过该token数的输入（批大小为1的解码）直接取出各token的top-k专家权重计算
+    GATHER_MAX_TOKENS = 1
+    # 不超过该token数的输入（批量解码）由所有专家对全部token做一次批量矩阵乘，未选中的专家权重为0
+    GROUPED_MAX_TOKENS = 64
+
     def __init__(self, config: LMConfig):
         super().__init__()
         self.config = config
+        # 专家并行：路由专家平均分配到所有rank，本rank只保存第expert_offset个起的连续len(self.experts)个专家
+        self.ep_group, self.ep_size, self.ep_rank = None, 1, 0
+        if config.expert_parallel and dist.is_available() and dist.is_initialized():
+            self.ep_group = expert_parallel_group()
+            self.ep_size, self.ep_rank = dist.get_world_size(self.ep_group), dist.get_rank(self.ep_group)
+            assert config.n_routed_experts % self.ep_size == 0, \
+                f'n_routed_experts({config.n_routed_experts})必须能被专家并行的进程数({self.ep_size})整除'
+        n_local_experts = config.n_routed_experts // self.ep_size
+        self.expert_offset = self.ep_rank * n_local_experts
         self.experts = nn.ModuleList([
             FeedForward(config)
-            for _ in range(config.n_routed_experts)
+            for _ in range(n_local_experts)
         ])
         self.gate = MoEGate(config)
         if config.n_shared_experts is not None:
             self.shared_experts = FeedForward(config)
+        if self.ep_size > 1:
+            # state_dict中的专家使用全局编号，与不分片的模型互相兼容
+            self._register_state_dict_hook(self._expert_state_dict_hook)
+            self._register_load_state_dict_pre_hook(self._expert_load_state_dict_pre_hook)
+            # 专家参数的梯度由所有rank的token累加而成，而DDP对复制的参数取平均，这里同样除以进程数
+            for p in self.experts.parameters():
+                p.register_hook(lambda grad: grad / self.ep_size)
 
     def forward(self, x):
         identity = x
@@ -421,42 +643,211 @@ class MOEFeedForward(nn.Module):
         topk_idx, topk_weight, aux_loss = self.gate(x)
         x = x.view(-1, x.shape[-1])
         flat_topk_idx = topk_idx.view(-1)
-        if self.training:
-            x = x.repeat_interleave(self.config.num_experts_per_tok, dim=0)
-            y = torch.empty_like(x, dtype=torch.float16)
-            for i, expert in enumerate(self.experts):
-                y[flat_topk_idx == i] = expert(x[flat_topk_idx == i]).to(y.dtype)  # 确保类型一致
-            y = (y.view(*topk_weight.shape, -1) * topk_weight.unsqueeze(-1)).sum(dim=1)
+        if self.ep_size > 1:
+            # 专家并行时训练与推理都需要所有rank一起交换token
+            capacity_factor = self.config.moe_capacity_factor if self.training else None
+            y = self.dispatch_parallel(x, flat_topk_idx, topk_weight.view(-1), capacity_factor).view(*orig_shape)
+        elif self.training:
+            y = self.dispatch(x, flat_topk_idx, topk_weight.view(-1), self.config.moe_capacity_factor)
             y = y.view(*orig_shape)
         else:
-            y = self.moe_infer(x, flat_topk_idx, topk_weight.view(-1, 1)).view(*orig_shape)
+            y = self.moe_infer(x, topk_idx, topk_weight).view(*orig_shape)
         if self.config.n_shared_experts is not None:
             y = y + self.shared_experts(identity)
         self.aux_loss = aux_loss
         return y
 
+    def dispatch(self, x, flat_expert_indices, flat_expert_weights, capacity_factor=None):
+        """
+        基于排序的专家分发：所有(token, 专家)对按专家编号排序一次，每个专家处理连续的一段token，
+        输出乘以路由权重后按token编号累加回去（index_add_即为反排列）
+
+        参数:
+            x: 形状为[num_tokens, dim]的输入
+            flat_expert_indices: 形状为[num_tokens * top_k]的专家编号，第i个元素属于第i // top_k个token
+            flat_expert_weights: 形状为[num_tokens * top_k]的路由权重
+            capacity_factor: 可选的容量系数，每个专家最多处理 ceil(capacity_factor * num_tokens * top_k / n_experts)
+                             个token，超出部分按token顺序丢弃（该专家对这些token的输出为0，只保留残差）
+
+        返回:
+            形状为[num_tokens, dim]的加权专家输出
+        """
+        order, tokens_per_expert = self._sort_by_expert(flat_expert_indices, capacity_factor)
+        token_idx = order // self.config.num_experts_per_tok
+        # 每层只在这里同步一次主机，取得各专家的token数
+        expert_inputs = x[token_idx].split(tokens_per_expert.tolist())
+        expert_out = torch.cat([expert(tokens) for expert, tokens in zip(self.experts, expert_inputs)])
+        expert_out = expert_out * flat_expert_weights[order].unsqueeze(-1).to(expert_out.dtype)
+        return torch.zeros_like(x).index_add_(0, token_idx, expert_out.to(x.dtype))
+
+    def _sort_by_expert(self, flat_expert_indices, capacity_factor=None):
+        """
+        把(token, 专家)对按专家编号稳定排序，可选地按容量丢弃超出的部分
+
+        返回:
+            order: 保留的(token, 专家)对在flat_expert_indices中的下标，按专家编号排列
+            tokens_per_expert: 形状为[n_routed_experts]的各专家（丢弃后）的token数
+        """
+        n_experts = self.config.n_routed_experts
+        order = flat_expert_indices.argsort(stable=True)
+        tokens_per_expert = flat_expert_indices.bincount(minlength=n_experts)
+        if capacity_factor is not None:
+            capacity = math.ceil(capacity_factor * flat_expert_indices.numel() / n_experts)
+            # 每个(token, 专家)对在所属专家中的名次，超出容量的丢弃
+            starts = tokens_per_expert.cumsum(0) - tokens_per_expert
+            rank = torch.arange(order.numel(), device=order.device) - starts[flat_expert_indices[order]]
+            order = order[rank < capacity]
+            if self.gate.stats is not None and not _RECOMPUTING:
+                self.gate.stats.add_dropped(tokens_per_expert, tokens_per_expert.clamp(max=capacity))
+            tokens_per_expert = tokens_per_expert.clamp(max=capacity)
+        return order, tokens_per_expert
+
+    def dispatch_parallel(self, x, flat_expert_indices, flat_expert_weights, capacity_factor=None):
+        """
+        专家并行的分发：按专家排序后，发往同一rank的token是连续的一段，用all-to-all发送给专家所在的rank，
+        各rank计算本地专家的输出后再用all-to-all发回，参数与返回值同dispatch（容量按本rank的token数计算）
+
+        两次all-to-all都可以求导（反向传播为反方向的all-to-all），每层同步一次主机以取得各rank之间的token数。
+        """
+        from torch.distributed.nn.functional import all_to_all_single
+
+        n_local = len(self.experts)
+        order, tokens_per_expert = self._sort_by_expert(flat_expert_indices, capacity_factor)
+        token_idx = order // self.config.num_experts_per_tok
+        # send_counts[r, e]: 本rank发给rank r上第e个本地专家的token数；交换后recv_counts[r, e]为从rank r收到的
+        send_counts = tokens_per_expert.view(self.ep_size, n_local)
+        recv_counts = torch.empty_like(send_counts)
+        dist.all_to_all_single(recv_counts, send_counts, group=self.ep_group)
+        counts = torch.cat([send_counts.sum(1), recv_counts.sum(1), recv_counts.sum(0)]).tolist()
+        send_splits, recv_splits = counts[:self.ep_size], counts[self.ep_size:2 * self.ep_size]
+        tokens_per_local_expert = counts[2 * self.ep_size:]
+
+        tokens = x[token_idx]
+        tokens = all_to_all_single(tokens.new_empty(sum(recv_splits), x.size(-1)), tokens,
+                                   recv_splits, send_splits, group=self.ep_group)
+        # 收到的token按(来源rank, 本地专家)排列，重排成每个本地专家连续的一段
+        local_idx = torch.arange(n_local, device=x.device).repeat(self.ep_size)
+        local_order = local_idx.repeat_interleave(recv_counts.flatten(), output_size=tokens.size(0)).argsort(stable=True)
+        expert_inputs = tokens[local_order].split(tokens_per_local_expert)
+        expert_out = torch.cat([expert(t) for expert, t in zip(self.experts, expert_inputs)])
+        expert_out = expert_out[local_order.argsort()]
+        expert_out = all_to_all_single(expert_out.new_empty(token_idx.size(0), x.size(-1)), expert_out,
+                                       send_splits, recv_splits, group=self.ep_group)
+        expert_out = expert_out * flat_expert_weights[order].unsqueeze(-1).to(expert_out.dtype)
+        return torch.zeros_like(x).index_add_(0, token_idx, expert_out.to(x.dtype))
+
+    def _expert_state_dict_hook(self, module, state_dict, prefix, local_metadata):
+        """把本地专家在state_dict中的编号换成全局编号"""
+        for key in [k for k in state_dict if k.startswith(prefix + 'experts.')]:
+            i, name = key[len(prefix + 'experts.'):].split('.', 1)
+            state_dict[f'{prefix}experts.{int(i) + self.expert_offset}.{name}'] = state_dict.pop(key)
+        return state_dict
+
+    def _expert_load_state_dict_pre_hook(self, state_dict, prefix, *args):
+        """加载时只保留属于本rank的专家，并把全局编号换成本地编号，完整的或本rank保存的state_dict都可以加载"""
+        for key in [k for k in state_dict if k.startswith(prefix + 'experts.')]:
+            i, name = key[len(prefix + 'experts.'):].split('.', 1)
+            value = state_dict.pop(key)
+            if 0 <= int(i) - self.expert_offset < len(self.experts):
+                state_dict[f'{prefix}experts.{int(i) - self.expert_offset}.{name}'] = value
+
+    def _expert_weights(self):
+        """
+        把各专家的w1/w2/w3（fused_proj时为w13/w2）权重堆叠成[n_experts, out_features, in_features]的张量，
+        供推理时按专家编号在设备上取用
+
+        堆叠后各专家Linear的权重改为堆叠张量中的视图，不额外占用内存；权重被整体替换（如.to()/.half()）后重新堆叠。
+        专家被替换为量化线性层等情况下返回None。
+        """
+        names = ('w13', 'w2') if self.config.fused_proj else ('w1', 'w2', 'w3')
+        linears = [[getattr(expert, name) for name in names] for expert in self.experts]
+        if not all(type(linear) is nn.Linear for group in linears for linear in group):
+            return None
+        stacked = getattr(self, '_stacked_weights', None)
+        if stacked is None or any(linear.weight.data_ptr() != weight[i].data_ptr()
+                                  for i, group in enumerate(linears) for linear, weight in zip(group, stacked)):
+            # 推理模式中创建的张量不能用于之后的训练，这里在普通模式下堆叠
+            with torch.inference_mode(False), torch.no_grad():
+                stacked = tuple(torch.stack([group[j].weight for group in linears]) for j in range(len(names)))
+                for i, group in enumerate(linears):
+                    for linear, weight in zip(group, stacked):
+                        linear.weight.data = weight[i]
+            self._stacked_weights = stacked
+        return stacked
+
     @torch.no_grad()
-    def moe_infer(self, x, flat_expert_indices, flat_expert_weights):
-        expert_cache = torch.zeros_like(x)
-        idxs = flat_expert_indices.argsort()
-        tokens_per_expert = flat_expert_indices.bincount().cpu().numpy().cumsum(0)
-        token_idxs = idxs // self.config.num_experts_per_tok
-        # 当tokens_per_expert = [6, 15, 20, 26]，tokens_per_expert.shape[0]即为专家数量（此时为4）
-        # 且token_idxs = [3, 7, 19, 21, 24, 25,  4,  5,  6, 10, 11, 12...] 时
-        # 意味token_idxs[:6] -> [3, 7, 19, 21, 24, 25]这6个位置属于专家0处理的token（每个token有可能被多个专家处理，这取决于num_experts_per_tok）
-        # 接下来9个位置token_idxs[6:15] -> [4,  5,  6, 10, 11, 12...]属于专家1处理的token...依此类推
-        for i, end_idx in enumerate(tokens_per_expert):
-            start_idx = 0 if i == 0 else tokens_per_expert[i - 1]
-            if start_idx == end_idx:
-                continue
-            expert = self.experts[i]
-            exp_token_idx = token_idxs[start_idx:end_idx]
-            expert_tokens = x[exp_token_idx]
-            expert_out = expert(expert_tokens).to(expert_cache.dtype)
-            expert_out.mul_(flat_expert_weights[idxs[start_idx:end_idx]])
-            expert_cache.scatter_add_(0, exp_token_idx.view(-1, 1).repeat(1, x.shape[-1]), expert_out)
-
-        return expert_cache
+    def moe_infer(self, x, topk_idx, topk_weight):
+        """
+        推理时的专家计算，按输入规模选择分发方式：
+        - gather：批大小为1的解码，直接取出top-k专家的权重做批量矩阵乘；
+        - grouped：批量解码，所有专家对全部token做一次批量矩阵乘，再按路由权重（未选中为0）合并；
+        - sorted：预填充等大输入，按专家排序后每个专家处理连续的一段（见dispatch），每层同步一次主机。
+        前两种方式的路由结果不离开设备，不会打断异步执行，也可以被CUDA Graph捕获。
+        在CPU上读取各专家的token数不需要设备同步，自动选择时总是使用计算量最小的sorted。
+
+        参数:
+            x: 形状为[num_tokens, dim]的输入
+            topk_idx: 形状为[num_tokens, top_k]的专家编号
+            topk_weight: 形状为[num_tokens, top_k]的路由权重
+
+        返回:
+            形状为[num_tokens, dim]的加权专家输出
+        """
+        mode = self.INFER_DISPATCH
+        if mode is None:
+            n = x.size(0)
+            mode = 'sorted' if x.device.type == 'cpu' else \
+                'gather' if n <= self.GATHER_MAX_TOKENS else 'grouped' if n <= self.GROUPED_MAX_TOKENS else 'sorted'
+        weights = self._expert_weights() if mode != 'sorted' else None
+        if weights is None:
+            return self.dispatch(x, topk_idx.view(-1), topk_weight.view(-1))
+        fused = len(weights) == 2
+        w2 = weights[1]
+        topk_weight = topk_weight.to(x.dtype)
+        if mode == 'gather':
+            # [num_tokens * top_k, out_features, in_features]的权重与各自的输入列向量相乘
+            idx = topk_idx.view(-1)
+            xs = x.repeat_interleave(topk_idx.size(1), dim=0).unsqueeze(-1)
+            if fused:
+                h1, h3 = torch.bmm(weights[0][idx], xs).chunk(2, dim=1)
+            else:
+                h1, h3 = torch.bmm(weights[0][idx], xs), torch.bmm(weights[2][idx], xs)
+            out = torch.bmm(w2[idx], F.silu(h1) * h3).view(*topk_idx.shape, -1)
+            return (out * topk_weight.unsqueeze(-1)).sum(dim=1)
+        # 各token对每个专家的合并权重，[n_experts, num_tokens, 1]
+        combine = torch.zeros(x.size(0), len(self.experts), dtype=x.dtype, device=x.device)
+        combine = combine.scatter(1, topk_idx, topk_weight).t().unsqueeze(-1)
+        xs = x.unsqueeze(0).expand(len(self.experts), -1, -1)
+        if fused:
+            h1, h3 = torch.bmm(xs, weights[0].transpose(1, 2)).chunk(2, dim=-1)
+        else:
+            h1, h3 = torch.bmm(xs, weights[0].transpose(1, 2)), torch.bmm(xs, weights[2].transpose(1, 2))
+        return (torch.bmm(F.silu(h1) * h3, w2.transpose(1, 2)) * combine).sum(dim=0)
+
+
+# 激活检查点的反向传播中正在重新计算前向时为True，此时不重复记录路由统计等副作用
+_RECOMPUTING = False
+
+
+def checkpoint_forward(fn, *args):
+    """
+    以激活检查点方式调用fn(*args)：前向时不保存中间激活，反向传播时重新计算
+
+    使用非重入实现（与DDP、只有部分输入需要梯度的情况兼容），并保存随机数状态，重新计算时dropout结果不变；
+    重新计算期间_RECOMPUTING为True。
+    """
+    calls = []
+
+    def run(*args):
+        global _RECOMPUTING
+        recomputing, _RECOMPUTING = _RECOMPUTING, bool(calls)
+        calls.append(None)
+        try:
+            return fn(*args)
+        finally:
+            _RECOMPUTING = recomputing
+
+    return checkpoint(run, *args, use_reentrant=False)
 
 
 class MiniMindBlock(nn.Module):
@@ -485,7 +876,7 @@ class MiniMindBlock(nn.Module):
         # 每个注意力头的维度
         self.head_dim = config.dim // config.n_heads
         # 注意力层
-        self.attention = Attention(config)
+        self.attention = Attention(config, layer_id)
 
         # 记录层索引，可用于位置相关的特殊处理
         self.layer_id = layer_id
@@ -495,8 +886,14 @@ class MiniMindBlock(nn.Module):
         self.ffn_norm = RMSNorm(config.dim, eps=config.norm_eps)
         # 前馈网络层，根据配置选择普通FFN或混合专家FFN(MoE)
         self.feed_forward = FeedForward(config) if not config.use_moe else MOEFeedForward(config)
-
-    def forward(self, x, pos_cis, past_key_value=None, use_cache=False):
+        # 训练时的激活检查点：整个块（'every'，或'every_n'时每activation_checkpoint_n层的第一层），或只有注意力子层
+        policy = config.activation_checkpoint or 'none'
+        if policy not in ('none', 'every', 'every_n', 'attention'):
+            raise ValueError(f"activation_checkpoint must be one of none/every/every_n/attention, got {policy!r}")
+        self.checkpoint_block = policy == 'every' or (policy == 'every_n' and layer_id % config.activation_checkpoint_n == 0)
+        self.checkpoint_attention = policy == 'attention'
+
+    def forward(self, x, pos_cis, past_key_value=None, use_cache=False, attn_mask=None):
         """
         前向传播函数
 
@@ -505,19 +902,33 @@ class MiniMindBlock(nn.Module):
             pos_cis: 旋转位置编码
             past_key_value: 可选的KV缓存，用于加速自回归生成
             use_cache: 是否使用并返回KV缓存
+            attn_mask: 可选的加性注意力掩码（含填充信息），为None时使用因果掩码
 
         返回:
             out: 经过处理后的输出张量
             past_kv: 更新后的KV缓存（如果use_cache=True）
         """
+        # 只在训练且需要梯度时使用激活检查点，推理和带KV缓存的前向不受影响
+        checkpointing = self.training and torch.is_grad_enabled() and not use_cache
+        if checkpointing and self.checkpoint_block:
+            return checkpoint_forward(self._forward, x, pos_cis, past_key_value, use_cache, attn_mask)
+        return self._forward(x, pos_cis, past_key_value, use_cache, attn_mask,
+                             checkpoint_attention=checkpointing and self.checkpoint_attention)
+
+    def _forward(self, x, pos_cis, past_key_value=None, use_cache=False, attn_mask=None, checkpoint_attention=False):
         # 1. 注意力子层：先归一化，再计算注意力，最后应用残差连接
         # 先对输入进行层归一化
-        h_attn, past_kv = self.attention(
+        attention = lambda x, pos_cis, attn_mask: self.attention(
             self.attention_norm(x),
             pos_cis,
             past_key_value=past_key_value,
-            use_cache=use_cache
+            use_cache=use_cache,
+            attn_mask=attn_mask
         )
+        if checkpoint_attention:
+            h_attn, past_kv = checkpoint_forward(attention, x, pos_cis, attn_mask)
+        else:
+            h_attn, past_kv = attention(x, pos_cis, attn_mask)
         # 应用第一个残差连接: x + Attention(LayerNorm(x))
         h = x + h_attn
 
@@ -527,13 +938,53 @@ class MiniMindBlock(nn.Module):
         return out, past_kv
 
 
+def chunked_cross_entropy(h, labels, norm, output, loss_mask=None, chunk_size: int = 1024):
+    """
+    分块计算最后的归一化、输出层投影与交叉熵，不生成整段序列的logits
+
+    只计算loss_mask不为0的位置，每chunk_size个位置一块；每块的logits用完即释放，
+    反向传播时重新计算（activation checkpointing），前向和反向任何时候最多只有一块[chunk_size, vocab_size]的logits。
+
+    参数:
+        h: 形状为[batch_size, seq_len, dim]的最后一层隐藏状态（归一化之前）
+        labels: 形状为[batch_size, seq_len]的目标token
+        norm: 最终归一化层
+        output: 输出层
+        loss_mask: 形状为[batch_size, seq_len]的掩码，为0的位置跳过；None时计算所有位置
+        chunk_size: 每块的位置数
+
+    返回:
+        形状为[batch_size, seq_len]的float32逐token交叉熵，跳过的位置为0
+    """
+    def chunk_loss(h_chunk, labels_chunk):
+        logits = output(norm(h_chunk)).float()
+        return F.cross_entropy(logits, labels_chunk, reduction='none')
+
+    shape = labels.shape
+    h, labels = h.reshape(-1, h.size(-1)), labels.reshape(-1)
+    # 取出需要计算的位置（需要同步一次主机得到位置数）
+    idx = loss_mask.reshape(-1).nonzero().squeeze(-1) if loss_mask is not None else None
+    h_sel, labels_sel = (h[idx], labels[idx]) if idx is not None else (h, labels)
+    losses = []
+    for i in range(0, h_sel.size(0), chunk_size):
+        h_chunk, labels_chunk = h_sel[i:i + chunk_size], labels_sel[i:i + chunk_size]
+        if torch.is_grad_enabled():
+            losses.append(checkpoint(chunk_loss, h_chunk, labels_chunk, use_reentrant=False))
+        else:
+            losses.append(chunk_loss(h_chunk, labels_chunk))
+    loss = torch.cat(losses) if losses else h.new_zeros(0, dtype=torch.float32)
+    if idx is not None:
+        loss = h.new_zeros(h.size(0), dtype=torch.float32).index_copy(0, idx, loss)
+    return loss.view(shape)
+
+
 class MiniMindLM(PreTrainedModel):
     """
     MiniMind语言模型主类
 
     这是基于Transformer架构的语言模型实现，结合了多种现代技术：
     1. 预归一化（Pre-Normalization）：在每个子层前而非后应用归一化
-    2. 旋转位置编码（RoPE）：使用复数旋转来编码位置信息
+    2. 旋转位置编码（RoPE）：用预计算的cos/sin表旋转Q/K来编码位置信息，支持动态NTK/YaRN长度外推
     3. 参数共享：输入嵌入和输出层权重共享
     4. 混合专家模型（MoE）：可选的稀疏前馈网络实现
 
@@ -544,6 +995,10 @@ class MiniMindLM(PreTrainedModel):
     4. 输出层：将隐藏状态映射为词汇表大小的logits
     """
     config_class = LMConfig
+    # 批量生成时每隔多少步检查一次是否所有行都已结束（检查需要同步主机）
+    EARLY_STOP_INTERVAL = 8
+    # 给出labels时分块计算交叉熵，每块的位置数（见chunked_cross_entropy）
+    LOSS_CHUNK_SIZE = 1024
 
     def __init__(self, params: LMConfig = None):
         """
@@ -577,29 +1032,94 @@ class MiniMindLM(PreTrainedModel):
         # 参数共享：输入嵌入和输出层权重共享，减少参数量并提高性能
         self.tok_embeddings.weight = self.output.weight
 
-        # 预计算位置编码：用于旋转位置编码(RoPE)
-        self.register_buffer("pos_cis",
-                             precompute_pos_cis(dim=params.dim // params.n_heads, theta=params.rope_theta),
+        # 预计算位置编码：用于旋转位置编码(RoPE)，覆盖max_seq_len个位置，更长的输入到来时再扩展；
+        # 动态NTK按当前序列长度计算基数（rope_ntk_len），在序列超出原始训练长度之前不缩放
+        scaling = params.rope_scaling or {}
+        self.rope_seq_len = params.max_seq_len
+        self.rope_ntk_len = scaling.get('original_max_position_embeddings', 2048) \
+            if scaling.get('type') == 'dynamic' else None
+        self.register_buffer("pos_cis", self._precompute_pos_cis(self.rope_seq_len, self.rope_ntk_len),
                              persistent=False)
 
         # 输出容器：用于存储和返回模型的各种输出
         self.OUT = CausalLMOutputWithPast()
 
+    def _precompute_pos_cis(self, end: int, ntk_len: int = None):
+        """计算覆盖end个位置（至少max_seq_len个）的RoPE表，动态NTK按长度ntk_len计算基数"""
+        return precompute_pos_cis(dim=self.params.dim // self.params.n_heads, end=max(end, self.params.max_seq_len),
+                                  theta=self.params.rope_theta, rope_scaling=self.params.rope_scaling,
+                                  seq_len=ntk_len)
+
+    def _update_pos_cis(self, seq_len: int):
+        """
+        按当前序列长度seq_len更新RoPE表
+
+        表的大小取不小于seq_len的2的幂，长序列的生成过程中只需扩展O(log n)次；
+        动态NTK的基数按实际的seq_len计算（与transformers的dynamic RoPE相同），seq_len超出原始训练长度后每次变化都重新计算，
+        回到原始长度以内时恢复为不缩放（已缓存的K仍是按旧基数旋转的，与常见实现一致）。
+        """
+        ntk_len = None
+        if self.rope_ntk_len is not None:
+            ntk_len = max(seq_len, (self.params.rope_scaling or {}).get('original_max_position_embeddings', 2048))
+        if seq_len <= self.rope_seq_len and ntk_len == self.rope_ntk_len:
+            return
+        if seq_len > self.rope_seq_len:
+            self.rope_seq_len = 1 << (seq_len - 1).bit_length()
+        self.rope_ntk_len = ntk_len
+        # generate等在推理模式中调用时，表也要在普通模式下创建，之后的训练前向才能在autograd中使用
+        with torch.inference_mode(False):
+            self.pos_cis = self._precompute_pos_cis(self.rope_seq_len, ntk_len).to(self.pos_cis.device,
+                                                                                    self.pos_cis.dtype)
+
+    def expert_parallel_parameters(self):
+        """专家并行时只保存在本rank上的参数名（各rank的专家互不相同，不能参与DDP的梯度同步）"""
+        return [f'layers.{l}.feed_forward.experts.{name}' for l, layer in enumerate(self.layers)
+                if isinstance(layer.feed_forward, MOEFeedForward) and layer.feed_forward.ep_size > 1
+                for name, _ in layer.feed_forward.experts.named_parameters()]
+
+    def full_state_dict(self):
+        """
+        完整的state_dict：专家并行时从所有rank收集各自的专家参数（集合操作，所有rank都要调用），
+        结果与不分片的模型相同，可以直接用于推理或继续训练
+        """
+        state_dict = self.state_dict()
+        names = self.expert_parallel_parameters()
+        if not names:
+            return state_dict
+        group = next(layer.feed_forward.ep_group for layer in self.layers if isinstance(layer.feed_forward, MOEFeedForward))
+        # state_dict中的专家已是全局编号，与参数名不同，按前缀取出本rank的专家
+        local = {k: v.cpu() for k, v in state_dict.items() if '.feed_forward.experts.' in k}
+        gathered = [None] * dist.get_world_size(group)
+        dist.all_gather_object(gathered, local, group=group)
+        for part in gathered:
+            state_dict.update({k: v.to(self.output.weight.device) for k, v in part.items()})
+        return state_dict
+
     def forward(self,
                 input_ids: Optional[torch.Tensor] = None,
-                past_key_values: Optional[List[Tuple[torch.Tensor, torch.Tensor]]] = None,
+                past_key_values: Optional[Union[List[Tuple[torch.Tensor, torch.Tensor]], KVCache]] = None,
                 use_cache: bool = False,
                 logits_to_keep: Union[int, torch.Tensor] = 0,
+                labels: Optional[torch.Tensor] = None,
+                loss_mask: Optional[torch.Tensor] = None,
                 **args):
         """
         模型前向传播函数
 
         参数:
             input_ids: 输入的token ID，形状为[batch_size, seq_len]
-            past_key_values: 可选的KV缓存，用于加速自回归生成
+            past_key_values: 可选的KV缓存，用于加速自回归生成；
+                             可以是每层(K, V)元组组成的列表（兼容旧接口），也可以是预分配的KVCache
             use_cache: 是否使用并返回KV缓存
-            logits_to_keep: 控制只计算部分位置的logits，可以是整数或张量
-            **args: 其他参数，如start_pos（用于RoPE计算的起始位置）
+            logits_to_keep: 控制只计算部分位置的logits，可以是整数（最后几个位置，0为全部）或位置下标张量；
+                            None时不计算logits（logits为None，由调用者对last_hidden_state分块投影，见token_log_probs）
+            labels: 可选的目标token，形状为[batch_size, seq_len]；给出时不计算logits，
+                    而是分块计算逐token的交叉熵（见chunked_cross_entropy），用于训练
+            loss_mask: 与labels同形状，为0的位置不计算交叉熵
+            **args: 其他参数，如start_pos（用于RoPE计算的起始位置）、
+                    attention_mask（[batch_size, kv_len]，1表示有效token、0表示填充）、
+                    position_ids（[batch_size, seq_len]，逐行的RoPE位置，用于左填充的批量生成，或打包训练时在每篇文档开头重置位置）、
+                    document_ids（[batch_size, seq_len]，打包训练时每个token所属文档的编号，注意力只在同一文档内）
 
         返回:
             CausalLMOutputWithPast对象，包含:
@@ -607,36 +1127,78 @@ class MiniMindLM(PreTrainedModel):
             - past_key_values: 更新后的KV缓存
             - last_hidden_state: 最后一层的隐藏状态
             - aux_loss: MoE模型的辅助损失（如果使用）
+            - token_loss: 给出labels时为[batch_size, seq_len]的逐token交叉熵（loss_mask为0的位置为0）
         """
-        # 初始化KV缓存，如果未提供则为每层创建None
-        past_key_values = past_key_values or [None] * len(self.layers)
-
-        # 获取起始位置，用于RoPE计算，默认为0
-        start_pos = args.get('start_pos', 0)
+        if isinstance(past_key_values, KVCache):
+            # 预分配缓存自带已缓存长度；显式传入start_pos时以其为准（可用于回滚缓存）
+            start_pos = args.get('start_pos', past_key_values.seq_len)
+            past_key_values.seq_len = start_pos
+            # 滑动窗口缓存在写入前先淘汰窗口外的token，新token的位置随之前移
+            start_pos = past_key_values.make_room(input_ids.size(1), self.pos_cis)
+        else:
+            # 初始化KV缓存，如果未提供则为每层创建None
+            past_key_values = past_key_values or [None] * len(self.layers)
+            # 获取起始位置，用于RoPE计算，默认为0
+            start_pos = args.get('start_pos', 0)
 
         # 1. 词元嵌入：将输入token ID转换为向量表示并应用dropout
         h = self.dropout(self.tok_embeddings(input_ids))
 
-        # 2. 获取当前序列对应的位置编码
-        pos_cis = self.pos_cis[start_pos:start_pos + input_ids.size(1)]
+        # 2. 获取当前序列对应的位置编码；给出position_ids时按行取各自位置
+        #    （整段序列的长度由填充掩码给出，不需要从设备上读取position_ids的最大值）
+        attention_mask = args.get('attention_mask')
+        self._update_pos_cis(attention_mask.size(1) if attention_mask is not None else start_pos + input_ids.size(1))
+        position_ids = args.get('position_ids')
+        if position_ids is not None:
+            pos_cis = self.pos_cis[position_ids]
+        else:
+            pos_cis = self.pos_cis[start_pos:start_pos + input_ids.size(1)]
+
+        # 构造所有层共享的注意力掩码：给出填充掩码时与因果掩码合并；
+        # 否则只在各层需要显式因果掩码时（有缓存偏移的多token输入，或不使用Flash Attention）构造一次
+        attn_mask = None
+        seq_len = input_ids.size(1)
+        document_ids = args.get('document_ids')
+        if attention_mask is not None:
+            attn_mask = self._prepare_attn_mask(attention_mask, seq_len, h.dtype)
+        elif document_ids is not None:
+            attn_mask = self._document_attn_mask(document_ids, h.dtype)
+        elif seq_len != 1:
+            if isinstance(past_key_values, KVCache):
+                past_len = start_pos
+            else:
+                past_len = past_key_values[0][0].size(1) if past_key_values[0] is not None else 0
+            if past_len != 0 or not self.layers[0].attention.flash:
+                attn_mask = causal_mask(seq_len, past_len + seq_len, h.device, h.dtype)
 
         # 3. 依次通过每个Transformer层
         past_kvs = []
         for l, layer in enumerate(self.layers):
             h, past_kv = layer(
                 h, pos_cis,
-                past_key_value=past_key_values[l],
-                use_cache=use_cache
+                past_key_value=past_key_values if isinstance(past_key_values, KVCache) else past_key_values[l],
+                use_cache=use_cache,
+                attn_mask=attn_mask
             )
             past_kvs.append(past_kv)
+        if isinstance(past_key_values, KVCache):
+            # 所有层都已写入，推进缓存长度；返回的仍是同一个缓存对象
+            past_key_values.seq_len = start_pos + input_ids.size(1)
+            past_kvs = past_key_values
 
         # 4. 确定需要计算logits的位置索引
         # 如果logits_to_keep是整数，则只保留最后logits_to_keep个位置
         # 否则使用提供的张量作为索引
         slice_indices = slice(-logits_to_keep, None) if isinstance(logits_to_keep, int) else logits_to_keep
 
-        # 5. 计算输出logits：先归一化，然后通过输出层
-        logits = self.output(self.norm(h)[:, slice_indices, :])
+        # 5. 计算输出logits：先取出需要的位置，再归一化并通过输出层（预填充时不对整段提示词做词表投影）；
+        #    训练时给出labels则分块计算交叉熵，不生成logits
+        token_loss = None
+        if labels is not None:
+            logits = None
+            token_loss = chunked_cross_entropy(h, labels, self.norm, self.output, loss_mask, self.LOSS_CHUNK_SIZE)
+        else:
+            logits = self.output(self.norm(h[:, slice_indices, :])) if logits_to_keep is not None else None
 
         # 6. 计算MoE辅助损失（如果使用MoE）
         aux_loss = sum(l.feed_forward.aux_loss for l in self.layers if isinstance(l.feed_forward, MOEFeedForward))
@@ -645,13 +1207,83 @@ class MiniMindLM(PreTrainedModel):
         self.OUT.__setitem__('last_hidden_state', h)  # 最后的隐藏状态
         self.OUT.__setitem__('logits', logits)  # 预测的logits
         self.OUT.__setitem__('aux_loss', aux_loss)  # MoE辅助损失
+        self.OUT.__setitem__('token_loss', token_loss)  # 逐token交叉熵
         self.OUT.__setitem__('past_key_values', past_kvs)  # KV缓存
 
         return self.OUT
 
+    @torch.inference_mode()
+    def token_log_probs(self, input_ids, labels=None, chunk_size: int = 512):
+        """
+        逐位置计算目标token的对数概率，用于困惑度等评估
+
+        一次前向得到最后一层的隐藏状态（不做词表投影），再按chunk_size个位置一块归一化并投影到词表，
+        立即取出目标token的对数概率，任何时候最多只有[batch_size, chunk_size, vocab_size]的logits。
+
+        参数:
+            input_ids: 形状为[batch_size, seq_len]的输入
+            labels: 形状为[batch_size, seq_len]的目标，labels[:, t]为位置t的下一个token；
+                    为None时以input_ids右移一位为目标，返回前seq_len-1个位置
+            chunk_size: 每块的位置数
+
+        返回:
+            形状与labels相同的float32对数概率
+        """
+        if labels is None:
+            input_ids, labels = input_ids[:, :-1], input_ids[:, 1:]
+        h = self(input_ids, logits_to_keep=None).last_hidden_state
+        log_probs = []
+        for i in range(0, h.size(1), chunk_size):
+            logits = self.output(self.norm(h[:, i:i + chunk_size])).float()
+            target = labels[:, i:i + chunk_size, None]
+            log_probs.append((logits.gather(-1, target) - logits.logsumexp(dim=-1, keepdim=True)).squeeze(-1))
+        return torch.cat(log_probs, dim=1)
+
+    @staticmethod
+    def _prepare_attn_mask(attention_mask: torch.Tensor, seq_len: int, dtype: torch.dtype):
+        """
+        将填充掩码与因果掩码合并为加性注意力掩码
+
+        参数:
+            attention_mask: 形状为[batch_size, kv_len]，1表示有效token，0表示填充
+            seq_len: 当前输入的长度（查询位于整段序列的最后seq_len个位置）
+            dtype: 掩码的数据类型
+
+        返回:
+            形状为[batch_size, 1, seq_len, kv_len]的加性掩码，允许的位置为0，屏蔽的位置为-inf
+        """
+        kv_len = attention_mask.size(1)
+        q_idx = torch.arange(kv_len - seq_len, kv_len, device=attention_mask.device)[:, None]
+        k_idx = torch.arange(kv_len, device=attention_mask.device)[None, :]
+        allowed = (k_idx <= q_idx)[None] & attention_mask.bool()[:, None, :]
+        # 左填充位置作为查询时没有任何可见的键，允许它看见自己，避免softmax产生NaN
+        allowed = allowed | ((k_idx == q_idx)[None] & ~allowed.any(dim=-1, keepdim=True))
+        mask = torch.zeros(allowed.shape, dtype=dtype, device=attention_mask.device)
+        return mask.masked_fill_(~allowed, float('-inf')).unsqueeze(1)
+
+    @staticmethod
+    def _document_attn_mask(document_ids: torch.Tensor, dtype: torch.dtype):
+        """
+        打包了多篇文档的序列的块对角因果掩码：每个token只能看见同一文档中不晚于自己的token
+
+        参数:
+            document_ids: 形状为[batch_size, seq_len]，每个token所属文档的编号（同一行内不减）
+            dtype: 掩码的数据类型
+
+        返回:
+            形状为[batch_size, 1, seq_len, seq_len]的加性掩码，允许的位置为0，屏蔽的位置为-inf
+        """
+        seq_len = document_ids.size(1)
+        idx = torch.arange(seq_len, device=document_ids.device)
+        allowed = (idx[None, :] <= idx[:, None])[None] & (document_ids[:, :, None] == document_ids[:, None, :])
+        mask = torch.zeros(allowed.shape, dtype=dtype, device=document_ids.device)
+        return mask.masked_fill_(~allowed, float('-inf')).unsqueeze(1)
+
     @torch.inference_mode()
     def generate(self, input_ids, eos_token_id=2, max_new_tokens=1024, temperature=0.75, top_p=0.90,
-                 stream=False, rp=1., use_cache=True, pad_token_id=0, num_return_sequences=1, **args):
+                 stream=False, rp=1., use_cache=True, pad_token_id=0, num_return_sequences=1,
+                 draft_model=None, num_speculative_tokens=4, top_k=0, min_p=0.,
+                 presence_penalty=0., frequency_penalty=0., prefill_chunk_size=None, **args):
         """
         文本生成函数
 
@@ -666,48 +1298,259 @@ class MiniMindLM(PreTrainedModel):
             use_cache: 是否使用KV缓存加速生成，默认为True
             pad_token_id: 填充token的ID，默认为0
             num_return_sequences: 每个输入生成的序列数量，默认为1
-            **args: 其他参数
+            draft_model: 可选的草稿模型（与本模型共享分词器的小模型），给出时使用投机解码
+            num_speculative_tokens: 投机解码时草稿模型每轮提出的token数k
+            top_k: 只在概率最高的top_k个token中采样，0表示不限制
+            min_p: 过滤概率低于 min_p * 最大概率 的token，0表示不过滤
+            presence_penalty: 存在惩罚，出现过的token的logit减去该值
+            frequency_penalty: 频率惩罚，token的logit减去该值乘以出现次数
+            prefill_chunk_size: 使用缓存时把提示词按该长度分块预填充，限制长提示词的峰值激活内存；None表示一次预填充
+            **args: 其他参数；流式生成时可以传入past_key_values（如SinkKVCache）在多次调用间保持会话缓存，
+                    此时input_ids只需包含缓存中还没有的新token
+
+            temperature、top_p、rp、top_k、min_p、presence_penalty、frequency_penalty
+            既可以是标量，也可以是长度为batch_size的列表（每个输入使用不同的采样设置）
 
         返回:
             生成的token序列，形状为[batch_size*num_return_sequences, seq_len]
         """
+        sampling = {
+            'temperature': temperature,
+            'top_p': top_p,
+            'top_k': top_k,
+            'min_p': min_p,
+            'repetition_penalty': rp,
+            'presence_penalty': presence_penalty,
+            'frequency_penalty': frequency_penalty,
+        }
+        if num_return_sequences > 1:
+            # 逐行参数随输入一起复制
+            sampling = {name: [v for v in value for _ in range(num_return_sequences)]
+                        if isinstance(value, (list, tuple)) else value for name, value in sampling.items()}
+
+        if draft_model is not None:
+            return self._speculative_generate(input_ids, draft_model, num_speculative_tokens, eos_token_id,
+                                              max_new_tokens, sampling, stream, pad_token_id, num_return_sequences)
+
         # 流式生成模式：逐token生成并返回生成器
         if stream:
-            return self._stream(input_ids, eos_token_id, max_new_tokens, temperature, top_p, rp, use_cache, **args)
+            return self._stream(input_ids, eos_token_id, max_new_tokens, sampling, use_cache,
+                                prefill_chunk_size=prefill_chunk_size, **args)
+
+        # 直接生成模式：移除每个输入序列中的填充token，并为每个输入复制num_return_sequences份
+        prompts = [input_ids[i][input_ids[i] != pad_token_id]
+                   for i in range(input_ids.size(0)) for _ in range(num_return_sequences)]
+        # 所有序列在同一个批次中并行生成，形状为[batch_size*num_return_sequences, seq_len]
+        return self._generate_batch(prompts, eos_token_id, max_new_tokens, sampling, use_cache, pad_token_id,
+                                    prefill_chunk_size, **args)
+
+    def _generate_batch(self, prompts, eos_token_id, max_new_tokens, sampling, use_cache, pad_token_id,
+                        prefill_chunk_size=None, **args):
+        """
+        批量生成函数：将长度不一的提示词左填充后组成一个批次，每步只做一次前向计算
+
+        各行通过attention_mask屏蔽填充位置、通过position_ids使用各自的RoPE位置，
+        遇到结束符或达到最大长度的行单独停止（之后的输出被忽略），所有行都结束后提前退出。
+
+        参数:
+            prompts: 去除填充后的提示词token ID列表，每个元素形状为[seq_len_i]
+            eos_token_id: 结束符token的ID
+            max_new_tokens: 序列（提示词+生成内容）的最大长度，与_stream的约定一致
+            sampling: 采样参数字典，传给LogitsProcessor
+            use_cache: 是否使用KV缓存
+            pad_token_id: 填充token的ID
+            prefill_chunk_size: 分块预填充的块长度，None表示一次预填充整个（左填充后的）提示词
+            **args: 其他参数
+
+        返回:
+            生成的token序列（提示词+生成内容，右侧用pad_token_id填充），形状为[len(prompts), seq_len]
+        """
+        device = prompts[0].device
+        bsz = len(prompts)
+        prompt_lens = torch.tensor([p.numel() for p in prompts], device=device)
+        prompt_len = int(prompt_lens.max())
+        # 每行最多生成的token数：与_stream一致，序列总长度达到max_new_tokens - 1时停止
+        budgets = (max_new_tokens - 1 - prompt_lens).clamp(min=0)
+        max_steps = int(budgets.max())
+        total_len = prompt_len + max_steps
+
+        # 1. 左填充：提示词右对齐，使每行最新的token位于同一列，便于共享KV缓存的写入位置
+        tokens = torch.full((bsz, total_len), pad_token_id, dtype=torch.long, device=device)
+        attention_mask = torch.zeros((bsz, total_len), dtype=torch.long, device=device)
+        for i, p in enumerate(prompts):
+            tokens[i, prompt_len - p.numel():prompt_len] = p
+            attention_mask[i, prompt_len - p.numel():] = 1
+        # 每个有效token在各自序列中的位置（填充位置记为0，反正会被掩码屏蔽）
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+        # 各行的采样参数与出现过的token计数都保存在设备上
+        processor = LogitsProcessor(self.vocab_size, bsz, device, tokens[:, :prompt_len],
+                                    attention_mask[:, :prompt_len], **sampling)
+
+        past_kvs = KVCache(self.params, bsz, total_len, device=device,
+                           dtype=self.output.weight.dtype) if use_cache else None
+        finished = budgets == 0
+        gen_lens = torch.zeros(bsz, dtype=torch.long, device=device)
+        cur_len = prompt_len
+        chunk_size = prefill_chunk_size or prompt_len
+        for step in range(max_steps):
+            # 2. 首步分块预填充提示词，每块接在已缓存的内容之后；之后只处理最新的一列token；
+            #    不使用缓存时每步处理整个序列
+            if use_cache and step == 0:
+                spans = [(i, min(i + chunk_size, cur_len)) for i in range(0, cur_len, chunk_size)]
+            else:
+                spans = [(cur_len - 1 if use_cache else 0, cur_len)]
+            for begin, end in spans:
+                out = self(tokens[:, begin:end], past_key_values=past_kvs, use_cache=use_cache,
+                           attention_mask=attention_mask[:, :end], position_ids=position_ids[:, begin:end],
+                           logits_to_keep=1, **args)
+            logits = out.logits[:, -1, :]
+            if use_cache:
+                past_kvs = out.past_key_values
+
+            # 3. 按各行的采样参数采样
+            next_tokens = processor.sample(logits)
+            # 已结束的行保持填充，不再记录新token
+            next_tokens = torch.where(finished, pad_token_id, next_tokens)
+            tokens[:, cur_len] = next_tokens
+            processor.update(next_tokens, ~finished)
+            gen_lens += (~finished).long()
+            position_ids[:, cur_len] = position_ids[:, cur_len - 1] + 1
+            cur_len += 1
+
+            # 4. 遇到结束符或达到该行的长度上限时，该行单独停止
+            finished = finished | (next_tokens == eos_token_id) | (gen_lens >= budgets)
+            # 检查是否全部结束需要同步主机，每隔若干步才检查一次；多算的几步只会写入填充
+            if (step + 1) % self.EARLY_STOP_INTERVAL == 0 and finished.all():
+                break
+
+        # 5. 去掉左填充，输出与逐行生成一致的格式：提示词+生成内容，右侧用pad_token_id补齐
+        out_lens = prompt_lens + gen_lens
+        res = torch.full((bsz, int(out_lens.max())), pad_token_id, dtype=torch.long, device=device)
+        for i, (p_len, o_len) in enumerate(zip(prompt_lens.tolist(), out_lens.tolist())):
+            res[i, :o_len] = tokens[i, prompt_len - p_len:prompt_len - p_len + o_len]
+        return res
 
-        # 直接生成模式：一次性返回所有生成结果
+    def _speculative_generate(self, input_ids, draft_model, num_speculative_tokens, eos_token_id, max_new_tokens,
+                              sampling, stream, pad_token_id, num_return_sequences):
+        """
+        投机解码的入口：流式模式直接返回生成器；否则逐条生成后右侧填充成一个批次
+
+        各行的接受长度不同，投机解码按单条序列进行，参数含义与generate相同
+        """
+        if stream:
+            return self._speculative_stream(input_ids, draft_model, num_speculative_tokens, eos_token_id,
+                                            max_new_tokens, sampling)
         generated = []
         for i in range(input_ids.size(0)):
-            # 移除每个输入序列中的填充token
             non_pad = input_ids[i][input_ids[i] != pad_token_id].unsqueeze(0)
-            # 为每个输入生成num_return_sequences个不同序列
-            for _ in range(num_return_sequences):
-                # 使用流式生成函数获取生成结果
-                out = self._stream(non_pad, eos_token_id, max_new_tokens, temperature, top_p, rp, use_cache, **args)
-                # 收集生成的token
-                tokens_list = [tokens[:, -1:] for tokens in out]
-                # 将生成的token拼接起来
-                gen = torch.cat(tokens_list, dim=-1) if tokens_list else non_pad
-                # 将输入和生成的token拼接成完整序列
-                full_sequence = torch.cat([non_pad, gen], dim=-1)
-                generated.append(full_sequence)
-
-        # 找出所有生成序列中的最大长度
-        max_length = max(seq.size(1) for seq in generated)
-        # 将所有序列填充到相同长度
-        generated = [
-            torch.cat(
-                [seq, torch.full((1, max_length - seq.size(1)), pad_token_id, dtype=seq.dtype, device=seq.device)],
-                dim=-1)
-            for seq in generated
-        ]
-        # 将所有序列拼接成一个批次
-        output = torch.cat(generated, dim=0)
-        # 重塑为[batch_size*num_return_sequences, seq_len]形状
-        res = output.view(input_ids.size(0) * num_return_sequences, -1)
+            for j in range(num_return_sequences):
+                # 逐行参数只取当前这一行的值
+                row = i * num_return_sequences + j
+                row_sampling = {name: value[row] if isinstance(value, (list, tuple)) else value
+                                for name, value in sampling.items()}
+                gen = non_pad[:, :0]
+                for gen in self._speculative_stream(non_pad, draft_model, num_speculative_tokens, eos_token_id,
+                                                    max_new_tokens, row_sampling):
+                    pass
+                generated.append(torch.cat([non_pad, gen], dim=-1)[0])
+        max_length = max(seq.numel() for seq in generated)
+        res = torch.full((len(generated), max_length), pad_token_id, dtype=torch.long, device=input_ids.device)
+        for i, seq in enumerate(generated):
+            res[i, :seq.numel()] = seq
         return res
 
-    def _stream(self, input_ids, eos_token_id, max_new_tokens, temperature, top_p, rp, use_cache, **args):
+    def _speculative_stream(self, input_ids, draft_model, num_speculative_tokens, eos_token_id, max_new_tokens,
+                            sampling):
+        """
+        投机解码（Speculative Decoding）：小模型起草，大模型一次前向验证
+
+        每一轮：
+        1. 草稿模型自回归地提出k个token d_1..d_k，并记录它的采样分布q_1..q_k；
+        2. 目标模型（本模型）对[待处理token, d_1..d_k]做一次前向，得到k+1个位置的分布p_1..p_{k+1}；
+        3. 依次以概率min(1, p_i(d_i)/q_i(d_i))接受d_i；在第一个被拒绝的位置从归一化的max(0, p_i - q_i)中重新采样，
+           全部接受时再从p_{k+1}额外采样一个token。
+        这种拒绝采样保证输出分布与目标模型在相同采样参数（包括各种惩罚）下直接采样完全一致。
+        两个模型都使用预分配的KVCache，被拒绝的草稿只需把缓存长度回滚到已接受的位置。
+
+        参数:
+            input_ids: 输入的token ID，形状为[1, seq_len]
+            draft_model: 草稿模型，需与本模型共享词表
+            num_speculative_tokens: 每轮提出的草稿token数k
+            其余参数与_stream相同
+
+        返回:
+            生成器，每轮产出当前已生成的token序列；结束后接受率与速度记录在self.speculative_stats中
+        """
+        assert input_ids.size(0) == 1, "投机解码按单条序列进行"
+        assert draft_model.vocab_size == self.vocab_size, "草稿模型与目标模型的词表必须一致"
+        k, device, vocab_size = num_speculative_tokens, input_ids.device, self.vocab_size
+        start = input_ids.shape[1]
+        max_len = max(max_new_tokens, start) + k + 1
+        target_cache = KVCache(self.params, 1, max_len, device=device, dtype=self.output.weight.dtype)
+        draft_cache = KVCache(draft_model.params, 1, max_len, device=device, dtype=draft_model.output.weight.dtype)
+        # 已出现过的token计数保存在processor中，用于各种惩罚
+        processor = LogitsProcessor(vocab_size, 1, device, input_ids, **sampling)
+        num_drafted, num_accepted, start_time = 0, 0, time.time()
+        self.speculative_stats = {}
+
+        while input_ids.shape[1] < max_new_tokens - 1:
+            # 1. 草稿模型依次提出k个token；首轮或上轮全部接受时，先补上草稿缓存中缺少的token
+            x, draft_counts, drafts, q = input_ids[:, draft_cache.seq_len:], processor.token_counts.clone(), [], []
+            for _ in range(k):
+                logits = draft_model(x, past_key_values=draft_cache, use_cache=True, logits_to_keep=1).logits[:, -1]
+                q.append(processor.probs(logits, draft_counts))
+                x = torch.multinomial(q[-1], num_samples=1)
+                drafts.append(x)
+                draft_counts.scatter_add_(1, x, torch.ones_like(x, dtype=draft_counts.dtype))
+            drafts, q = torch.cat(drafts, dim=1)[0], torch.cat(q, dim=0)  # [k], [k, vocab_size]
+
+            # 2. 目标模型一次前向验证全部草稿，得到k+1个位置的分布
+            x = torch.cat([input_ids[:, target_cache.seq_len:], drafts[None]], dim=1)
+            logits = self(x, past_key_values=target_cache, use_cache=True, logits_to_keep=k + 1).logits[0]
+            # 第i个位置的token计数需要包含d_1..d_i
+            drafted = F.one_hot(drafts, vocab_size).cumsum(0).to(processor.token_counts.dtype)
+            counts = processor.token_counts + torch.cat([torch.zeros_like(drafted[:1]), drafted], dim=0)
+            p = processor.probs(logits, counts)  # [k+1, vocab_size]
+
+            # 3. 拒绝采样：r < p(d)/q(d) 时接受（q(d)>0，因为d就是从q中采样的）
+            idx = torch.arange(k, device=device)
+            accept = torch.rand(k, device=device) * q[idx, drafts] < p[idx, drafts]
+            n = int(accept.cumprod(0).sum())
+            if n < k:
+                residual = (p[n] - q[n]).clamp(min=0)
+                # p与q完全相同时残差为0，此时不会发生拒绝；数值误差下退回p
+                residual = residual if residual.sum() > 0 else p[n]
+                next_token = torch.multinomial(residual / residual.sum(), num_samples=1)
+            else:
+                next_token = torch.multinomial(p[k], num_samples=1)
+            num_drafted, num_accepted = num_drafted + k, num_accepted + n
+
+            new_tokens = torch.cat([drafts[:n], next_token]).tolist()
+            if eos_token_id in new_tokens:
+                new_tokens = new_tokens[:new_tokens.index(eos_token_id) + 1]
+            new_tokens = new_tokens[:max_new_tokens - 1 - input_ids.shape[1]]
+            new_tokens = torch.tensor([new_tokens], dtype=torch.long, device=device)
+            input_ids = torch.cat([input_ids, new_tokens], dim=1)
+            processor.update(new_tokens)
+
+            # 4. 回滚缓存：只保留已接受token的KV，最新的token留到下一轮再送入
+            target_cache.seq_len = input_ids.shape[1] - 1
+            draft_cache.seq_len = min(draft_cache.seq_len, input_ids.shape[1] - 1)
+
+            elapsed = time.time() - start_time
+            self.speculative_stats = {
+                'acceptance_rate': num_accepted / num_drafted,
+                'tokens_per_second': (input_ids.shape[1] - start) / max(elapsed, 1e-9),
+                'num_drafted': num_drafted,
+                'num_accepted': num_accepted,
+            }
+            yield input_ids[:, start:]
+            if new_tokens[0, -1].item() == eos_token_id:
+                break
+
+    def _stream(self, input_ids, eos_token_id, max_new_tokens, sampling, use_cache, past_key_values=None,
+                prefill_chunk_size=None, **args):
         """
         流式生成函数，逐token生成并返回生成器
 
@@ -715,59 +1558,56 @@ class MiniMindLM(PreTrainedModel):
             input_ids: 输入的token ID
             eos_token_id: 结束符token的ID
             max_new_tokens: 最大生成的新token数量
-            temperature: 温度参数，控制随机性
-            top_p: 核采样参数
-            rp: 重复惩罚因子
+            sampling: 采样参数字典，传给LogitsProcessor
             use_cache: 是否使用KV缓存
+            past_key_values: 可选，调用方持有的KV缓存（已缓存之前的对话），input_ids接在缓存的内容之后
+            prefill_chunk_size: 分块预填充的块长度，None表示一次预填充
             **args: 其他参数
 
         返回:
             生成器，每次产出当前已生成的token序列
         """
         # 记录起始位置、是否首次推理和KV缓存
-        start, first_seq, past_kvs = input_ids.shape[1], True, None
+        start, first_seq, past_kvs = input_ids.shape[1], True, past_key_values
+        if use_cache and past_kvs is None:
+            # 按最大长度一次性预分配KV缓存，生成过程中只原地写入
+            past_kvs = KVCache(self.params, input_ids.size(0), max(max_new_tokens, input_ids.shape[1]),
+                               device=input_ids.device, dtype=self.output.weight.dtype)
+        # 按prefill_chunk_size分块预填充；滑动窗口缓存一次最多写入window_size个token
+        chunk_size = prefill_chunk_size or input_ids.shape[1]
+        if isinstance(past_kvs, SinkKVCache):
+            chunk_size = min(chunk_size, past_kvs.window_size)
+        # 每行的采样参数与出现过的token计数，在设备上逐步更新
+        processor = LogitsProcessor(self.vocab_size, input_ids.size(0), input_ids.device, input_ids, **sampling)
         # 循环生成，直到达到最大长度或生成结束符
         while input_ids.shape[1] < max_new_tokens - 1:
-            # 首次推理或不使用缓存时，处理整个序列
-            if first_seq or not use_cache:
-                out, first_seq = self(input_ids, past_key_values=past_kvs, use_cache=use_cache, **args), False
-            # 后续推理且使用缓存时，只处理最新的token
+            # 不使用缓存时，每次处理整个序列
+            if not use_cache:
+                out = self(input_ids, logits_to_keep=1, **args)
+            # 首次推理时，把输入写入缓存
+            elif first_seq:
+                for i in range(0, input_ids.shape[1], chunk_size):
+                    out = self(input_ids[:, i:i + chunk_size], past_key_values=past_kvs, use_cache=True,
+                               logits_to_keep=1, **args)
+                first_seq = False
+            # 后续推理且使用缓存时，只处理最新的token（写入位置由缓存自己维护）
             else:
-                out = self(input_ids[:, -1:], past_key_values=past_kvs, use_cache=use_cache,
-                           start_pos=input_ids.shape[1] - 1, **args)
+                out = self(input_ids[:, -1:], past_key_values=past_kvs, use_cache=True, **args)
             # 获取logits和更新后的KV缓存
             logits, past_kvs = out.logits[:, -1, :], out.past_key_values
 
-            # 重复惩罚：降低已出现token的概率
-            logits[:, list(set(input_ids.tolist()[0]))] /= rp
-            # 应用温度缩放
-            logits /= (temperature + 1e-9)
-
-            # 核采样(Top-p/nucleus sampling)：只保留概率最高的若干token，使其累积概率达到top_p
-            if top_p is not None and top_p < 1.0:
-                # 对logits按降序排序
-                sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
-                # 计算softmax概率
-                sorted_probs = F.softmax(sorted_logits, dim=-1)
-                # 计算累积概率
-                cumulative_probs = torch.cumsum(sorted_probs, dim=-1)
-                # 找出累积概率超过top_p的位置
-                sorted_indices_to_remove = cumulative_probs > top_p
-                # 向右移动一位，保留第一个超过阈值的token
-                sorted_indices_to_remove[:, 1:] = sorted_indices_to_remove[:, :-1].clone()
-                # 确保至少保留概率最高的token
-                sorted_indices_to_remove[:, 0] = False
-                # 将排序后的掩码映射回原始顺序
-                indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
-                # 将被过滤的token概率设为负无穷
-                logits[indices_to_remove] = -float('Inf')
-
-            # 根据处理后的logits进行多项式采样，选择下一个token
-            input_ids_next = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
+            # 应用惩罚、温度缩放与截断采样，选择下一个token
+            input_ids_next = processor.sample(logits).unsqueeze(-1)
+            processor.update(input_ids_next)
             # 将新token添加到序列中
             input_ids = torch.cat((input_ids, input_ids_next), dim=1)
             # 产出当前已生成的序列
             yield input_ids[:, start:]
             # 如果生成了结束符，则停止生成
-            if input_ids_next.item() == eos_token_id:
+            if input_ids_next[0].item() == eos_token_id:
                 break
+        else:
+            # 因长度限制结束时，最后采样的token还没有写入缓存；调用方持有的缓存会接着用于下一轮，
+            # 把它也写入（不计算logits），缓存的内容才与已生成的全部token一致
+            if use_cache and past_key_values is not None and not first_seq:
+                self(input_ids[:, -1:], past_key_values=past_kvs, use_cache=True, logits_to_keep=None, **args)
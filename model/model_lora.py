@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 from torch import optim, nn
 
 
@@ -18,6 +19,11 @@ class LoRA(nn.Module):
         return self.B(self.A(x))
 
 
+def _lora_name(name):
+    """LoRA权重文件中使用的模块名：合并的wqkv上的LoRA只作用于Q的部分，按分开布局中的wq保存，两种布局可以互相加载"""
+    return name[:-len('wqkv')] + 'wq' if name.endswith('wqkv') else name
+
+
 def apply_lora(model, rank=16):
     for name, module in model.named_modules():
         if isinstance(module, nn.Linear) and module.weight.shape[0] == module.weight.shape[1]:
@@ -30,13 +36,24 @@ def apply_lora(model, rank=16):
                 return layer1(x) + layer2(x)
 
             module.forward = forward_with_lora
+        elif isinstance(module, nn.Linear) and name.endswith('wqkv'):
+            # 合并的wqkv：与分开布局一样只在Q（输出的前in_features维）上加LoRA，K/V部分补0
+            lora = LoRA(module.in_features, module.in_features, rank=rank).to(model.device)
+            setattr(module, "lora", lora)
+            original_forward = module.forward
+
+            def forward_with_lora(x, layer1=original_forward, layer2=lora, kv_dim=module.out_features - module.in_features):
+                return layer1(x) + F.pad(layer2(x), (0, kv_dim))
+
+            module.forward = forward_with_lora
 
 
 def load_lora(model, path):
     state_dict = torch.load(path, map_location=model.device)
     for name, module in model.named_modules():
         if hasattr(module, 'lora'):
-            lora_state = {k.replace(f'{name}.lora.', ''): v for k, v in state_dict.items() if f'{name}.lora.' in k}
+            prefix = f'{_lora_name(name)}.lora.'
+            lora_state = {k.replace(prefix, ''): v for k, v in state_dict.items() if prefix in k}
             module.lora.load_state_dict(lora_state)
 
 
@@ -44,6 +61,6 @@ def save_lora(model, path):
     state_dict = {}
     for name, module in model.named_modules():
         if hasattr(module, 'lora'):
-            lora_state = {f'{name}.lora.{k}': v for k, v in module.lora.state_dict().items()}
+            lora_state = {f'{_lora_name(name)}.lora.{k}': v for k, v in module.lora.state_dict().items()}
             state_dict.update(lora_state)
     torch.save(state_dict, path)
@@ -0,0 +1,311 @@
+import math
+import warnings
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from .model import MOEFeedForward
+
+# 需要量化的线性层：Attention中的wq/wk/wv/wo与FeedForward（包括MoE专家）中的w1/w2/w3，以及合并布局中的wqkv/w13
+# 输出层与词嵌入共享权重、MoE门控参数很少，保持原精度
+QUANT_TARGETS = ('wq', 'wk', 'wv', 'wo', 'w1', 'w2', 'w3', 'wqkv', 'w13')
+
+
+# 定义int8权重量化的线性层
+class Int8Linear(nn.Module):
+    """
+    int8权重 + 逐输出通道scale的线性层（对称量化，零点为0）
+
+    权重按 W ≈ weight_int8 * scale[:, None] 存储，显存/内存占用约为fp32的1/4。
+    前向计算：
+    - CPU上且有fbgemm/x86量化后端时，把int8权重预打包后调用int8 GEMM
+      （激活在每次调用时动态量化为8bit），解码时读取的权重字节数只有fp32的1/4；
+    - 其它设备上先把权重反量化到激活的精度，再做普通矩阵乘。
+    """
+    def __init__(self, in_features, out_features):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer('weight', torch.zeros(out_features, in_features, dtype=torch.int8))
+        self.register_buffer('scale', torch.ones(out_features, dtype=torch.float32))
+        # 预打包的int8权重，首次在CPU上前向时生成，权重变化后失效
+        self._packed = None
+
+    @classmethod
+    def from_float(cls, linear: nn.Linear):
+        """逐输出通道取 max|W| / 127 作为scale，把nn.Linear的权重量化为int8"""
+        assert linear.bias is None, "MiniMind的线性层都不带偏置"
+        weight = linear.weight.detach().float()
+        module = cls(linear.in_features, linear.out_features).to(weight.device)
+        scale = (weight.abs().amax(dim=1) / 127).clamp(min=1e-8)
+        module.weight.copy_(torch.round(weight / scale[:, None]).clamp(-127, 127).to(torch.int8))
+        module.scale.copy_(scale)
+        return module
+
+    def dequantize(self):
+        return self.weight.float() * self.scale[:, None]
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        self._packed = None
+
+    def _apply(self, fn, *args, **kwargs):
+        self._packed = None
+        return super()._apply(fn, *args, **kwargs)
+
+    def _packed_weight(self):
+        if self._packed is None:
+            qweight = torch._make_per_channel_quantized_tensor(
+                self.weight, self.scale.double(), torch.zeros_like(self.scale, dtype=torch.long), 0)
+            self._packed = torch.ops.quantized.linear_prepack(qweight, None)
+        return self._packed
+
+    def forward(self, x):
+        if x.device.type == 'cpu' and torch.backends.quantized.engine in ('fbgemm', 'x86'):
+            out = torch.ops.quantized.linear_dynamic(x.float().reshape(-1, self.in_features), self._packed_weight(), True)
+            return out.view(*x.shape[:-1], self.out_features).to(x.dtype)
+        return F.linear(x, self.weight.to(x.dtype)) * self.scale.to(x.dtype)
+
+    def extra_repr(self):
+        return f'in_features={self.in_features}, out_features={self.out_features}'
+
+
+# 定义int4分组量化的线性层
+class Int4Linear(nn.Module):
+    """
+    int4权重 + 分组scale/零点的线性层（非对称量化）
+
+    每个输出通道的权重沿输入维度每group_size个分为一组，组内 W ≈ (q - zero) * scale，q∈[0, 15]。
+    两个int4打包进一个uint8：低4位为组内前半部分的列，高4位为组内后半部分的列，
+    按[n_groups, group_size/2, out_features]存储，内存占用约为fp32的1/8（另加每组的scale与零点）。
+
+    前向时不反量化出完整的权重矩阵，而是逐组计算：
+        y = Σ_g scale_g * (x_g · q_g - zero_g * Σx_g)
+    解包后的int4直接参与分组的批量矩阵乘，scale与零点在乘完之后才作用到[n_groups, N, out]的结果上，
+    省去了在整个权重矩阵上做广播乘加。
+    """
+    def __init__(self, in_features, out_features, group_size=128):
+        super().__init__()
+        assert in_features % group_size == 0 and group_size % 2 == 0, "输入维度需能被group_size整除"
+        self.in_features = in_features
+        self.out_features = out_features
+        self.group_size = group_size
+        n_groups = in_features // group_size
+        self.register_buffer('qweight', torch.zeros(n_groups, group_size // 2, out_features, dtype=torch.uint8))
+        self.register_buffer('scales', torch.ones(n_groups, out_features, dtype=torch.float16))
+        self.register_buffer('zeros', torch.zeros(n_groups, out_features, dtype=torch.uint8))
+
+    @staticmethod
+    def find_params(weight):
+        """按最后一维的最小/最大值计算4bit非对称量化的scale与零点"""
+        w_min = weight.amin(dim=-1).clamp(max=0)
+        w_max = weight.amax(dim=-1).clamp(min=0)
+        scale = ((w_max - w_min) / 15).clamp(min=1e-8)
+        zero = torch.round(-w_min / scale).clamp(0, 15)
+        return scale, zero
+
+    @staticmethod
+    def quantize(weight, scale, zero):
+        return torch.round(weight / scale + zero).clamp(0, 15)
+
+    def pack(self, q, scale, zero):
+        """保存量化结果：q为[out, in]的0~15整数，scale/zero为[out, n_groups]"""
+        q = q.to(torch.uint8).view(self.out_features, -1, 2, self.group_size // 2).permute(1, 2, 3, 0)
+        self.qweight.copy_(q[:, 0] | (q[:, 1] << 4))
+        self.scales.copy_(scale.t())
+        self.zeros.copy_(zero.t())
+
+    @classmethod
+    def from_float(cls, linear: nn.Linear, group_size=128):
+        """逐组取最小/最大值直接取整（RTN），不需要校准数据"""
+        assert linear.bias is None, "MiniMind的线性层都不带偏置"
+        module = cls(linear.in_features, linear.out_features, group_size).to(linear.weight.device)
+        weight = linear.weight.detach().float().view(linear.out_features, -1, group_size)
+        scale, zero = cls.find_params(weight)
+        q = cls.quantize(weight, scale[..., None], zero[..., None])
+        module.pack(q.view(linear.out_features, -1), scale, zero)
+        return module
+
+    def _unpack(self, dtype):
+        """解包为[n_groups, 2, group_size/2, out_features]的0~15整数"""
+        return torch.stack([self.qweight & 0xF, self.qweight >> 4], dim=1).to(dtype)
+
+    def dequantize(self, dtype=torch.float32):
+        w = (self._unpack(dtype) - self.zeros[:, None, None].to(dtype)) * self.scales[:, None, None].to(dtype)
+        return w.reshape(self.in_features, self.out_features).t()
+
+    def forward(self, x):
+        shape, dtype = x.shape, x.dtype
+        # [n_groups, N, 2, group_size/2]：组内前半部分与后半部分分别对应低4位与高4位
+        xg = x.reshape(-1, self.in_features // self.group_size, 2, self.group_size // 2).transpose(0, 1)
+        y = torch.matmul(xg[:, :, 0], (self.qweight & 0xF).to(dtype)) + \
+            torch.matmul(xg[:, :, 1], (self.qweight >> 4).to(dtype))
+        y = (y - xg.sum(dim=(-1, -2))[..., None] * self.zeros[:, None].to(dtype)) * self.scales[:, None].to(dtype)
+        return y.sum(dim=0).view(*shape[:-1], self.out_features)
+
+    def extra_repr(self):
+        return f'in_features={self.in_features}, out_features={self.out_features}, group_size={self.group_size}'
+
+
+def _quant_targets(model):
+    """找出model中需要量化的线性层，返回(完整名称, 父模块, 属性名, 线性层)"""
+    for prefix, module in list(model.named_modules()):
+        for name, child in module.named_children():
+            if name in QUANT_TARGETS and isinstance(child, nn.Linear):
+                yield f"{prefix}.{name}" if prefix else name, module, name, child
+
+
+def quantize_int8(model):
+    """把model中的wq/wk/wv/wo/w1/w2/w3（合并布局中为wqkv/wo/w13/w2）原地替换为Int8Linear（训练后量化，不需要校准数据）"""
+    for _, module, name, linear in _quant_targets(model):
+        setattr(module, name, Int8Linear.from_float(linear))
+    return model
+
+
+@torch.no_grad()
+def gptq_quantize(linear: nn.Linear, H, group_size=128, block_size=128, percdamp=0.01):
+    """
+    GPTQ：按列依次量化权重，并用校准数据的二阶信息把每列的量化误差补偿到尚未量化的列上
+
+    参数:
+        linear: 待量化的线性层
+        H: 该层输入的Hessian 2/n·XᵀX，形状为[in_features, in_features]
+        group_size: 量化分组大小
+        block_size: 分块延迟更新的列数，需为group_size的整数倍
+        percdamp: 加到H对角线上的阻尼（相对对角线均值）
+
+    返回:
+        量化后的Int4Linear
+    """
+    W = linear.weight.detach().float().clone()
+    out_features, in_features = W.shape
+    block_size = max(block_size // group_size, 1) * group_size
+    H = H.clone()
+    # 校准数据中从未激活的输入维度：对应权重不影响输出，直接置零
+    dead = torch.diag(H) == 0
+    H[dead, dead] = 1
+    W[:, dead] = 0
+    H += percdamp * torch.mean(torch.diag(H)) * torch.eye(in_features, device=H.device)
+    # 只需要H⁻¹的上三角Cholesky分解
+    Hinv = torch.linalg.cholesky(torch.cholesky_inverse(torch.linalg.cholesky(H)), upper=True)
+
+    Q = torch.zeros_like(W)
+    scales = torch.zeros(out_features, in_features // group_size, device=W.device)
+    zeros = torch.zeros_like(scales)
+    for i1 in range(0, in_features, block_size):
+        i2 = min(i1 + block_size, in_features)
+        W1, Hinv1 = W[:, i1:i2].clone(), Hinv[i1:i2, i1:i2]
+        Err1 = torch.zeros_like(W1)
+        for i in range(i2 - i1):
+            if (i1 + i) % group_size == 0:
+                # 分组的起始列：用已补偿过误差的权重确定该组的scale与零点
+                g = (i1 + i) // group_size
+                scales[:, g], zeros[:, g] = Int4Linear.find_params(W1[:, i:i + group_size])
+            w, d = W1[:, i], Hinv1[i, i]
+            q = Int4Linear.quantize(w, scales[:, g], zeros[:, g])
+            Q[:, i1 + i] = q
+            err = (w - (q - zeros[:, g]) * scales[:, g]) / d
+            # 把误差按H⁻¹分摊到块内后面的列
+            W1[:, i:] -= err[:, None] * Hinv1[i, i:][None, :]
+            Err1[:, i] = err
+        # 块结束后一次性更新后面所有块
+        W[:, i2:] -= Err1 @ Hinv[i1:i2, i2:]
+
+    module = Int4Linear(in_features, out_features, group_size).to(W.device)
+    module.pack(Q, scales, zeros)
+    return module
+
+
+@torch.no_grad()
+def quantize_int4(model, calib_data=None, group_size=128, percdamp=0.01):
+    """
+    把model中的wq/wk/wv/wo/w1/w2/w3（合并布局中为wqkv/wo/w13/w2）原地替换为Int4Linear
+
+    给出校准数据时逐层使用GPTQ：每个Transformer层先用已量化的前面各层的输出做输入，
+    统计本层各线性层输入的Hessian后量化，再把量化后本层的输出作为下一层的输入，使误差不会逐层累积。
+    不给校准数据时退化为逐组直接取整（RTN）。
+
+    参数:
+        model: MiniMindLM
+        calib_data: 校准样本列表，每个元素为一条不含填充的token ID序列，形状为[seq_len]
+        group_size: 量化分组大小，输入维度不能整除时取两者的最大公约数
+        percdamp: GPTQ的阻尼系数
+    """
+    def layer_group_size(linear):
+        # 输入维度不能被group_size整除时（如FFN的hidden_dim），改用两者的最大公约数
+        return math.gcd(group_size, linear.in_features)
+
+    if not calib_data:
+        for _, module, name, linear in _quant_targets(model):
+            setattr(module, name, Int4Linear.from_float(linear, layer_group_size(linear)))
+        return model
+
+    model.eval()
+    device = model.output.weight.device
+    # 校准时MoE固定按专家排序分发：gather/grouped直接读取堆叠的专家权重、不调用各专家的线性层，
+    # 钩子统计不到这些专家的输入
+    infer_dispatch, MOEFeedForward.INFER_DISPATCH = MOEFeedForward.INFER_DISPATCH, 'sorted'
+    try:
+        _gptq_layers(model, calib_data, device, layer_group_size, percdamp)
+    finally:
+        MOEFeedForward.INFER_DISPATCH = infer_dispatch
+    return model
+
+
+def _gptq_layers(model, calib_data, device, layer_group_size, percdamp):
+    """quantize_int4的GPTQ部分：逐层统计Hessian、量化，并把量化后本层的输出作为下一层的输入"""
+    # 各样本进入第一层的隐藏状态
+    hs = [model.tok_embeddings(x.to(device)[None]) for x in calib_data]
+    for layer_id, layer in enumerate(model.layers):
+        targets = list(_quant_targets(layer))
+        Hs = {full_name: torch.zeros(linear.in_features, linear.in_features, device=device)
+              for full_name, _, _, linear in targets}
+        counts = dict.fromkeys(Hs, 0)
+
+        def add_batch(full_name):
+            def hook(linear, inputs, output):
+                x = inputs[0].reshape(-1, inputs[0].size(-1)).float()
+                n = counts[full_name] + x.size(0)
+                # 累积均值：H = 2/n·Σxxᵀ
+                Hs[full_name].mul_(counts[full_name] / max(n, 1)).add_(x.t() @ x, alpha=2 / max(n, 1))
+                counts[full_name] = n
+            return hook
+
+        handles = [linear.register_forward_hook(add_batch(full_name)) for full_name, _, _, linear in targets]
+        for h in hs:
+            layer(h, model.pos_cis[:h.size(1)])
+        for handle in handles:
+            handle.remove()
+        for full_name, module, name, linear in targets:
+            # 校准数据没有路由到的MoE专家没有统计量，退化为RTN
+            if not counts[full_name]:
+                warnings.warn(f"layers.{layer_id}.{full_name} received no calibration samples, "
+                              "falling back to round-to-nearest")
+            gs = layer_group_size(linear)
+            setattr(module, name, gptq_quantize(linear, Hs[full_name], gs, percdamp=percdamp)
+                    if counts[full_name] else Int4Linear.from_float(linear, gs))
+        # 用量化后的本层计算下一层的输入
+        hs = [layer(h, model.pos_cis[:h.size(1)])[0] for h in hs]
+
+
+def save_quantized(model, path):
+    """保存量化后的权重（量化权重、scale与零点作为buffer一起保存）"""
+    torch.save({k: v for k, v in model.state_dict().items() if 'mask' not in k}, path)
+
+
+def load_quantized(model, path, map_location='cpu'):
+    """
+    直接加载save_quantized保存的量化权重
+
+    model为按同一LMConfig新建的MiniMindLM，state_dict中已量化的线性层会先替换为对应的量化层再加载
+    """
+    state_dict = torch.load(path, map_location=map_location)
+    for full_name, module, name, linear in _quant_targets(model):
+        if f"{full_name}.scale" in state_dict:
+            setattr(module, name, Int8Linear(linear.in_features, linear.out_features))
+        elif f"{full_name}.qweight" in state_dict:
+            group_size = linear.in_features // state_dict[f"{full_name}.scales"].size(0)
+            setattr(module, name, Int4Linear(linear.in_features, linear.out_features, group_size))
+    model.load_state_dict({k: v for k, v in state_dict.items() if 'mask' not in k}, strict=True)
+    return model
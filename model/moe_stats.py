@@ -0,0 +1,151 @@
+import math
+import threading
+
+import torch
+import torch.distributed as dist
+
+from .model import MOEFeedForward
+
+
+class MoELayerStats:
+    """
+    单个MoE层的路由统计，全部在设备上累加，读取（MoERoutingStats.summary）之前不同步主机
+
+    expert_sums[0]: 各专家被选中的次数；expert_sums[1]: 各专家因容量限制丢弃的次数；expert_sums[2]: 各专家门控分数之和
+    token_sums: [门控分布的熵之和, 最大门控分数之和, token数]
+    lock: 更新、读取与清零时持有的锁（推理服务中前向与读取统计在不同线程），MoERoutingStats让所有层共用一个
+    """
+
+    def __init__(self, n_experts: int, lock=None):
+        self.n_experts = n_experts
+        self.expert_sums = None
+        self.token_sums = None
+        self.lock = lock or threading.RLock()
+
+    def _init(self, device):
+        # 在推理模式中创建的张量不能在之后的训练中原地更新，这里在普通模式下创建
+        with torch.inference_mode(False):
+            self.expert_sums = torch.zeros(3, self.n_experts, device=device)
+            self.token_sums = torch.zeros(3, device=device)
+
+    @torch.no_grad()
+    def update(self, scores, topk_idx):
+        """
+        记录一次门控的结果
+
+        参数:
+            scores: 形状为[num_tokens, n_experts]的门控分数（softmax之后）
+            topk_idx: 形状为[num_tokens, top_k]的选中的专家编号
+        """
+        scores = scores.detach().float()
+        counts = topk_idx.flatten().bincount(minlength=self.n_experts)
+        entropy = -(scores * scores.clamp(min=1e-20).log()).sum()
+        token_sums = torch.stack([entropy, scores.max(dim=-1).values.sum()])
+        with self.lock:
+            if self.expert_sums is None:
+                self._init(scores.device)
+            self.expert_sums[0] += counts
+            self.expert_sums[2] += scores.sum(dim=0)
+            self.token_sums[:2] += token_sums
+            self.token_sums[2] += scores.size(0)
+
+    @torch.no_grad()
+    def add_dropped(self, routed, kept):
+        """记录容量限制丢弃的(token, 专家)对，routed/kept为丢弃前后形状为[n_experts]的各专家token数"""
+        with self.lock:
+            if self.expert_sums is not None:
+                self.expert_sums[1] += routed - kept
+
+    def reset(self):
+        with self.lock:
+            if self.expert_sums is not None:
+                self.expert_sums.zero_()
+                self.token_sums.zero_()
+
+
+class MoERoutingStats:
+    """
+    MoE路由统计：为模型的每个MoE层挂上MoELayerStats，按需汇总为各层的专家负载、丢弃率、路由熵等指标
+
+    用法:
+        stats = MoERoutingStats(model)  # 开始统计
+        ...训练或推理...
+        metrics = stats.summary()  # 读取并清零，只在这里同步一次主机
+        stats.remove()  # 停止统计
+
+    指标（以moe/layer{i}/为前缀）:
+        load_expert{j}: 专家j被选中的次数占所有路由的比例
+        score_expert{j}: 专家j的平均门控分数
+        max_load: 最忙的专家的负载相对于均匀分配的倍数，1.0表示完全均衡
+        drop_rate: 因容量限制被丢弃的路由比例
+        entropy: 门控分布的平均熵，除以log(n_experts)归一化到[0, 1]，越小说明路由越确定
+        top1_score: 平均的最大门控分数
+    """
+
+    def __init__(self, model):
+        model = getattr(model, 'module', model)
+        self.layers = {i: layer.feed_forward for i, layer in enumerate(model.layers)
+                       if isinstance(layer.feed_forward, MOEFeedForward)}
+        # 所有层共用一个锁，summary在其它线程读取时看到的是同一时刻各层一致的快照
+        self.lock = threading.RLock()
+        for moe in self.layers.values():
+            moe.gate.stats = MoELayerStats(moe.config.n_routed_experts, self.lock)
+
+    def remove(self):
+        for moe in self.layers.values():
+            moe.gate.stats = None
+
+    def reset(self):
+        with self.lock:
+            for moe in self.layers.values():
+                moe.gate.stats.reset()
+
+    def summary(self, reset: bool = True, all_reduce: bool = False):
+        """
+        汇总上次清零以来的统计
+
+        参数:
+            reset: 读取后清零，下次只统计之后的路由
+            all_reduce: 在默认进程组的所有rank之间求和后再计算（集合操作，所有rank都要调用）
+
+        返回:
+            指标名到数值的字典，可以直接传给wandb.log；还没有任何路由时为空字典
+        """
+        stats = [moe.gate.stats for moe in self.layers.values()]
+        # 在锁内取快照并清零，推理线程在此期间的更新要么全部计入本次、要么全部留给下次
+        with self.lock:
+            if not stats or any(s.expert_sums is None for s in stats):
+                return {}
+            sums = torch.cat([torch.cat([s.expert_sums.flatten(), s.token_sums]) for s in stats])
+            if reset:
+                self.reset()
+        if all_reduce and dist.is_available() and dist.is_initialized():
+            dist.all_reduce(sums)
+        # 所有层的统计一次拷贝到主机
+        sums = sums.tolist()
+        metrics = {}
+        for layer_id, s in zip(self.layers, stats):
+            n = s.n_experts
+            chunk, sums = sums[:3 * n + 3], sums[3 * n + 3:]
+            routed, dropped, score = chunk[:n], chunk[n:2 * n], chunk[2 * n:3 * n]
+            entropy, top1, num_tokens = chunk[3 * n:]
+            total = sum(routed)
+            if total == 0:
+                continue
+            prefix = f'moe/layer{layer_id}/'
+            for j in range(n):
+                metrics[f'{prefix}load_expert{j}'] = routed[j] / total
+                metrics[f'{prefix}score_expert{j}'] = score[j] / num_tokens
+            metrics[f'{prefix}max_load'] = max(routed) * n / total
+            metrics[f'{prefix}drop_rate'] = sum(dropped) / total
+            metrics[f'{prefix}entropy'] = entropy / num_tokens / math.log(n) if n > 1 else 0.0
+            metrics[f'{prefix}top1_score'] = top1 / num_tokens
+        return metrics
+
+    @staticmethod
+    def format(metrics):
+        """把summary的结果整理为一行日志，每层给出最大负载、丢弃率和归一化的路由熵"""
+        layers = sorted({int(k.split('/')[1][len('layer'):]) for k in metrics})
+        return ' | '.join(f"L{i} max_load:{metrics[f'moe/layer{i}/max_load']:.2f} "
+                          f"drop:{metrics[f'moe/layer{i}/drop_rate']:.1%} "
+                          f"entropy:{metrics[f'moe/layer{i}/entropy']:.2f}" for i in layers)
@@ -0,0 +1,86 @@
+import argparse
+import gc
+import os
+import sys
+import time
+
+__package__ = "scripts"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import torch
+from model.LMConfig import LMConfig
+from model.model import MiniMindLM
+
+
+def sync(device):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def train_step(model, x, y, loss_mask):
+    res = model(x, labels=y, loss_mask=loss_mask)
+    loss = (res.token_loss * loss_mask).sum() / loss_mask.sum() + res.aux_loss
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+
+
+def measure(model, batch_size, seq_len, steps, device):
+    """
+    返回(前向保存给反向传播的激活（MB）, 显存峰值（MB，只在CUDA上统计）, 训练一步的平均耗时（秒）)
+
+    保存的激活按存储去重统计；激活检查点内部的激活不保存，也不会计入。
+    """
+    model.train()
+    x = torch.randint(0, model.vocab_size, (batch_size, seq_len), device=device)
+    y = torch.randint(0, model.vocab_size, (batch_size, seq_len), device=device)
+    loss_mask = torch.ones(batch_size, seq_len, device=device)
+    train_step(model, x, y, loss_mask)
+
+    saved = {}
+
+    def pack(t):
+        saved[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        res = model(x, labels=y, loss_mask=loss_mask)
+    del res
+    model.zero_grad(set_to_none=True)
+
+    if device.startswith('cuda'):
+        torch.cuda.reset_peak_memory_stats()
+    sync(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        train_step(model, x, y, loss_mask)
+    sync(device)
+    step_time = (time.perf_counter() - start) / steps
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if device.startswith('cuda') else float('nan')
+    return sum(saved.values()) / 2 ** 20, peak, step_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Activation checkpointing benchmark")
+    # 按dim给出层数：MiniMind2-Small(512, 8层)与MiniMind2(768, 16层)
+    parser.add_argument('--configs', default='512:8,768:16', type=str)
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--seq_len', default=512, type=int)
+    parser.add_argument('--steps', default=3, type=int)
+    parser.add_argument('--use_moe', action='store_true')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    args = parser.parse_args()
+
+    policies = [('none', 1), ('every', 1), ('every_n', 2), ('every_n', 4), ('attention', 1)]
+    print(f"{'config':<10}{'policy':<12}{'saved(MB)':>11}{'peak(MB)':>10}{'ms/step':>10}{'vs none':>9}")
+    for config in args.configs.split(','):
+        dim, n_layers = map(int, config.split(':'))
+        base_time = None
+        for policy, n in policies:
+            torch.manual_seed(0)
+            model = MiniMindLM(LMConfig(dim=dim, n_layers=n_layers, max_seq_len=args.seq_len, use_moe=args.use_moe,
+                                        activation_checkpoint=policy, activation_checkpoint_n=n)).to(args.device)
+            saved, peak, t = measure(model, args.batch_size, args.seq_len, args.steps, args.device)
+            base_time = base_time or t
+            name = f'{policy}/{n}' if policy == 'every_n' else policy
+            print(f"{f'{dim}x{n_layers}':<10}{name:<12}{saved:>11.0f}{peak:>10.0f}{t * 1000:>10.0f}{t / base_time:>8.2f}x")
+            del model
+            gc.collect()
@@ -0,0 +1,69 @@
+import argparse
+import os
+import sys
+import time
+
+__package__ = "scripts"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import torch
+from model.LMConfig import LMConfig
+from model.model import MiniMindBlock, MiniMindLM
+
+
+def timeit(fn, iters, device):
+    """返回每次调用的平均耗时（秒）"""
+    for _ in range(3):
+        fn()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters
+
+
+def build_pair(cls, config, *args):
+    """按分开与合并两种投影布局构建同样权重的模块"""
+    torch.manual_seed(0)
+    split = cls(*args, LMConfig(**{**config.to_dict(), 'fused_proj': False}))
+    fused = cls(*args, LMConfig(**{**config.to_dict(), 'fused_proj': True}))
+    fused.load_state_dict(split.state_dict())
+    return split, fused
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fused wqkv/w13 projection benchmark")
+    parser.add_argument('--dims', default='512,768', type=str)
+    parser.add_argument('--iters', default=50, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    args = parser.parse_args()
+
+    dtypes = [torch.float32] + ([torch.bfloat16] if args.device.startswith('cuda') else [])
+    # (名称, batch_size, seq_len)：单条解码、批量解码、预填充
+    shapes = [('decode', 1, 1), ('decode', 16, 1), ('prefill', 1, 512)]
+
+    # 1. 单层（注意力+FFN）前向，以及整个模型的训练一步（前向+反向）
+    print(f"{'dim':>5} {'dtype':<10}{'shape':<16}{'split(us)':>11}{'fused(us)':>11}{'speedup':>9}")
+    for dim in map(int, args.dims.split(',')):
+        config = LMConfig(dim=dim, n_layers=8, max_seq_len=512)
+        pos_cis = MiniMindLM(config).pos_cis.to(args.device)
+        for dtype in dtypes:
+            split, fused = (m.to(args.device, dtype).eval() for m in build_pair(MiniMindBlock, config, 0))
+            for name, bsz, seq_len in shapes:
+                x = torch.randn(bsz, seq_len, dim, device=args.device, dtype=dtype)
+                cis = pos_cis[:seq_len].to(dtype)
+                with torch.inference_mode():
+                    t_split = timeit(lambda: split(x, cis), args.iters, args.device)
+                    t_fused = timeit(lambda: fused(x, cis), args.iters, args.device)
+                print(f"{dim:>5} {str(dtype).split('.')[-1]:<10}{f'{name} {bsz}x{seq_len}':<16}"
+                      f"{t_split * 1e6:>11.1f}{t_fused * 1e6:>11.1f}{t_split / t_fused:>8.2f}x")
+
+            split, fused = (m.to(args.device, dtype).train() for m in build_pair(MiniMindLM, config))
+            x = torch.randint(0, config.vocab_size, (4, 256), device=args.device)
+            step = lambda model: model(x).logits.float().mean().backward()
+            t_split = timeit(lambda: step(split), max(args.iters // 10, 1), args.device)
+            t_fused = timeit(lambda: step(fused), max(args.iters // 10, 1), args.device)
+            print(f"{dim:>5} {str(dtype).split('.')[-1]:<10}{'train 4x256':<16}"
+                  f"{t_split * 1e6:>11.0f}{t_fused * 1e6:>11.0f}{t_split / t_fused:>8.2f}x")
@@ -0,0 +1,126 @@
+import argparse
+import os
+import sys
+import time
+
+__package__ = "scripts"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import torch
+import torch.nn.functional as F
+from model.LMConfig import LMConfig
+from model.model import MiniMindLM, MOEFeedForward
+
+
+def dispatch_masked(self, x, flat_expert_indices, flat_expert_weights, capacity_factor=None):
+    """原来的训练实现：复制top_k份token，每个专家用布尔掩码在全部token中取出、写回自己的部分（作为对照）"""
+    top_k = self.config.num_experts_per_tok
+    x = x.repeat_interleave(top_k, dim=0)
+    y = torch.empty_like(x, dtype=torch.float16)
+    for i, expert in enumerate(self.experts):
+        y[flat_expert_indices == i] = expert(x[flat_expert_indices == i]).to(y.dtype)
+    y = (y.view(-1, top_k, y.shape[-1]) * flat_expert_weights.view(-1, top_k, 1)).sum(dim=1)
+    return y.to(x.dtype)
+
+
+def sync(device):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def train_step_time(model, batch_size, seq_len, steps, device):
+    """返回前向+反向+优化器更新一步的平均耗时（秒）"""
+    model.train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    x = torch.randint(0, model.vocab_size, (batch_size, seq_len + 1), device=device)
+
+    def step():
+        out = model(x[:, :-1])
+        loss = F.cross_entropy(out.logits.view(-1, out.logits.size(-1)), x[:, 1:].reshape(-1)) + out.aux_loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+    step()
+    sync(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    sync(device)
+    return (time.perf_counter() - start) / steps
+
+
+@torch.inference_mode()
+def decode_latency(model, batch_size, prompt_len, new_tokens, device):
+    """返回贪心解码每步（整个批次生成一个token）的平均耗时（秒），不含预填充"""
+    model.eval()
+    x = torch.randint(1, model.vocab_size, (batch_size, prompt_len), device=device)
+    model.generate(x, max_new_tokens=prompt_len + 3, temperature=0, eos_token_id=-1)
+    sync(device)
+    start = time.perf_counter()
+    model.generate(x, max_new_tokens=prompt_len + 2, temperature=0, eos_token_id=-1)
+    sync(device)
+    prefill = time.perf_counter() - start
+    start = time.perf_counter()
+    model.generate(x, max_new_tokens=prompt_len + new_tokens + 1, temperature=0, eos_token_id=-1)
+    sync(device)
+    return (time.perf_counter() - start - prefill) / (new_tokens - 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MoE dispatch benchmark")
+    parser.add_argument('--dim', default=640, type=int)
+    parser.add_argument('--n_layers', default=8, type=int)
+    parser.add_argument('--batch_size', default=4, type=int)
+    parser.add_argument('--seq_len', default=512, type=int)
+    parser.add_argument('--steps', default=5, type=int)
+    parser.add_argument('--capacity_factor', default=1.25, type=float)
+    # train: 训练一步的耗时；decode: MiniMind2-MoE与稠密MiniMind2的解码延迟
+    parser.add_argument('--bench', default='train', type=str, choices=['train', 'decode'])
+    parser.add_argument('--decode_batch_sizes', default='1,8', type=str)
+    parser.add_argument('--new_tokens', default=64, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    args = parser.parse_args()
+
+    def build(**kwargs):
+        torch.manual_seed(0)
+        return MiniMindLM(LMConfig(dim=args.dim, n_layers=args.n_layers, max_seq_len=args.seq_len,
+                                   **kwargs)).to(args.device)
+
+    if args.bench == 'decode':
+        # MiniMind2-MoE(dim=640, 8层)与稠密MiniMind2(dim=768, 16层)，MoE分别固定为三种推理分发方式和自动选择
+        dense = MiniMindLM(LMConfig(dim=768, n_layers=16)).to(args.device)
+        moe = MiniMindLM(LMConfig(dim=640, n_layers=8, use_moe=True)).to(args.device)
+        print(f"{'decode':<22}{'batch':>6}{'ms/step':>10}{'tokens/s':>10}")
+        for bsz in map(int, args.decode_batch_sizes.split(',')):
+            rows = [('MiniMind2 dense', dense, None)] + \
+                   [(f'MiniMind2-MoE {mode or "auto"}', moe, mode) for mode in ('sorted', 'gather', 'grouped', None)]
+            for name, model, mode in rows:
+                MOEFeedForward.INFER_DISPATCH = mode
+                t = decode_latency(model, bsz, 32, args.new_tokens, args.device)
+                print(f"{name:<22}{bsz:>6}{t * 1000:>10.1f}{bsz / t:>10.1f}")
+        MOEFeedForward.INFER_DISPATCH = None
+        sys.exit(0)
+
+    # 训练一步的耗时：稠密模型与MoE模型（每个专家与稠密FFN同宽，top-2路由，另有1个共享专家）；
+    # MoE每个token经过 top_k + 共享专家数 个FFN，再给出FFN加宽到相同激活计算量的稠密模型作为分发开销的参照
+    dense = build()
+    dense_time = train_step_time(dense, args.batch_size, args.seq_len, args.steps, args.device)
+    moe = build(use_moe=True)
+    active = moe.params.num_experts_per_tok + (1 if moe.params.n_shared_experts else 0)
+    matched = build(hidden_dim=dense.params.hidden_dim * active)
+    dispatch = MOEFeedForward.dispatch
+    rows = [('dense', None, dense_time),
+            (f'dense ffn x{active}', None, train_step_time(matched, args.batch_size, args.seq_len, args.steps,
+                                                           args.device))]
+    MOEFeedForward.dispatch = dispatch_masked
+    rows.append(('moe masked loop', None, train_step_time(moe, args.batch_size, args.seq_len, args.steps, args.device)))
+    MOEFeedForward.dispatch = dispatch
+    rows.append(('moe sorted', None, train_step_time(moe, args.batch_size, args.seq_len, args.steps, args.device)))
+    moe.params.moe_capacity_factor = args.capacity_factor
+    rows.append(('moe sorted', args.capacity_factor,
+                 train_step_time(moe, args.batch_size, args.seq_len, args.steps, args.device)))
+    moe.params.moe_capacity_factor = None
+
+    print(f"{'train step':<18}{'capacity':>10}{'ms/step':>10}{'vs dense':>10}")
+    for name, capacity, t in rows:
+        print(f"{name:<18}{str(capacity or '-'):>10}{t * 1000:>10.0f}{t / dense_time:>9.2f}x")
@@ -0,0 +1,114 @@
+import argparse
+import os
+import sys
+import time
+
+__package__ = "scripts"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import torch
+import model.model as minimind
+from model.LMConfig import LMConfig
+from model.model import MiniMindLM, precompute_pos_cis, apply_rotary_emb
+
+
+def to_complex(pos_cis):
+    """把cos/sin表换成原来实现使用的complex64表，形状为[..., head_dim//2]"""
+    cos, sin = pos_cis.float().chunk(2, dim=-1)
+    return torch.complex(cos[..., ::2], sin[..., 1::2])
+
+
+def apply_rotary_emb_complex(xq, xk, pos_cis):
+    """原来的实现：把Q/K转换为float32复数，乘以complex64的pos_cis后再转换回来（作为对照）"""
+    xq_ = torch.view_as_complex(xq.float().reshape(*xq.shape[:-1], -1, 2))
+    xk_ = torch.view_as_complex(xk.float().reshape(*xk.shape[:-1], -1, 2))
+    shape = (xq_.shape[0], xq_.shape[1], 1, xq_.shape[-1]) if pos_cis.ndim == 3 else (1, xq_.shape[1], 1, xq_.shape[-1])
+    pos_cis = pos_cis.view(*shape)
+    xq_out = torch.view_as_real(xq_ * pos_cis).flatten(3)
+    xk_out = torch.view_as_real(xk_ * pos_cis).flatten(3)
+    return xq_out.type_as(xq), xk_out.type_as(xk)
+
+
+def timeit(fn, iters, device):
+    """返回每次调用的平均耗时（秒）"""
+    for _ in range(3):
+        fn()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters
+
+
+def use_complex_rope(model, enable):
+    """在原来的复数实现与cos/sin实现之间切换整个模型的RoPE"""
+    if enable:
+        model.pos_cis = to_complex(model.pos_cis)
+        minimind.apply_rotary_emb = apply_rotary_emb_complex
+    else:
+        model.pos_cis = model._precompute_pos_cis(model.rope_seq_len, model.rope_ntk_len).to(model.output.weight)
+        minimind.apply_rotary_emb = apply_rotary_emb
+
+
+@torch.inference_mode()
+def model_throughput(model, prompt_len, batch_size, decode_steps, iters, device):
+    """返回(预填充tokens/s, 批量解码tokens/s)"""
+    x = torch.randint(0, model.vocab_size, (batch_size, prompt_len), device=device)
+    prefill = timeit(lambda: model(x[:1]), iters, device)
+    out = model(x, use_cache=True)
+    past = out.past_key_values
+    token = x[:, -1:]
+
+    def decode():
+        for _ in range(decode_steps):
+            model(token, past_key_values=past, use_cache=True, start_pos=prompt_len)
+
+    return prompt_len / prefill, batch_size * decode_steps / timeit(decode, max(iters // 4, 1), device)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="RoPE throughput: complex vs cos/sin implementation")
+    parser.add_argument('--dim', default=512, type=int)
+    parser.add_argument('--n_layers', default=8, type=int)
+    parser.add_argument('--n_heads', default=8, type=int)
+    parser.add_argument('--n_kv_heads', default=2, type=int)
+    parser.add_argument('--prompt_len', default=512, type=int)
+    parser.add_argument('--batch_size', default=16, type=int)
+    parser.add_argument('--iters', default=20, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    args = parser.parse_args()
+
+    head_dim = args.dim // args.n_heads
+    table = precompute_pos_cis(head_dim, end=8192).to(args.device)
+    dtypes = [torch.float32, torch.bfloat16] + ([torch.float16] if args.device.startswith('cuda') else [])
+
+    # 1. 单次RoPE调用：长提示词预填充与批量解码两种典型形状，(名称, batch_size, seq_len, 起始位置)
+    shapes = [('prefill', 1, 2048, 0), ('decode', args.batch_size, 1, 1024)]
+    print(f"{'shape':<10}{'dtype':<10}{'complex(us)':>12}{'cos/sin(us)':>12}{'speedup':>9}{'max err':>10}")
+    for name, bsz, seq_len, start in shapes:
+        for dtype in dtypes:
+            xq = torch.randn(bsz, seq_len, args.n_heads, head_dim, device=args.device, dtype=dtype)
+            xk = torch.randn(bsz, seq_len, args.n_kv_heads, head_dim, device=args.device, dtype=dtype)
+            # 两种实现各自使用缓存好的表：complex64表与模型数据类型的cos/sin表
+            old_table = to_complex(table[start:start + seq_len])
+            new_table = table[start:start + seq_len].to(dtype)
+            t_old = timeit(lambda: apply_rotary_emb_complex(xq, xk, old_table), args.iters * 10, args.device)
+            t_new = timeit(lambda: apply_rotary_emb(xq, xk, new_table), args.iters * 10, args.device)
+            err = (apply_rotary_emb_complex(xq, xk, old_table)[0].float() -
+                   apply_rotary_emb(xq, xk, new_table)[0].float()).abs().max().item()
+            print(f"{name:<10}{str(dtype).split('.')[-1]:<10}{t_old * 1e6:>12.1f}{t_new * 1e6:>12.1f}"
+                  f"{t_old / t_new:>8.2f}x{err:>10.2e}")
+
+    # 2. 整个模型的吞吐量：随机初始化的权重即可，RoPE的开销与权重取值无关
+    model = MiniMindLM(LMConfig(dim=args.dim, n_layers=args.n_layers, n_heads=args.n_heads,
+                                n_kv_heads=args.n_kv_heads, max_seq_len=8192)).eval().to(args.device)
+    print(f"\n{'model':<10}{'dtype':<10}{'rope':<10}{'prefill tok/s':>15}{'decode tok/s':>15}")
+    for dtype in dtypes:
+        model.to(dtype)
+        for name, enable in (('complex', True), ('cos/sin', False)):
+            use_complex_rope(model, enable)
+            prefill, decode = model_throughput(model, args.prompt_len, args.batch_size, 8, args.iters, args.device)
+            print(f"{'':<10}{str(dtype).split('.')[-1]:<10}{name:<10}{prefill:>15.0f}{decode:>15.0f}")
+    use_complex_rope(model, False)
@@ -36,6 +36,15 @@ def convert_transformers2torch(transformers_path, torch_path):
     print(f"模型已保存为 PyTorch 格式: {torch_path}")
 
 
+def convert_proj_layout(torch_path, out_path, fused_proj=True):
+    """把原生torch权重转换为合并(wqkv/w13)或分开(wq/wk/wv/w1/w3)的投影布局，加载时由模型自动合并/拆分"""
+    model = MiniMindLM(LMConfig(**{**lm_config.to_dict(), 'fused_proj': fused_proj}))
+    state_dict = torch.load(torch_path, map_location='cpu')
+    model.load_state_dict({k: v for k, v in state_dict.items() if 'mask' not in k}, strict=True)
+    torch.save(model.state_dict(), out_path)
+    print(f"模型已保存为{'合并' if fused_proj else '分开'}的投影布局: {out_path}")
+
+
 # don't need to use
 def push_to_hf(export_model_path):
     def init_model():
@@ -60,3 +69,6 @@ if __name__ == '__main__':
 
     # # convert transformers to torch model
     # convert_transformers2torch(transformers_path, torch_path)
+
+    # # convert to fused wqkv/w13 projections
+    # convert_proj_layout(torch_path, torch_path.replace('.pth', '_fused.pth'), fused_proj=True)
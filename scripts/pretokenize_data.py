@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+__package__ = "scripts"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+from transformers import AutoTokenizer
+
+tokenizer = None
+
+
+def init_worker(tokenizer_path):
+    global tokenizer
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+
+
+def tokenize(lines):
+    """把一批jsonl行按PretrainDataset的格式（bos + text + eos）分词，返回拼接后的token与每篇文档的长度"""
+    texts = [f"{tokenizer.bos_token}{str(json.loads(line)['text'])}{tokenizer.eos_token}" for line in lines]
+    input_ids = tokenizer(texts).input_ids
+    tokens = np.fromiter((t for ids in input_ids for t in ids), dtype=np.uint16, count=sum(map(len, input_ids)))
+    return tokens, np.array([len(ids) for ids in input_ids], dtype=np.int64)
+
+
+def read_batches(path, batch_size):
+    with open(path, 'r', encoding='utf-8') as f:
+        batch = []
+        for line in f:
+            if line.strip():
+                batch.append(line)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+class ShardWriter:
+    """依次写入{prefix}_{k:04d}.bin/.idx，每个分片超过shard_tokens个token后开始下一个分片（文档不跨分片）"""
+
+    def __init__(self, prefix, shard_tokens):
+        self.prefix, self.shard_tokens = prefix, shard_tokens
+        self.num_shards = 0
+        self.bin = None
+
+    def _open(self):
+        path = f'{self.prefix}_{self.num_shards:04d}'
+        self.bin, self.idx = open(path + '.bin', 'wb'), open(path + '.idx', 'wb')
+        np.zeros(1, dtype=np.int64).tofile(self.idx)
+        self.num_tokens = 0
+        self.num_shards += 1
+
+    def write(self, tokens, lengths):
+        if self.bin is None or self.num_tokens >= self.shard_tokens:
+            self.close()
+            self._open()
+        tokens.tofile(self.bin)
+        (self.num_tokens + np.cumsum(lengths)).tofile(self.idx)
+        self.num_tokens += len(tokens)
+
+    def close(self):
+        if self.bin is not None:
+            self.bin.close()
+            self.idx.close()
+            self.bin = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Tokenize pretrain jsonl into uint16 memmap shards")
+    parser.add_argument('--data_path', default='../dataset/pretrain_hq.jsonl', type=str)
+    parser.add_argument('--out_dir', default='../dataset/pretrain_hq', type=str)
+    parser.add_argument('--tokenizer_path', default='../model/minimind_tokenizer', type=str)
+    # 每个分片的token数上限（uint16，1G个token为2GB）
+    parser.add_argument('--shard_tokens', default=1 << 30, type=int)
+    parser.add_argument('--batch_size', default=1000, type=int)
+    parser.add_argument('--num_workers', default=os.cpu_count(), type=int)
+    args = parser.parse_args()
+
+    vocab_size = len(AutoTokenizer.from_pretrained(args.tokenizer_path))
+    assert vocab_size <= 1 << 16, f"uint16 shards need vocab_size <= 65536, got {vocab_size}"
+    os.makedirs(args.out_dir, exist_ok=True)
+    prefix = os.path.join(args.out_dir, os.path.splitext(os.path.basename(args.data_path))[0])
+    writer = ShardWriter(prefix, args.shard_tokens)
+
+    start = time.time()
+    num_docs = num_tokens = 0
+    with Pool(args.num_workers, initializer=init_worker, initargs=(args.tokenizer_path,)) as pool:
+        # imap保持文档顺序
+        for tokens, lengths in pool.imap(tokenize, read_batches(args.data_path, args.batch_size)):
+            writer.write(tokens, lengths)
+            num_docs += len(lengths)
+            num_tokens += len(tokens)
+    writer.close()
+    print(f"{num_docs} documents, {num_tokens} tokens -> {writer.num_shards} shards in {args.out_dir} "
+          f"({time.time() - start:.1f}s)")
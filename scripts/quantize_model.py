@@ -0,0 +1,104 @@
+import argparse
+import copy
+import os
+import sys
+import time
+
+__package__ = "scripts"
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import torch
+import warnings
+from torch.utils.data import DataLoader, Subset
+from transformers import AutoTokenizer
+from model.LMConfig import LMConfig
+from model.model import MiniMindLM
+from model.dataset import PretrainDataset
+from model.model_quant import quantize_int8, quantize_int4, save_quantized
+
+warnings.filterwarnings('ignore')
+
+
+@torch.no_grad()
+def eval_perplexity(model, loader):
+    """在预训练数据上计算逐token的困惑度"""
+    total_loss, total_tokens = 0.0, 0
+    for X, Y, loss_mask in loader:
+        # 分块计算目标token的对数概率，不生成整段序列的logits
+        loss = -model.token_log_probs(X, Y)
+        total_loss += (loss * loss_mask).sum().item()
+        total_tokens += loss_mask.sum().item()
+    return torch.exp(torch.tensor(total_loss / total_tokens)).item()
+
+
+@torch.no_grad()
+def eval_speed(model, input_ids, max_new_tokens):
+    """批大小为1、贪心解码时的生成速度（tokens/s）"""
+    model.generate(input_ids, max_new_tokens=input_ids.shape[1] + 8, temperature=0, eos_token_id=-1)
+    start = time.time()
+    out = model.generate(input_ids, max_new_tokens=input_ids.shape[1] + max_new_tokens + 1,
+                         temperature=0, eos_token_id=-1)
+    return (out.shape[1] - input_ids.shape[1]) / (time.time() - start)
+
+
+def model_size(model):
+    # 词嵌入与输出层共享权重，只统计一次
+    tensors = {t.data_ptr(): t for t in model.state_dict().values()}
+    return sum(t.numel() * t.element_size() for t in tensors.values()) / 1024 ** 2
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MiniMind weight quantization")
+    parser.add_argument('--out_dir', default='out', type=str)
+    parser.add_argument('--dim', default=512, type=int)
+    parser.add_argument('--n_layers', default=8, type=int)
+    parser.add_argument('--use_moe', default=False, type=bool)
+    parser.add_argument('--model_mode', default=1, type=int, help="0: 预训练模型，1: SFT-Chat模型，2: RLHF-Chat模型，3: Reason模型")
+    # int8：逐通道量化，适合CPU推理；int4：分组量化+GPTQ误差补偿，内存约为fp32的1/7
+    parser.add_argument('--quant', default='int8', type=str, choices=['int8', 'int4'])
+    parser.add_argument('--group_size', default=128, type=int)
+    # int4量化的校准样本（取自data_path的末尾，与困惑度评估的样本不重叠），为0时不校准、直接取整
+    parser.add_argument('--calib_samples', default=128, type=int)
+    # 困惑度评估使用的数据与样本数
+    parser.add_argument('--data_path', default='../dataset/pretrain_hq.jsonl', type=str)
+    parser.add_argument('--num_samples', default=256, type=int)
+    parser.add_argument('--max_seq_len', default=512, type=int)
+    # 生成速度评估的输出长度与CPU线程数
+    parser.add_argument('--speed_tokens', default=256, type=int)
+    parser.add_argument('--num_threads', default=torch.get_num_threads(), type=int)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.num_threads)
+    moe_path = '_moe' if args.use_moe else ''
+    modes = {0: 'pretrain', 1: 'full_sft', 2: 'rlhf', 3: 'reason', 4: 'grpo'}
+    ckp = f'../{args.out_dir}/{modes[args.model_mode]}_{args.dim}{moe_path}.pth'
+    model = MiniMindLM(LMConfig(dim=args.dim, n_layers=args.n_layers, max_seq_len=8192, use_moe=args.use_moe))
+    state_dict = torch.load(ckp, map_location='cpu')
+    model.load_state_dict({k: v for k, v in state_dict.items() if 'mask' not in k}, strict=True)
+    model.eval()
+
+    tokenizer = AutoTokenizer.from_pretrained('../model/minimind_tokenizer')
+    dataset = PretrainDataset(args.data_path, tokenizer, max_length=args.max_seq_len)
+    loader = DataLoader(Subset(dataset, range(min(args.num_samples, len(dataset)))), batch_size=8)
+    prompt = tokenizer(tokenizer.bos_token + '请介绍一下自己。', return_tensors='pt').input_ids
+
+    # 量化并保存，之后eval_model.py / serve_openai_api.py可以用 --quant int8/int4 直接加载
+    start = time.time()
+    if args.quant == 'int8':
+        qmodel = quantize_int8(copy.deepcopy(model))
+    else:
+        calib_data = []
+        for i in range(max(len(dataset) - args.calib_samples, 0), len(dataset)):
+            X, _, loss_mask = dataset[i]
+            # 去掉右侧的填充
+            calib_data.append(X[:max(int(loss_mask.sum()), 1)])
+        qmodel = quantize_int4(copy.deepcopy(model), calib_data, group_size=args.group_size)
+    quant_path = ckp.replace('.pth', f'_{args.quant}.pth')
+    save_quantized(qmodel, quant_path)
+    print(f"量化用时{time.time() - start:.1f}s，量化权重已保存到 {quant_path}")
+
+    # 困惑度-速度对比报告
+    print(f"{'model':<8}{'size(MB)':>10}{'ppl':>10}{'tokens/s':>10}")
+    for name, m in (('fp32', model), (args.quant, qmodel)):
+        ppl = eval_perplexity(m, loader)
+        speed = eval_speed(m, prompt, args.speed_tokens)
+        print(f"{name:<8}{model_size(m):>10.1f}{ppl:>10.3f}{speed:>10.1f}")
@@ -10,34 +10,54 @@ import torch
 import warnings
 import uvicorn
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from model.LMConfig import LMConfig
 from model.model import MiniMindLM
 from model.model_lora import apply_lora, load_lora
+from model.model_quant import load_quantized
+from model.engine import InferenceEngine, GenerationRequest
+from model.kv_cache import KVCache
+from model.moe_stats import MoERoutingStats
 
 warnings.filterwarnings('ignore')
 
 app = FastAPI()
 
 
+def rope_scaling(args):
+    """命令行参数对应的RoPE长度外推配置"""
+    if args.rope_scaling == 'none':
+        return None
+    return {'type': args.rope_scaling, 'factor': args.rope_factor,
+            'original_max_position_embeddings': args.rope_original_max_len}
+
+
 def init_model(args):
     tokenizer = AutoTokenizer.from_pretrained('../model/minimind_tokenizer')
     if args.load == 0:
         moe_path = '_moe' if args.use_moe else ''
         modes = {0: 'pretrain', 1: 'full_sft', 2: 'rlhf', 3: 'reason'}
-        ckp = f'../{args.out_dir}/{modes[args.model_mode]}_{args.dim}{moe_path}.pth'
+        quant_path = f'_{args.quant}' if args.quant != 'none' else ''
+        ckp = f'../{args.out_dir}/{modes[args.model_mode]}_{args.dim}{moe_path}{quant_path}.pth'
 
         model = MiniMindLM(LMConfig(
             dim=args.dim,
             n_layers=args.n_layers,
             max_seq_len=args.max_seq_len,
-            use_moe=args.use_moe
+            use_moe=args.use_moe,
+            rope_scaling=rope_scaling(args),
+            fused_proj=args.fused_proj
         ))
 
-        state_dict = torch.load(ckp, map_location=device)
-        model.load_state_dict({k: v for k, v in state_dict.items() if 'mask' not in k}, strict=True)
+        if args.quant != 'none':
+            # 由scripts/quantize_model.py生成的量化权重
+            load_quantized(model, ckp, map_location=device)
+        else:
+            state_dict = torch.load(ckp, map_location=device)
+            model.load_state_dict({k: v for k, v in state_dict.items() if 'mask' not in k}, strict=True)
 
         if args.lora_name != 'None':
             apply_lora(model)
@@ -58,39 +78,51 @@ class ChatRequest(BaseModel):
     top_p: float = 0.92
     max_tokens: int = 8192
     stream: bool = False
-
-
-def generate_stream_response(messages, temperature, top_p, max_tokens):
+    presence_penalty: float = 0.0
+    frequency_penalty: float = 0.0
+    # 以下为OpenAI接口之外的扩展采样参数
+    top_k: int = 0
+    min_p: float = 0.0
+    repetition_penalty: float = 1.0
+
+    def sampling_params(self):
+        return {name: getattr(self, name) for name in (
+            'temperature', 'top_p', 'top_k', 'min_p', 'repetition_penalty', 'presence_penalty', 'frequency_penalty')}
+
+
+def submit_request(messages, max_tokens, **sampling):
+    """构建提示词并提交到推理引擎，返回请求对象；sampling为各项采样参数"""
+    new_prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)[-max_tokens:]
+    x = tokenizer(new_prompt).data['input_ids']
+    return engine.submit(GenerationRequest(
+        x,
+        max_new_tokens=max_tokens,
+        eos_token_id=tokenizer.eos_token_id,
+        **sampling
+    ))
+
+
+def generate_stream_response(messages, max_tokens, **sampling):
     try:
-        new_prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)[-max_tokens:]
-        x = tokenizer(new_prompt).data['input_ids']
-        x = (torch.tensor(x, dtype=torch.long, device=device)[None, ...])
-        with torch.no_grad():
-            res_y = model.generate(
-                x,
-                eos_token_id=tokenizer.eos_token_id,
-                max_new_tokens=max_tokens,
-                temperature=temperature,
-                top_p=top_p,
-                stream=True,
-                rp=1.,
-                pad_token_id=tokenizer.pad_token_id
-            )
-            history_idx = 0
-            for y in res_y:
-                answer = tokenizer.decode(y[0].tolist(), skip_special_tokens=True)
-                if (answer and answer[-1] == '�') or not answer:
-                    continue
-                delta = answer[history_idx:]
-                history_idx = len(answer)
-                json_data = {
-                    'id': f'chatcmpl-{int(time.time())}',
-                    'object': 'chat.completion.chunk',
-                    'created': int(time.time()),
-                    'model': 'minimind',
-                    'choices': [{'index': 0, 'delta': {'content': delta}, 'finish_reason': None}]
-                }
-                yield f"data: {json.dumps(json_data)}\n\n"
+        request = submit_request(messages, max_tokens, **sampling)
+        # 同步生成器由StreamingResponse放到线程池中迭代，等待新token时不会阻塞事件循环
+        history_idx = 0
+        output_ids = []
+        for token in request:
+            output_ids.append(token)
+            answer = tokenizer.decode(output_ids, skip_special_tokens=True)
+            if (answer and answer[-1] == '�') or not answer:
+                continue
+            delta = answer[history_idx:]
+            history_idx = len(answer)
+            json_data = {
+                'id': f'chatcmpl-{int(time.time())}',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': 'minimind',
+                'choices': [{'index': 0, 'delta': {'content': delta}, 'finish_reason': None}]
+            }
+            yield f"data: {json.dumps(json_data)}\n\n"
 
     except Exception as e:
         yield f"data: {json.dumps({'error': str(e)})}\n\n"
@@ -103,32 +135,16 @@ async def chat_completions(request: ChatRequest):
             return StreamingResponse(
                 generate_stream_response(
                     messages=request.messages,
-                    temperature=request.temperature,
-                    top_p=request.top_p,
-                    max_tokens=request.max_tokens
+                    max_tokens=request.max_tokens,
+                    **request.sampling_params()
                 ),
                 media_type="text/event-stream"
             )
         else:
-            new_prompt = tokenizer.apply_chat_template(
-                request.messages,
-                tokenize=False,
-                add_generation_prompt=True
-            )[-request.max_tokens:]
-            x = tokenizer(new_prompt).data['input_ids']
-            x = (torch.tensor(x, dtype=torch.long, device=device)[None, ...])
-            with torch.no_grad():
-                res_y = model.generate(
-                    x,
-                    eos_token_id=tokenizer.eos_token_id,
-                    max_new_tokens=request.max_tokens,
-                    temperature=request.temperature,
-                    top_p=request.top_p,
-                    stream=False,
-                    rp=1.,
-                    pad_token_id=tokenizer.pad_token_id
-                )
-                answer = tokenizer.decode(res_y.squeeze()[x.shape[1]:].tolist(), skip_special_tokens=True)
+            gen_request = submit_request(request.messages, request.max_tokens, **request.sampling_params())
+            # 在线程池中等待生成结束，其它请求可以同时进入引擎的解码批次
+            output_ids = await run_in_threadpool(gen_request.result)
+            answer = tokenizer.decode(output_ids, skip_special_tokens=True)
             return {
                 "id": f"chatcmpl-{int(time.time())}",
                 "object": "chat.completion",
@@ -138,7 +154,7 @@ async def chat_completions(request: ChatRequest):
                     {
                         "index": 0,
                         "message": {"role": "assistant", "content": answer},
-                        "finish_reason": "stop"
+                        "finish_reason": gen_request.finish_reason
                     }
                 ]
             }
@@ -147,6 +163,14 @@ async def chat_completions(request: ChatRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/v1/moe_stats")
+async def get_moe_stats(reset: bool = False):
+    """MoE路由统计：服务启动（或上次reset）以来各层的专家负载、丢弃率、路由熵与门控分数"""
+    if moe_stats is None:
+        raise HTTPException(status_code=404, detail="未开启MoE路由统计（需要--use_moe与--moe_stats）")
+    return moe_stats.summary(reset=reset)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Server for MiniMind")
     parser.add_argument('--out_dir', default='out', type=str)
@@ -155,10 +179,42 @@ if __name__ == "__main__":
     parser.add_argument('--n_layers', default=8, type=int)
     parser.add_argument('--max_seq_len', default=8192, type=int)
     parser.add_argument('--use_moe', default=False, type=bool)
+    # RoPE长度外推（dynamic: 动态NTK，yarn: YaRN），让按rope_original_max_len训练的权重支持更长的上下文
+    parser.add_argument('--rope_scaling', default='none', type=str, choices=['none', 'dynamic', 'yarn'])
+    parser.add_argument('--rope_factor', default=4.0, type=float)
+    parser.add_argument('--rope_original_max_len', default=512, type=int)
+    # 合并投影层（wqkv/w13），按原布局保存的权重加载时自动合并
+    parser.add_argument('--fused_proj', action='store_true')
+    # 加载量化权重（先用quantize_model.py转换），int8适合在CPU上部署，int4内存占用最小
+    parser.add_argument('--quant', default='none', type=str, choices=['none', 'int8', 'int4'])
     parser.add_argument('--load', default=0, type=int, help="0: 从原生torch权重，1: 利用transformers加载")
     parser.add_argument('--model_mode', default=1, type=int, help="0: 预训练模型，1: SFT-Chat模型，2: RLHF-Chat模型，3: Reason模型")
+    # 连续批处理中同时解码的最大请求数
+    parser.add_argument('--max_batch_size', default=8, type=int)
+    # 分页KV缓存的块数与块大小：缓存的显存预算为 kv_cache_blocks * kv_block_size 个token，由所有请求共享
+    parser.add_argument('--kv_cache_blocks', default=1024, type=int)
+    parser.add_argument('--kv_block_size', default=16, type=int)
+    # KV缓存的存储格式：int8/fp8按(token, head)量化，相同内存下可容纳约4倍（相对fp32）的token
+    parser.add_argument('--kv_cache_dtype', default=None, type=str, choices=['int8', 'fp8'])
+    # 关闭前缀缓存（默认开启：相同的system提示词和多轮对话历史只预填充一次）
+    parser.add_argument('--disable_prefix_cache', action='store_true')
+    # 分块预填充：每步最多预填充的提示词token数，之后让其它请求解码一步，避免长提示词阻塞所有流；0为一次预填充
+    parser.add_argument('--prefill_chunk_size', default=512, type=int)
+    # 记录MoE路由统计，通过GET /v1/moe_stats查看
+    parser.add_argument('--moe_stats', action='store_true')
+    args = parser.parse_args()
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    model, tokenizer = init_model(parser.parse_args())
+    model, tokenizer = init_model(args)
+    model.params.kv_cache_dtype = args.kv_cache_dtype
+    moe_stats = MoERoutingStats(model) if args.use_moe and args.moe_stats else None
+    # 所有请求共享同一个后台推理引擎
+    engine = InferenceEngine(model, max_batch_size=args.max_batch_size, max_seq_len=args.max_seq_len,
+                             num_blocks=args.kv_cache_blocks, block_size=args.kv_block_size,
+                             enable_prefix_cache=not args.disable_prefix_cache,
+                             prefill_chunk_size=args.prefill_chunk_size or None).start()
+    cache_tokens = args.kv_cache_blocks * args.kv_block_size
+    cache_mb = cache_tokens * KVCache.bytes_per_token(model.params, model.output.weight.dtype) / 1024 ** 2
+    print(f'KV缓存({args.kv_cache_dtype or model.output.weight.dtype}): {cache_tokens} tokens, {cache_mb:.1f}MB')
 
     uvicorn.run(app, host="0.0.0.0", port=8998)
@@ -37,7 +37,6 @@ def train_epoch(epoch, wandb):
     end_of_think_ids = tokenizer('</think>').input_ids
     start_of_answer_ids = tokenizer('<answer>').input_ids
     end_of_answer_ids = tokenizer('</answer>').input_ids
-    loss_fct = nn.CrossEntropyLoss(reduction='none')
     start_time = time.time()
     for step, (X, Y, loss_mask) in enumerate(train_loader):
         X = X.to(args.device)
@@ -48,11 +47,6 @@ def train_epoch(epoch, wandb):
             param_group['lr'] = lr
 
         with ctx:
-            res = model(X)
-            loss = loss_fct(
-                res.logits.view(-1, res.logits.size(-1)),
-                Y.view(-1)
-            ).view(Y.size())
             sp_ids = torch.isin(Y.view(-1),
                                 torch.tensor(start_of_think_ids + end_of_think_ids
                                              + start_of_answer_ids + end_of_answer_ids
@@ -62,7 +56,8 @@ def train_epoch(epoch, wandb):
             loss_mask_sum = loss_mask.sum()
             loss_mask[sp_ids] = 10
             loss_mask = loss_mask.view(Y.size())
-            loss = (loss * loss_mask).sum() / loss_mask_sum
+            res = model(X, labels=Y, loss_mask=loss_mask)
+            loss = (res.token_loss * loss_mask).sum() / loss_mask_sum
             loss += res.aux_loss
             loss = loss / args.accumulation_steps
 
@@ -154,11 +149,15 @@ if __name__ == "__main__":
     parser.add_argument('--n_layers', default=8, type=int)
     parser.add_argument('--max_seq_len', default=1024, type=int)
     parser.add_argument('--use_moe', default=False, type=bool)
+    # 激活检查点：none/every（每个块）/every_n（每activation_checkpoint_n层一个块）/attention（只有注意力子层）
+    parser.add_argument('--activation_checkpoint', default='none', type=str, choices=['none', 'every', 'every_n', 'attention'])
+    parser.add_argument('--activation_checkpoint_n', default=2, type=int)
     parser.add_argument("--data_path", type=str, default="./dataset/r1_mix_1024.jsonl")
 
     args = parser.parse_args()
 
-    lm_config = LMConfig(dim=args.dim, n_layers=args.n_layers, max_seq_len=args.max_seq_len, use_moe=args.use_moe)
+    lm_config = LMConfig(dim=args.dim, n_layers=args.n_layers, max_seq_len=args.max_seq_len, use_moe=args.use_moe,
+                         activation_checkpoint=args.activation_checkpoint, activation_checkpoint_n=args.activation_checkpoint_n)
     args.save_dir = os.path.join(args.out_dir)
     os.makedirs(args.save_dir, exist_ok=True)
     os.makedirs(args.out_dir, exist_ok=True)
@@ -199,10 +199,15 @@ if __name__ == "__main__":
     parser.add_argument("--save_interval", type=int, default=100)
     parser.add_argument('--local_rank', type=int, default=-1)
     parser.add_argument("--data_path", type=str, default="./dataset/sft_data.jsonl")
+    # 激活检查点：none/every（每个块）/every_n（每activation_checkpoint_n层一个块）/attention（只有注意力子层）
+    parser.add_argument('--activation_checkpoint', default='none', type=str, choices=['none', 'every', 'every_n', 'attention'])
+    parser.add_argument('--activation_checkpoint_n', default=2, type=int)
 
     args = parser.parse_args()
     # 定义学生模型和教师模型
-    lm_config_student = LMConfig(dim=512, n_layers=8, max_seq_len=512)
+    # 激活检查点只作用于学生模型（教师模型不计算梯度）
+    lm_config_student = LMConfig(dim=512, n_layers=8, max_seq_len=512, activation_checkpoint=args.activation_checkpoint,
+                                 activation_checkpoint_n=args.activation_checkpoint_n)
     lm_config_teacher = LMConfig(dim=768, n_layers=16, max_seq_len=512)
     max_seq_len = lm_config_student.max_seq_len
     args.save_dir = os.path.join(args.out_dir)
@@ -217,12 +217,16 @@ if __name__ == "__main__":
     parser.add_argument('--n_layers', default=8, type=int)
     parser.add_argument('--max_seq_len', default=1024, type=int)
     parser.add_argument('--use_moe', default=False, type=bool)
+    # 激活检查点：none/every（每个块）/every_n（每activation_checkpoint_n层一个块）/attention（只有注意力子层）
+    parser.add_argument('--activation_checkpoint', default='none', type=str, choices=['none', 'every', 'every_n', 'attention'])
+    parser.add_argument('--activation_checkpoint_n', default=2, type=int)
     parser.add_argument("--data_path", type=str, default="./dataset/dpo.jsonl")
 
     args = parser.parse_args()
 
     # 构造模型配置并准备输出目录
-    lm_config = LMConfig(dim=args.dim, n_layers=args.n_layers, max_seq_len=args.max_seq_len, use_moe=args.use_moe)
+    lm_config = LMConfig(dim=args.dim, n_layers=args.n_layers, max_seq_len=args.max_seq_len, use_moe=args.use_moe,
+                         activation_checkpoint=args.activation_checkpoint, activation_checkpoint_n=args.activation_checkpoint_n)
     args.save_dir = os.path.join(args.out_dir)
     os.makedirs(args.save_dir, exist_ok=True)
     os.makedirs(args.out_dir, exist_ok=True)
@@ -16,7 +16,8 @@ from torch import optim, nn  # 优化器和神经网络模块
 from torch.nn.parallel import DistributedDataParallel  # 分布式数据并行训练
 from torch.utils.data import DataLoader, DistributedSampler  # 数据加载器
 from transformers import AutoTokenizer, AutoModelForCausalLM  # Hugging Face transformers库
-from model.model import MiniMindLM  # 自定义的MiniMind语言模型
+from model.model import MiniMindLM, clip_grad_norm_  # 自定义的MiniMind语言模型
+from model.moe_stats import MoERoutingStats  # MoE路由统计
 from model.LMConfig import LMConfig  # 语言模型配置
 from model.dataset import SFTDataset  # SFT数据集类
 
@@ -38,8 +39,6 @@ def get_lr(current_step, total_steps, lr):
 
 # 训练一个完整的epoch
 def train_epoch(epoch, wandb):
-    # 定义损失函数：交叉熵损失，不进行reduction以便后续使用loss_mask
-    loss_fct = nn.CrossEntropyLoss(reduction='none')
     start_time = time.time()
     # 遍历数据加载器中的每个批次
     for step, (X, Y, loss_mask) in enumerate(train_loader):
@@ -55,16 +54,11 @@ def train_epoch(epoch, wandb):
 
         # 使用自动混合精度上下文（在GPU上可加速训练并减少内存使用）
         with ctx:
-            # 前向传播
-            res = model(X)
-            # 计算损失：预测logits与目标标签之间的交叉熵
-            loss = loss_fct(
-                res.logits.view(-1, res.logits.size(-1)),  # 将logits展平
-                Y.view(-1)  # 将目标标签展平
-            ).view(Y.size())
+            # 前向传播：给出目标标签时模型分块计算逐token的交叉熵（跳过loss_mask为0的位置），不生成完整的logits
+            res = model(X, labels=Y, loss_mask=loss_mask)
 
             # 应用损失掩码并计算平均损失
-            loss = (loss * loss_mask).sum() / loss_mask.sum()
+            loss = (res.token_loss * loss_mask).sum() / loss_mask.sum()
             # 添加辅助损失（如果有的话，例如MoE的负载均衡损失）
             loss += res.aux_loss
             # 如果使用梯度累积，则将损失除以累积步数
@@ -78,7 +72,7 @@ def train_epoch(epoch, wandb):
             # 将梯度从FP16反缩放回FP32
             scaler.unscale_(optimizer)
             # 梯度裁剪，防止梯度爆炸
-            torch.nn.utils.clip_grad_norm_(model.parameters(), args.grad_clip)
+            clip_grad_norm_(model, args.grad_clip)
 
             # 使用优化器更新模型参数
             scaler.step(optimizer)
@@ -91,6 +85,8 @@ def train_epoch(epoch, wandb):
         # 定期打印训练日志
         if step % args.log_interval == 0:
             spend_time = time.time() - start_time
+            # MoE路由统计在设备上累加，这里汇总所有进程的统计并清零（只在日志步同步一次）
+            moe_metrics = moe_stats.summary(all_reduce=ddp) if moe_stats is not None else {}
             Logger(
                 'Epoch:[{}/{}]({}/{}) loss:{:.3f} lr:{:.12f} epoch_Time:{}min:'.format(
                     epoch + 1,
@@ -100,15 +96,18 @@ def train_epoch(epoch, wandb):
                     loss.item(),
                     optimizer.param_groups[-1]['lr'],
                     spend_time / (step + 1) * iter_per_epoch // 60 - spend_time // 60))
+            if moe_metrics:
+                Logger(f'MoE路由: {MoERoutingStats.format(moe_metrics)}')
 
             # 如果启用了wandb且是主进程，则记录指标
             if (wandb is not None) and (not ddp or dist.get_rank() == 0):
                 wandb.log({"loss": loss,
                            "lr": optimizer.param_groups[-1]['lr'],
-                           "epoch_Time": spend_time / (step + 1) * iter_per_epoch // 60 - spend_time // 60})
+                           "epoch_Time": spend_time / (step + 1) * iter_per_epoch // 60 - spend_time // 60,
+                           **moe_metrics})
 
-        # 定期保存模型检查点
-        if (step + 1) % args.save_interval == 0 and (not ddp or dist.get_rank() == 0):
+        # 定期保存模型检查点（专家并行时所有进程一起收集各自的专家，由主进程保存完整的权重）
+        if (step + 1) % args.save_interval == 0 and (not ddp or dist.get_rank() == 0 or lm_config.expert_parallel):
             model.eval()  # 切换到评估模式
             # 根据是否使用MoE（混合专家模型）设置文件名
             moe_path = '_moe' if lm_config.use_moe else ''
@@ -116,12 +115,13 @@ def train_epoch(epoch, wandb):
 
             # 获取模型状态字典（对于DDP模型需要获取.module属性）
             if isinstance(model, torch.nn.parallel.DistributedDataParallel):
-                state_dict = model.module.state_dict()
+                state_dict = model.module.full_state_dict()
             else:
                 state_dict = model.state_dict()
 
             # 保存模型权重
-            torch.save(state_dict, ckp)
+            if not ddp or dist.get_rank() == 0:
+                torch.save(state_dict, ckp)
             model.train()  # 切换回训练模式
 
 
@@ -151,14 +151,17 @@ def init_distributed_mode():
     if not ddp: return  # 如果不是分布式训练则直接返回
     global ddp_local_rank, DEVICE
 
-    # 初始化分布式进程组，使用NCCL后端（适用于GPU训练）
-    dist.init_process_group(backend="nccl")
+    # 初始化分布式进程组，使用NCCL后端（适用于GPU训练）；没有GPU时使用gloo后端在CPU上训练
+    dist.init_process_group(backend="nccl" if torch.cuda.is_available() else "gloo")
     # 获取当前进程的全局排名
     ddp_rank = int(os.environ["RANK"])
     # 获取当前进程在本机的局部排名
     ddp_local_rank = int(os.environ["LOCAL_RANK"])
     # 获取总进程数
     ddp_world_size = int(os.environ["WORLD_SIZE"])
+    if not torch.cuda.is_available():
+        DEVICE = "cpu"
+        return
     # 设置当前进程使用的GPU设备
     DEVICE = f"cuda:{ddp_local_rank}"
     torch.cuda.set_device(DEVICE)
@@ -208,6 +211,15 @@ if __name__ == "__main__":
     parser.add_argument('--max_seq_len', default=512, type=int)
     # 是否使用混合专家模型(MoE)
     parser.add_argument('--use_moe', default=False, type=bool)
+    # 专家并行（需DDP启动）：路由专家分片到各个进程，token用all-to-all交换
+    parser.add_argument('--expert_parallel', action='store_true')
+    # 记录MoE路由统计（各层专家负载、丢弃率、路由熵），每log_interval步打印并写入wandb
+    parser.add_argument('--moe_stats', action='store_true')
+    # 合并投影层（wqkv/w13），按原布局保存的权重加载时自动合并
+    parser.add_argument('--fused_proj', action='store_true')
+    # 激活检查点：none/every（每个块）/every_n（每activation_checkpoint_n层一个块）/attention（只有注意力子层）
+    parser.add_argument('--activation_checkpoint', default='none', type=str, choices=['none', 'every', 'every_n', 'attention'])
+    parser.add_argument('--activation_checkpoint_n', default=2, type=int)
     # 训练数据路径
     parser.add_argument("--data_path", type=str, default="./dataset/sft_mini_512.jsonl")
 
@@ -215,7 +227,9 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     # 创建语言模型配置
-    lm_config = LMConfig(dim=args.dim, n_layers=args.n_layers, max_seq_len=args.max_seq_len, use_moe=args.use_moe)
+    lm_config = LMConfig(dim=args.dim, n_layers=args.n_layers, max_seq_len=args.max_seq_len, use_moe=args.use_moe,
+                         expert_parallel=args.expert_parallel, fused_proj=args.fused_proj,
+                         activation_checkpoint=args.activation_checkpoint, activation_checkpoint_n=args.activation_checkpoint_n)
     # 设置保存目录
     args.save_dir = os.path.join(args.out_dir)
     # 创建必要的目录
@@ -260,6 +274,7 @@ if __name__ == "__main__":
 
     # 初始化模型和分词器
     model, tokenizer = init_model(lm_config)
+    moe_stats = MoERoutingStats(model) if lm_config.use_moe and args.moe_stats else None
 
     # 创建SFT数据集
     train_ds = SFTDataset(args.data_path, tokenizer, max_length=lm_config.max_seq_len)
@@ -283,9 +298,9 @@ if __name__ == "__main__":
 
     # 如果是分布式训练，将模型包装为DistributedDataParallel
     if ddp:
-        # 设置不参与同步的参数（通常是位置编码等）
-        model._ddp_params_and_buffers_to_ignore = {"pos_cis"}
-        model = DistributedDataParallel(model, device_ids=[ddp_local_rank])
+        # 设置不参与同步的参数（位置编码，以及专家并行时各进程各自的专家）
+        model._ddp_params_and_buffers_to_ignore = {"pos_cis"} | set(model.expert_parallel_parameters())
+        model = DistributedDataParallel(model, device_ids=[ddp_local_rank] if device_type == "cuda" else None)
 
     # 计算每个epoch的迭代次数
     iter_per_epoch = len(train_loader)
@@ -29,7 +29,6 @@ def get_lr(current_step, total_steps, lr):
 
 # 代码和full_sft「几乎」一致
 def train_epoch(epoch, wandb):
-    loss_fct = nn.CrossEntropyLoss(reduction='none')
     start_time = time.time()
     for step, (X, Y, loss_mask) in enumerate(train_loader):
         X = X.to(args.device)
@@ -40,12 +39,8 @@ def train_epoch(epoch, wandb):
             param_group['lr'] = lr
 
         with ctx:
-            res = model(X)
-            loss = loss_fct(
-                res.logits.view(-1, res.logits.size(-1)),
-                Y.view(-1)
-            ).view(Y.size())
-            loss = (loss * loss_mask).sum() / loss_mask.sum()
+            res = model(X, labels=Y, loss_mask=loss_mask)
+            loss = (res.token_loss * loss_mask).sum() / loss_mask.sum()
             loss += res.aux_loss
             loss = loss / args.accumulation_steps
 
@@ -128,11 +123,18 @@ if __name__ == "__main__":
     parser.add_argument('--n_layers', default=8, type=int)
     parser.add_argument('--max_seq_len', default=512, type=int)
     parser.add_argument('--use_moe', default=False, type=bool)
+    # 合并投影层（wqkv/w13）：LoRA仍只作用于Q与O，权重文件与分开的布局通用
+    parser.add_argument('--fused_proj', action='store_true')
+    # 激活检查点：none/every（每个块）/every_n（每activation_checkpoint_n层一个块）/attention（只有注意力子层）
+    parser.add_argument('--activation_checkpoint', default='none', type=str, choices=['none', 'every', 'every_n', 'attention'])
+    parser.add_argument('--activation_checkpoint_n', default=2, type=int)
     parser.add_argument("--data_path", type=str, default="./dataset/lora_identity.jsonl")
     parser.add_argument("--lora_name", type=str, default="lora_identity", help="根据任务保存成lora_(英文/医学/心理...)")
     args = parser.parse_args()
 
-    lm_config = LMConfig(dim=args.dim, n_layers=args.n_layers, max_seq_len=args.max_seq_len, use_moe=args.use_moe)
+    lm_config = LMConfig(dim=args.dim, n_layers=args.n_layers, max_seq_len=args.max_seq_len, use_moe=args.use_moe,
+                         fused_proj=args.fused_proj, activation_checkpoint=args.activation_checkpoint,
+                         activation_checkpoint_n=args.activation_checkpoint_n)
     args.save_dir = os.path.join(args.out_dir)
     os.makedirs(args.save_dir, exist_ok=True)
     os.makedirs(args.out_dir, exist_ok=True)
@@ -15,9 +15,10 @@ from contextlib import nullcontext
 
 from transformers import AutoTokenizer
 
-from model.model import MiniMindLM
+from model.model import MiniMindLM, clip_grad_norm_
+from model.moe_stats import MoERoutingStats
 from model.LMConfig import LMConfig
-from model.dataset import PretrainDataset
+from model.dataset import PretrainDataset, PretrainMemmapDataset
 
 warnings.filterwarnings('ignore')
 
@@ -36,14 +37,17 @@ def get_lr(current_step, total_steps, lr):
 
 # 定义训练函数
 def train_epoch(epoch, wandb):
-    # 交叉熵损失
-    loss_fct = nn.CrossEntropyLoss(reduction='none')
     start_time = time.time()
-    for step, (X, Y, loss_mask) in enumerate(train_loader):
+    for step, (X, Y, loss_mask, *position_ids) in enumerate(train_loader):
         # 数据移动到设备
         X = X.to(args.device)
         Y = Y.to(args.device)
         loss_mask = loss_mask.to(args.device)
+        # 打包的样本（--packing document）：每篇文档的位置从0开始，并按文档编号屏蔽跨文档的注意力
+        doc_args = {}
+        if args.packing == 'document':
+            position_ids = position_ids[0].to(args.device)
+            doc_args = dict(position_ids=position_ids, document_ids=(position_ids == 0).cumsum(dim=1))
 
         # 动态调整学习率
         lr = get_lr(epoch * iter_per_epoch + step, args.epochs * iter_per_epoch, args.learning_rate)
@@ -53,17 +57,12 @@ def train_epoch(epoch, wandb):
 
         # 根据CPU/GPU选择
         with ctx:
-            # 输入X到模型
-            res = model(X)
-            # 计算Loss
-            loss = loss_fct(
-                #res.logits.size(-1) 词汇表大小
-                res.logits.view(-1, res.logits.size(-1)),# 预测值，形状 (batch_size * sequence_length, vocab_size)
-                Y.view(-1) # 形状(batch_size * sequence_length)，底层会做One-Hot处理
-            ).view(Y.size()) #形状 (batch_size * sequence_length)
+            # 输入X到模型，同时给出目标Y：模型分块计算逐token的交叉熵（只算loss_mask不为0的位置），
+            # 不生成形状为(batch_size, sequence_length, vocab_size)的logits
+            res = model(X, labels=Y, loss_mask=loss_mask, **doc_args)
 
             # *掩码盖住忽略的损失； /掩码用来归一化
-            loss = (loss * loss_mask).sum() / loss_mask.sum()
+            loss = (res.token_loss * loss_mask).sum() / loss_mask.sum()
 
             # 增加模型的辅助损失
             loss += res.aux_loss
@@ -78,7 +77,7 @@ def train_epoch(epoch, wandb):
             # 将梯度还原到正常范围
             scaler.unscale_(optimizer)
             # 对模型参数的梯度进行裁剪，确保梯度的范数（L2 范数）不超过 args.grad_clip 的值。
-            torch.nn.utils.clip_grad_norm_(model.parameters(), args.grad_clip)
+            clip_grad_norm_(model, args.grad_clip)
 
             # 更新模型参数
             scaler.step(optimizer)
@@ -90,6 +89,8 @@ def train_epoch(epoch, wandb):
         # 每过log_interval步，打印当前epoch，loss，lr等日志
         if step % args.log_interval == 0:
             spend_time = time.time() - start_time
+            # MoE路由统计在设备上累加，这里汇总所有进程的统计并清零（只在日志步同步一次）
+            moe_metrics = moe_stats.summary(all_reduce=ddp) if moe_stats is not None else {}
             Logger(
                 'Epoch:[{}/{}]({}/{}) loss:{:.3f} lr:{:.12f} epoch_Time:{}min:'.format(
                     epoch + 1,
@@ -99,25 +100,29 @@ def train_epoch(epoch, wandb):
                     loss.item() * args.accumulation_steps,
                     optimizer.param_groups[-1]['lr'],
                     spend_time / (step + 1) * iter_per_epoch // 60 - spend_time // 60))
+            if moe_metrics:
+                Logger(f'MoE路由: {MoERoutingStats.format(moe_metrics)}')
             # 将训练过程中的一些关键指标（如损失值、学习率和每个 epoch 的时间）记录到 Weights & Biases (wandb) 平台
             if (wandb is not None) and (not ddp or dist.get_rank() == 0):
                 wandb.log({"loss": loss.item() * args.accumulation_steps,
                            "lr": optimizer.param_groups[-1]['lr'],
-                           "epoch_Time": spend_time / (step + 1) * iter_per_epoch // 60 - spend_time // 60})
+                           "epoch_Time": spend_time / (step + 1) * iter_per_epoch // 60 - spend_time // 60,
+                           **moe_metrics})
 
-        # 每隔一定步数保存模型
-        if (step + 1) % args.save_interval == 0 and (not ddp or dist.get_rank() == 0):
+        # 每隔一定步数保存模型；专家并行时所有rank一起收集各自的专家，由主进程保存完整的权重
+        if (step + 1) % args.save_interval == 0 and (not ddp or dist.get_rank() == 0 or lm_config.expert_parallel):
             model.eval()  # 切换到评估模式
             moe_path = '_moe' if lm_config.use_moe else ''  # 判断是否使用MoE
             ckp = f'{args.save_dir}/pretrain_{lm_config.dim}{moe_path}.pth'  # 构建保存路径
 
             # 获取模型状态字典，判断是否为分布式训练
             if isinstance(model, torch.nn.parallel.DistributedDataParallel):
-                state_dict = model.module.state_dict()
+                state_dict = model.module.full_state_dict()
             else:
                 state_dict = model.state_dict()
 
-            torch.save(state_dict, ckp)  # 保存模型
+            if not ddp or dist.get_rank() == 0:
+                torch.save(state_dict, ckp)  # 保存模型
             model.train()  # 切换回训练模式
 
 
@@ -133,10 +138,14 @@ def init_distributed_mode():
     if not ddp: return
     global ddp_local_rank, DEVICE
 
-    dist.init_process_group(backend="nccl")
+    # 没有GPU时使用gloo后端在CPU上训练（用于调试分布式/专家并行）
+    dist.init_process_group(backend="nccl" if torch.cuda.is_available() else "gloo")
     ddp_rank = int(os.environ["RANK"])
     ddp_local_rank = int(os.environ["LOCAL_RANK"])
     ddp_world_size = int(os.environ["WORLD_SIZE"])
+    if not torch.cuda.is_available():
+        DEVICE = "cpu"
+        return
     DEVICE = f"cuda:{ddp_local_rank}"
     torch.cuda.set_device(DEVICE)
 
@@ -165,10 +174,25 @@ if __name__ == "__main__":
     parser.add_argument('--n_layers', default=8, type=int)
     parser.add_argument('--max_seq_len', default=512, type=int)
     parser.add_argument('--use_moe', default=False, type=bool)
+    # 专家并行（需DDP启动）：路由专家分片到各个进程，token用all-to-all交换，n_routed_experts需能被进程数整除
+    parser.add_argument('--expert_parallel', action='store_true')
+    # 记录MoE路由统计（各层专家负载、丢弃率、路由熵），每log_interval步打印并写入wandb
+    parser.add_argument('--moe_stats', action='store_true')
+    # 合并投影层（wqkv/w13），按原布局保存的权重加载时自动合并
+    parser.add_argument('--fused_proj', action='store_true')
+    # 激活检查点：none/every（每个块）/every_n（每activation_checkpoint_n层一个块）/attention（只有注意力子层）
+    parser.add_argument('--activation_checkpoint', default='none', type=str, choices=['none', 'every', 'every_n', 'attention'])
+    parser.add_argument('--activation_checkpoint_n', default=2, type=int)
+    # jsonl文件；或scripts/pretokenize_data.py生成的token分片（目录或.bin文件），直接映射读取，不在训练时分词
     parser.add_argument("--data_path", type=str, default="./dataset/pretrain_hq.jsonl")
+    # 序列打包（需要token分片）：none每篇文档填充到max_seq_len；concat文档首尾相接切成无填充的样本；
+    # document在concat的基础上让每篇文档的位置从0开始，且注意力不跨文档（块对角因果掩码）
+    parser.add_argument('--packing', default='none', type=str, choices=['none', 'concat', 'document'])
     args = parser.parse_args()
 
-    lm_config = LMConfig(dim=args.dim, n_layers=args.n_layers, max_seq_len=args.max_seq_len, use_moe=args.use_moe)
+    lm_config = LMConfig(dim=args.dim, n_layers=args.n_layers, max_seq_len=args.max_seq_len, use_moe=args.use_moe,
+                         expert_parallel=args.expert_parallel, fused_proj=args.fused_proj,
+                         activation_checkpoint=args.activation_checkpoint, activation_checkpoint_n=args.activation_checkpoint_n)
     args.save_dir = os.path.join(args.out_dir)
     os.makedirs(args.save_dir, exist_ok=True)
     os.makedirs(args.out_dir, exist_ok=True)
@@ -204,8 +228,15 @@ if __name__ == "__main__":
         wandb = None
 
     model, tokenizer = init_model(lm_config)
+    moe_stats = MoERoutingStats(model) if lm_config.use_moe and args.moe_stats else None
     # 加载预训练数据
-    train_ds = PretrainDataset(args.data_path, tokenizer, max_length=lm_config.max_seq_len)
+    if args.data_path.endswith('.jsonl'):
+        if args.packing != 'none':
+            raise ValueError("--packing needs token shards, convert the jsonl with scripts/pretokenize_data.py")
+        train_ds = PretrainDataset(args.data_path, tokenizer, max_length=lm_config.max_seq_len)
+    else:
+        train_ds = PretrainMemmapDataset(args.data_path, max_length=lm_config.max_seq_len,
+                                         pad_token_id=tokenizer.pad_token_id, pack=args.packing != 'none')
     # DistributedSampler确保在多GPU训练时每个进程只处理数据集的一个子集，避免数据重复
     train_sampler = DistributedSampler(train_ds) if ddp else None
     # 创建DataLoader用于批量加载和处理数据
@@ -228,10 +259,11 @@ if __name__ == "__main__":
 
     if ddp:
         # 在分布式训练中，pos_cis参数不需要进行梯度同步(通常是位置编码相关参数)
-        model._ddp_params_and_buffers_to_ignore = {"pos_cis"}
+        # 专家并行时各进程的专家互不相同，也不参与同步
+        model._ddp_params_and_buffers_to_ignore = {"pos_cis"} | set(model.expert_parallel_parameters())
         # 将模型包装为DistributedDataParallel，实现数据并行训练
         # device_ids指定当前进程使用的GPU设备ID
-        model = DistributedDataParallel(model, device_ids=[ddp_local_rank])
+        model = DistributedDataParallel(model, device_ids=[ddp_local_rank] if device_type == "cuda" else None)
 
     # 计算每个epoch中的迭代次数，用于学习率调整和日志记录
     iter_per_epoch = len(train_loader)